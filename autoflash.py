@@ -1,8 +1,22 @@
+import asyncio
 import logging
 import argparse
+import contextlib
 import ipaddress
+from pathlib import Path
+import autoflash.log as log
+from autoflash import TFTP_IP, IP_NETWORK
 from autoflash import OPENWRT_DEFAULT_LAN_IP
 from autoflash import run_autoflash
+from autoflash import parallel
+from autoflash import metrics
+from autoflash import history
+from autoflash import aio
+from autoflash import ips
+from autoflash import netns
+import autoflash.interaction.uboot as uboot
+from autoflash.tftp import TftpServer
+from autoflash.imageserver import ImageServer
 
 
 def parse_args():
@@ -23,12 +37,25 @@ def parse_args():
     parser.add_argument(
         "--port",
         type=str,
-        default="/dev/ttyUSB0",
-        help="Serial port, default is /dev/ttyUSB0",
+        nargs="+",
+        default=["/dev/ttyUSB0"],
+        help="Serial port(s) or glob like '/dev/ttyUSB*', default is /dev/ttyUSB0. "
+        "With multiple ports, all APs are flashed in parallel with automatically assigned IPs.",
     )
     parser.add_argument(
         "--speed", type=int, default=9600, help="Baudrate, default is 9600"
     )
+    parser.add_argument(
+        "--fast-speed",
+        type=int,
+        metavar="BAUD",
+        help="Switch U-Boot and OpenWrt to this baudrate after logging in, eg. 115200",
+    )
+    parser.add_argument(
+        "--detect-speed",
+        action="store_true",
+        help="Detect whether the AP talks at --speed or --fast-speed before logging in",
+    )
     parser.add_argument(
         "-p",
         "--password",
@@ -40,7 +67,92 @@ def parse_args():
         "--ap-ip",
         type=ipaddress.IPv4Address,
         default=OPENWRT_DEFAULT_LAN_IP,
-        help="IP address for the AP",
+        help="IP address for the AP (single port only)",
+    )
+    parser.add_argument(
+        "--ip-network",
+        type=ipaddress.IPv4Network,
+        default=IP_NETWORK,
+        help=f"Network to lease AP IPs from when flashing multiple ports, default is {IP_NETWORK}",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        type=Path,
+        help="Append timing events of all flash phases as JSON lines to this file",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Serve Prometheus metrics on this port at /metrics",
+    )
+    parser.add_argument(
+        "--skip-flashed",
+        action="store_true",
+        help="Mark flashed APs, and don't flash APs again that already run the sysupgrade image",
+    )
+    parser.add_argument(
+        "--uboot-script",
+        type=Path,
+        help="JSON file with the U-Boot prompts and dialogues of another AP model or U-Boot version, "
+        "see README",
+    )
+    parser.add_argument(
+        "--checkpoint-dir",
+        type=Path,
+        help="Save the progress of every port to this directory and resume from it on the next run",
+    )
+    parser.add_argument(
+        "--capture-dir",
+        type=Path,
+        help="Record the serial session of every AP to a compressed file in this directory",
+    )
+    parser.add_argument(
+        "--log-dir",
+        type=Path,
+        help="When flashing multiple ports, additionally write one log file per port to this directory",
+    )
+    parser.add_argument(
+        "--http",
+        action="store_true",
+        help="Let the AP download the sysupgrade image from the built-in HTTP server "
+        "instead of copying it with scp",
+    )
+    parser.add_argument(
+        "--http-port",
+        type=int,
+        default=8080,
+        help="Port of the built-in HTTP server, default is 8080",
+    )
+    parser.add_argument(
+        "--tftp-dir",
+        type=Path,
+        help=f"Serve this directory with the built-in TFTP server on {TFTP_IP}:69 "
+        "instead of using an external TFTP server",
+    )
+    parser.add_argument(
+        "--netns",
+        action="append",
+        metavar="PORT=INTERFACE",
+        help="Flash the AP on PORT (eg. ttyUSB0) in a network namespace of its own with INTERFACE "
+        f"at {TFTP_IP}, so every AP keeps its default IP. Needs root, repeat for every port",
+    )
+    parser.add_argument(
+        "--history",
+        type=Path,
+        metavar="FILE",
+        help="Keep the durations of all flash phases in this SQLite file and fail a phase early "
+        "once it takes much longer than before, see README",
+    )
+    parser.add_argument(
+        "--model",
+        type=str,
+        help="AP model the history is kept for, default is the name of the --uboot-script "
+        "or 'default'",
+    )
+    parser.add_argument(
+        "--asyncio",
+        action="store_true",
+        help="Drive all ports from a single asyncio event loop instead of one thread per port",
     )
     parser.add_argument(
         "-d",
@@ -63,18 +175,172 @@ def parse_args():
     return parser.parse_args()
 
 
+def start_servers(args, stack: contextlib.ExitStack):
+    """Starts the built-in servers requested on the command line, returns the image server"""
+    if args.tftp_dir:
+        stack.enter_context(TftpServer(args.tftp_dir))
+    if args.http:
+        return stack.enter_context(ImageServer(port=args.http_port))
+    return None
+
+
+def flash_isolated(args, port, interfaces):
+    """
+    Flashes the AP on `port` in the port's network namespace, with servers of
+    its own, as the ones of the host's namespace can't be reached from there
+    """
+    with netns.isolated(port, interfaces[parallel.port_name(port)]):
+        with contextlib.ExitStack() as stack:
+            run_autoflash(
+                args.ramboot_file_name,
+                args.sysupgrade_path,
+                port,
+                args.speed,
+                args.password,
+                OPENWRT_DEFAULT_LAN_IP,
+                image_server=start_servers(args, stack),
+                fast_speed=args.fast_speed,
+                detect_speed=args.detect_speed,
+                capture_dir=args.capture_dir,
+                checkpoint_dir=args.checkpoint_dir,
+                skip_flashed=args.skip_flashed,
+            )
+    return OPENWRT_DEFAULT_LAN_IP
+
+
+def flash_ports(args, ports, image_server=None, interfaces=None):
+    def get_ap_ip(port):
+        if len(ports) == 1:
+            return args.ap_ip
+
+        return ips.claim_ip(reserved_ips=[TFTP_IP], holder=port)
+
+    def release_ap_ip(ap_ip):
+        # After a failure the AP might still use its IP, so that lease is left to expire
+        if len(ports) > 1:
+            ips.release_ip(ap_ip)
+
+    def flash(port):
+        if interfaces:
+            return flash_isolated(args, port, interfaces)
+
+        ap_ip = get_ap_ip(port)
+        run_autoflash(
+            args.ramboot_file_name,
+            args.sysupgrade_path,
+            port,
+            args.speed,
+            args.password,
+            ap_ip,
+            image_server=image_server,
+            fast_speed=args.fast_speed,
+            detect_speed=args.detect_speed,
+            capture_dir=args.capture_dir,
+            checkpoint_dir=args.checkpoint_dir,
+            skip_flashed=args.skip_flashed,
+        )
+        release_ap_ip(ap_ip)
+        return ap_ip
+
+    async def flash_async(port):
+        # The leases are in SQLite, which would block the loop and every other port
+        ap_ip = await asyncio.to_thread(get_ap_ip, port)
+        await aio.run_autoflash(
+            args.ramboot_file_name,
+            args.sysupgrade_path,
+            port,
+            args.speed,
+            args.password,
+            ap_ip,
+            image_server=image_server,
+        )
+        await asyncio.to_thread(release_ap_ip, ap_ip)
+        return ap_ip
+
+    if args.asyncio:
+        results = asyncio.run(
+            parallel.run_on_ports_async(ports, flash_async, log_dir=args.log_dir)
+        )
+    else:
+        results = parallel.run_on_ports(ports, flash, log_dir=args.log_dir)
+    parallel.print_results(results)
+    return all(r.ok for r in results)
+
+
 def main():
     args = parse_args()
+    ports = parallel.expand_ports(args.port)
+    if not ports:
+        raise SystemExit("No serial ports found")
+
+    metrics.configure(args.metrics_file, args.metrics_port)
+    if TFTP_IP not in args.ip_network:
+        # U-Boot's ipaddr and serverip must be in the same subnet for the ramboot
+        raise SystemExit(f"--ip-network must contain the TFTP server's IP {TFTP_IP}")
+    ips.configure(network=args.ip_network)
+    if args.uboot_script:
+        uboot.use_script(args.uboot_script)
+    if args.history:
+        history.configure(
+            args.history,
+            model=args.model or (args.uboot_script.stem if args.uboot_script else None),
+        )
+
+    if len(ports) > 1 and args.ap_ip != OPENWRT_DEFAULT_LAN_IP:
+        raise SystemExit("--ap-ip can only be used with a single port")
+    if args.skip_flashed and not args.sysupgrade_path:
+        raise SystemExit("--skip-flashed needs --sysupgrade-path")
+    interfaces = None
+    if args.netns:
+        if args.ap_ip != OPENWRT_DEFAULT_LAN_IP:
+            raise SystemExit("--ap-ip can't be used with --netns")
+        try:
+            interfaces = netns.parse_interfaces(args.netns, ports)
+        except ValueError as e:
+            raise SystemExit(f"--netns: {e}")
+    if args.asyncio and (
+        args.fast_speed
+        or args.detect_speed
+        or args.capture_dir
+        or args.checkpoint_dir
+        or args.netns
+        or args.skip_flashed
+        or args.history
+    ):
+        raise SystemExit(
+            "--fast-speed, --detect-speed, --capture-dir, --checkpoint-dir, "
+            "--netns, --skip-flashed and --history can't be used with --asyncio"
+        )
+
+    if len(ports) > 1 or args.asyncio or interfaces:
+        logging.basicConfig(
+            level=args.loglevel, format=log.PARALLEL_FORMAT, datefmt=log.DATEFMT
+        )
+        with contextlib.ExitStack() as stack:
+            # With --netns, every port has servers of its own
+            image_server = None if interfaces else start_servers(args, stack)
+            if not flash_ports(args, ports, image_server, interfaces):
+                raise SystemExit(1)
+        return
+
     logging.basicConfig(level=args.loglevel)
 
-    run_autoflash(
-        args.ramboot_file_name,
-        args.sysupgrade_path,
-        args.port,
-        args.speed,
-        args.password,
-        args.ap_ip,
-    )
+    with contextlib.ExitStack() as stack:
+        image_server = start_servers(args, stack)
+        run_autoflash(
+            args.ramboot_file_name,
+            args.sysupgrade_path,
+            ports[0],
+            args.speed,
+            args.password,
+            args.ap_ip,
+            image_server=image_server,
+            fast_speed=args.fast_speed,
+            detect_speed=args.detect_speed,
+            capture_dir=args.capture_dir,
+            checkpoint_dir=args.checkpoint_dir,
+            skip_flashed=args.skip_flashed,
+        )
 
     if args.loglevel == logging.DEBUG:
         print()
@@ -1,11 +1,23 @@
+import os
+import re
+import time
+import logging
 import serial
 import ipaddress
 import autoflash.interaction.uboot as uboot
 import autoflash.interaction.openwrt as openwrt
+import autoflash.metrics as metrics
+import autoflash.capture as capture
+import autoflash.checkpoint as checkpoint
+import autoflash.digests as digests
+from autoflash.interaction.serial import detect_baudrate
 
 IP_NETWORK = ipaddress.IPv4Network("192.168.1.0/24")
 OPENWRT_DEFAULT_LAN_IP = ipaddress.IPv4Address("192.168.1.1")
 TFTP_IP = IP_NETWORK[10]
+# Seconds the installed firmware may take to boot when checking whether an
+# AP is flashed already, see `flash_ap`
+FIRMWARE_BOOT_TIMEOUT = 120
 
 
 def run_autoflash(
@@ -15,23 +27,206 @@ def run_autoflash(
     speed=9600,
     password="admin@huawei.com",
     ap_ip=OPENWRT_DEFAULT_LAN_IP,
+    image_server=None,
+    fast_speed=None,
+    detect_speed=False,
+    capture_dir=None,
+    checkpoint_dir=None,
+    skip_flashed=False,
+    sysupgrade_sha256=None,
 ):
-    with serial.Serial(port, speed, timeout=1) as ser:
-        # Ramboot
-        uboot.ensure_ready(ser, password)
-        uboot.configure_ramboot(ser, TFTP_IP, ap_ip, ramboot_file_name)
-        uboot.run_ramboot(ser)
+    """
+    Flashes the AP on `port`. If an `imageserver.ImageServer` is passed, the AP
+    downloads the sysupgrade image from it instead of it being copied with scp.
 
-        if not sysupgrade_path:
-            return
+    `speed` is the AP's default baud rate. With `fast_speed`, U-Boot and the
+    OpenWrt console are switched to that rate after logging in. With
+    `detect_speed`, the rate the AP currently talks at is detected first, in
+    case a previous run left it at `fast_speed`. With `capture_dir`, the
+    serial session is recorded to a new file in it, see `capture`. With
+    `checkpoint_dir`, the flash is resumed where a previous run on `port` stopped,
+    see `checkpoint`. With `skip_flashed`, an AP that already runs the
+    sysupgrade image is not flashed again. The image is verified on the AP
+    against `sysupgrade_sha256`, see `flash_ap`.
+    """
+    with serial.Serial(port, speed, timeout=1) as port_ser, capture.capturing(
+        port_ser, capture_dir
+    ) as ser:
+        flash_ap(
+            ser,
+            ramboot_file_name,
+            sysupgrade_path,
+            password,
+            ap_ip,
+            image_server,
+            fast_speed=fast_speed,
+            detect_speed=detect_speed,
+            checkpoints=checkpoint.CheckpointStore(checkpoint_dir),
+            skip_flashed=skip_flashed,
+            sysupgrade_sha256=sysupgrade_sha256,
+        )
+
+
+def flash_ap(
+    ser,
+    ramboot_file_name,
+    sysupgrade_path=None,
+    password="admin@huawei.com",
+    ap_ip=OPENWRT_DEFAULT_LAN_IP,
+    image_server=None,
+    prompt=None,
+    fast_speed=None,
+    detect_speed=False,
+    checkpoints: checkpoint.CheckpointStore = None,
+    skip_flashed=False,
+    sysupgrade_sha256=None,
+):
+    """
+    Like `run_autoflash`, but on an already open serial port, which must be set
+    to the AP's default baud rate. `prompt` is the U-Boot prompt that was
+    already read, see `uboot.wait_for_power_on`, otherwise the AP's state is
+    probed and the flash continues from there, see `checkpoint`. Failed steps
+    are retried according to `checkpoint.RETRIES`.
+
+    With `skip_flashed`, U-Boot's environment and the installed firmware are
+    marked with the digest of the sysupgrade image once sysupgrade succeeded,
+    and an AP whose installed firmware has the image's marker is not flashed
+    again. An AP that was just powered
+    on is let boot its firmware for that, instead of stopping in U-Boot.
+
+    The sysupgrade image is checked on the AP against its digest before it is
+    flashed, a mismatch repeats the transfer. Pass `sysupgrade_sha256` if the
+    digest is known, otherwise it is taken from `digests`.
+    """
+    console_speed = ser.baudrate
+    checkpoints = checkpoints or checkpoint.CheckpointStore()
+    image = sysupgrade_path or ramboot_file_name
+    file_name = os.path.basename(sysupgrade_path) if sysupgrade_path else None
+    trace = metrics.Trace(ser.port, ap_ip, image)
+    sha256 = sysupgrade_sha256
+    if sysupgrade_path and not sha256:
+        sha256 = digests.sha256(sysupgrade_path)
+    # The installed firmware is marked with the image's digest
+    image_sha256 = sha256 if skip_flashed else None
 
-        # Flash OpenWrt
-        openwrt.wait_for_shell_ready(ser)
-        openwrt.wait_for_lan_ready(ser)
+    def ramboot():
+        nonlocal prompt
+        with trace.phase("uboot_login"):
+            uboot.ensure_ready(ser, password, prompt)
+            prompt = None
+            if fast_speed:
+                uboot.switch_baudrate(ser, fast_speed)
+        with trace.phase("configure_ramboot"):
+            uboot.configure_ramboot(ser, TFTP_IP, ap_ip, ramboot_file_name)
+        with trace.phase("ramboot"):
+            uboot.run_ramboot(ser, console_baudrate=console_speed)
+        return checkpoint.RAMBOOTED
+
+    def prepare_lan():
+        if not sysupgrade_path:
+            return checkpoint.DONE
+        with trace.phase("shell_ready"):
+            openwrt.wait_for_shell_ready(ser)
+            if fast_speed:
+                openwrt.switch_baudrate(ser, fast_speed)
+        with trace.phase("lan_ready"):
+            openwrt.wait_for_lan_ready(ser)
         if ap_ip != OPENWRT_DEFAULT_LAN_IP:
             openwrt.set_lan_ip(ser, ap_ip)
-        openwrt.wait_for_pingable(ser, ap_ip)
-        openwrt.flash_openwrt(ser, ap_ip, sysupgrade_path)
+        return checkpoint.LAN_READY
+
+    def transfer():
+        if image_server:
+            with trace.phase("transfer"):
+                with image_server.published(sysupgrade_path) as url:
+                    openwrt.download_sysupgrade(ser, url, sha256, file_name)
+        else:
+            with trace.phase("pingable"):
+                openwrt.wait_for_pingable(ser, ap_ip)
+            with trace.phase("transfer"):
+                openwrt.copy_sysupgrade(ap_ip, sysupgrade_path)
+            with trace.phase("verify"):
+                openwrt.verify_sysupgrade(ser, sha256, file_name)
+        return checkpoint.TRANSFERRED
+
+    def start_sysupgrade():
+        openwrt.run_sysupgrade(ser, file_name)
+        return checkpoint.SYSUPGRADE
+
+    def wait_for_sysupgrade():
+        with trace.phase("sysupgrade"):
+            rebooted = openwrt.wait_for_sysupgrade_complete(
+                ser, console_baudrate=console_speed
+            )
+            if image_sha256:
+                # Only now the AP is known to run the image, see `check_flashed`.
+                # U-Boot might have asked to stop auto-boot already.
+                if not re.match(uboot.PROMPT_STOP_AUTOBOOT, rebooted):
+                    rebooted = None
+                uboot.ensure_ready(ser, password, rebooted)
+                uboot.save_env(ser, {uboot.ENV_IMAGE: image_sha256})
+                uboot.boot(ser)
+            openwrt.wait_for_shell_ready(ser)
+        if image_sha256:
+            openwrt.write_image_marker(ser, image_sha256)
+        return checkpoint.DONE
+
+    steps = {
+        checkpoint.UBOOT: ramboot,
+        checkpoint.RAMBOOTED: prepare_lan,
+        checkpoint.LAN_READY: transfer,
+        checkpoint.TRANSFERRED: start_sysupgrade,
+        checkpoint.SYSUPGRADE: wait_for_sysupgrade,
+    }
+
+    def resume():
+        if detect_speed:
+            candidates = [console_speed] + ([fast_speed] if fast_speed else [])
+            detect_baudrate(ser, candidates, probe=b"\r")
+        return checkpoint.resume_state(
+            ser, checkpoints.load(ser.port), image, ap_ip, image_sha256
+        )
+
+    def check_flashed(prompt):
+        """
+        Boots the installed firmware if U-Boot's environment says the AP was
+        flashed with the image before, returns the state to continue from
+        """
+        with trace.phase("firmware_check"):
+            uboot.ensure_ready(ser, password, prompt)
+            if uboot.read_env(ser, uboot.ENV_IMAGE) != image_sha256:
+                return checkpoint.UBOOT, None
+
+            # Only the installed firmware can tell whether the flash completed
+            logging.info("The AP was flashed with the image before, booting it")
+            uboot.boot(ser)
+            try:
+                openwrt.wait_for_shell_ready(ser, timeout=FIRMWARE_BOOT_TIMEOUT)
+            except Exception as e:
+                logging.warning(f"The installed firmware didn't boot: {e}")
+        return resume()
+
+    with trace.run():
+        state = checkpoint.UBOOT if prompt is not None else None
+        if state is None:
+            state, prompt = resume()
+        if state == checkpoint.UBOOT and image_sha256:
+            state, prompt = check_flashed(prompt)
 
-        # Wait for sysupgrade to finish
-        openwrt.wait_for_shell_ready(ser)
+        failures = {}
+        while state != checkpoint.DONE:
+            try:
+                state = steps[state]()
+            except Exception as e:
+                failures[state] = failures.get(state, 0) + 1
+                attempts, delay = checkpoint.RETRIES[state]
+                if failures[state] >= attempts:
+                    raise
+                logging.warning(
+                    f"Step after '{state}' failed ({e}), retrying in {delay}s "
+                    f"({failures[state]}/{attempts})"
+                )
+                time.sleep(delay)
+                state, prompt = resume()
+                continue
+            checkpoints.save(ser.port, state, image, ap_ip)
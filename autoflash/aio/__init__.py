@@ -0,0 +1,78 @@
+"""
+Asyncio version of the flash sequence.
+
+`run_autoflash` does the same as `autoflash.run_autoflash`, but all waiting
+happens on the event loop, so a single thread can flash many APs at once.
+"""
+
+import os
+import asyncio
+from . import uboot
+from . import openwrt
+from .serial import AsyncSerial
+from .. import TFTP_IP, OPENWRT_DEFAULT_LAN_IP
+from .. import digests
+from .. import metrics
+
+
+async def run_autoflash(
+    ramboot_file_name,
+    sysupgrade_path=None,
+    port="/dev/ttyUSB0",
+    speed=9600,
+    password="admin@huawei.com",
+    ap_ip=OPENWRT_DEFAULT_LAN_IP,
+    image_server=None,
+):
+    trace = metrics.Trace(port, ap_ip, sysupgrade_path or ramboot_file_name)
+    async with AsyncSerial(port, speed) as aser:
+        with trace.run():
+            await _flash(
+                aser,
+                trace,
+                ramboot_file_name,
+                sysupgrade_path,
+                password,
+                ap_ip,
+                image_server,
+            )
+
+
+async def _flash(
+    aser, trace, ramboot_file_name, sysupgrade_path, password, ap_ip, image_server
+):
+    # Ramboot
+    with trace.phase("uboot_login"):
+        await uboot.ensure_ready(aser, password)
+    with trace.phase("configure_ramboot"):
+        await uboot.configure_ramboot(aser, TFTP_IP, ap_ip, ramboot_file_name)
+    with trace.phase("ramboot"):
+        await uboot.run_ramboot(aser)
+
+    if not sysupgrade_path:
+        return
+
+    # Flash OpenWrt
+    with trace.phase("shell_ready"):
+        await openwrt.wait_for_shell_ready(aser)
+    with trace.phase("lan_ready"):
+        await openwrt.wait_for_lan_ready(aser)
+    if ap_ip != OPENWRT_DEFAULT_LAN_IP:
+        openwrt.set_lan_ip(aser, ap_ip)
+    sha256 = await asyncio.to_thread(digests.sha256, sysupgrade_path)
+    if image_server:
+        file_name = os.path.basename(sysupgrade_path)
+        with trace.phase("transfer"):
+            with image_server.published(sysupgrade_path) as url:
+                await openwrt.download_sysupgrade(aser, url, sha256, file_name)
+        openwrt.run_sysupgrade(aser, file_name)
+    else:
+        with trace.phase("pingable"):
+            await openwrt.wait_for_pingable(aser, ap_ip)
+        with trace.phase("transfer"):
+            await openwrt.flash_openwrt(aser, ap_ip, sysupgrade_path, sha256)
+
+    # Wait for sysupgrade to finish
+    with trace.phase("sysupgrade"):
+        await openwrt.wait_for_sysupgrade_complete(aser)
+        await openwrt.wait_for_shell_ready(aser)
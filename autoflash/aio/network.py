@@ -0,0 +1,87 @@
+import asyncio
+from .. import network
+from ..network import SSH_PORT, MIN_PROBE_INTERVAL, MAX_PROBE_INTERVAL, CONNECT_TIMEOUT
+
+
+async def _ping_command(ip):
+    process = await asyncio.create_subprocess_exec(
+        "ping",
+        "-c",
+        "1",
+        "-W",
+        "1",
+        str(ip),
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+
+    return await process.wait() == 0
+
+
+async def ip_responds_to_ping(ip, timeout=1.0):
+    sock = network.open_icmp_socket()
+    if sock is None:
+        return await _ping_command(ip)
+
+    ip = str(ip)
+    loop = asyncio.get_running_loop()
+    replied = loop.create_future()
+
+    def on_readable():
+        while True:
+            try:
+                packet, (source, _) = sock.recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+            if source == ip and network.parse_echo_reply(sock, packet):
+                if not replied.done():
+                    replied.set_result(True)
+
+    loop.add_reader(sock.fileno(), on_readable)
+    try:
+        sock.sendto(network.icmp_echo_request(0, 1), (ip, 0))
+        await asyncio.wait_for(replied, timeout)
+        return True
+    except (OSError, asyncio.TimeoutError):
+        return False
+    finally:
+        loop.remove_reader(sock.fileno())
+        sock.close()
+
+
+async def wait_for_reachable(ip, port=SSH_PORT, timeout=180) -> bool:
+    """
+    Like `network.wait_for_reachable`. Many IPs can be watched from the same
+    event loop by running this concurrently.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    interval = MIN_PROBE_INTERVAL
+    while (remaining := deadline - loop.time()) > 0:
+        alive = str(ip) in network.arp_neighbours()
+        probe_timeout = min(CONNECT_TIMEOUT, remaining)
+        ping = asyncio.ensure_future(ip_responds_to_ping(ip, probe_timeout))
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(str(ip), port), probe_timeout
+            )
+            writer.close()
+            ping.cancel()
+            return True
+        except ConnectionRefusedError:
+            # The host is up, only the service isn't yet
+            alive = True
+        except (OSError, asyncio.TimeoutError):
+            pass
+
+        if alive:
+            ping.cancel()
+        else:
+            alive = await ping
+
+        interval = (
+            MIN_PROBE_INTERVAL if alive else min(interval * 2, MAX_PROBE_INTERVAL)
+        )
+        await asyncio.sleep(min(interval, max(0, deadline - loop.time())))
+
+    return False
@@ -0,0 +1,157 @@
+import re
+import os
+import asyncio
+import logging
+import ipaddress
+from . import serial
+from . import network
+from ..interaction.openwrt import (
+    PROMPT_OPENWRT_SHELL,
+    PROMPT_LAN_FORWARDING,
+    PROMPTS_SHELL_READY,
+    PROMPTS_SYSUPGRADE_COMPLETE,
+    SHELL_PROBE_INTERVAL,
+    LAN_SETTLE_TIME,
+    DOWNLOAD_OK,
+    PROMPTS_DOWNLOAD,
+    CHECKSUM_OK,
+    PROMPTS_CHECKSUM,
+    download_command,
+    verify_command,
+)
+from ..log import debug_logging_enabled
+
+
+async def wait_for_shell_ready(aser: serial.AsyncSerial, timeout=100):
+    """See `interaction.openwrt.wait_for_shell_ready`"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    aser.write(b"\n")
+    while (remaining := deadline - loop.time()) > 0:
+        m = await serial.read_until_match(
+            aser, PROMPTS_SHELL_READY, min(SHELL_PROBE_INTERVAL, remaining)
+        )
+        if m is not None and re.match(PROMPT_OPENWRT_SHELL, m):
+            if debug_logging_enabled():
+                print()
+
+            logging.info("OpenWRT shell ready")
+            return
+        aser.write(b"\n")
+
+    serial.log_buffer_as_error(aser)
+    raise Exception("Timeout waiting for OpenWrt shell ready")
+
+
+async def wait_for_sysupgrade_complete(aser: serial.AsyncSerial, timeout=300):
+    await serial.wait_for_prompt_match(
+        aser, PROMPTS_SYSUPGRADE_COMPLETE, timeout=timeout
+    )
+    logging.info("Sysupgrade complete, AP is rebooting")
+
+
+async def wait_for_lan_ready(aser: serial.AsyncSerial, settle_time=LAN_SETTLE_TIME):
+    logging.info("Waiting for OpenWrt's 'br-lan' LAN interface to be ready")
+
+    aser.write(b"\n")
+    await serial.wait_for_prompt_match(aser, PROMPT_OPENWRT_SHELL)
+
+    aser.write(b'while ! ip link show br-lan | grep -q "br-lan"; do sleep 1; done\n')
+
+    await serial.wait_for_prompt_match(aser, PROMPT_OPENWRT_SHELL, timeout=180)
+
+    if not aser.console.history_contains(PROMPT_LAN_FORWARDING):
+        await serial.read_until_match(aser, PROMPT_LAN_FORWARDING, settle_time)
+    if debug_logging_enabled():
+        print()
+
+    logging.info("OpenWrt LAN ready")
+
+
+async def wait_for_pingable(
+    aser: serial.AsyncSerial,
+    ip: ipaddress.IPv4Address,
+    port=network.SSH_PORT,
+    timeout=180,
+):
+    logging.info(f"Waiting for AP @ {ip} to accept connections on port {port}")
+    reachable = asyncio.ensure_future(network.wait_for_reachable(ip, port, timeout))
+    while not reachable.done():
+        # Into the console's history like any other output, see `serial.next_match`
+        read = aser.console.decode(aser.read_available())
+        if debug_logging_enabled():
+            print(read, end="")
+        await asyncio.wait([reachable], timeout=0.5)
+
+    if not reachable.result():
+        raise Exception(f"Timeout waiting for AP @ {ip} to be reachable on port {port}")
+    logging.info(f"AP @ {ip} is reachable now")
+
+
+def set_lan_ip(aser: serial.AsyncSerial, ip: ipaddress.IPv4Address):
+    logging.info(f"Setting LAN IP to {ip}")
+    aser.write(f"uci set network.lan.ipaddr={ip}\n".encode("utf-8"))
+    aser.write(b"uci commit network\n")
+    aser.write(b"/etc/init.d/network restart\n")
+
+
+async def flash_openwrt(
+    aser: serial.AsyncSerial,
+    ap_ip: ipaddress.IPv4Address,
+    sysupgrade_file: str,
+    sha256: str = None,
+):
+    logging.info("Copying sysupgrade image to AP using scp")
+
+    process = await asyncio.create_subprocess_exec(
+        "scp",
+        "-o",
+        "StrictHostKeyChecking=no",
+        "-o",
+        "UserKnownHostsFile=/dev/null",
+        "-O",  # Enable legacy scp mode, otherwise we get "ash: /usr/libexec/sftp-server: not found"
+        str(sysupgrade_file),
+        f"root@{ap_ip}:/tmp",
+    )
+    if await process.wait() != 0:
+        logging.error("Failed to copy sysupgrade image using scp")
+        raise Exception(f"scp exited with status {process.returncode}")
+
+    if sha256:
+        await verify_sysupgrade(aser, sha256, os.path.basename(sysupgrade_file))
+    run_sysupgrade(aser, os.path.basename(sysupgrade_file))
+
+
+async def download_sysupgrade(
+    aser: serial.AsyncSerial, url: str, sha256: str, file_name: str
+):
+    logging.info(f"Letting AP download sysupgrade image from {url}")
+    aser.write(download_command(url, sha256, file_name).encode("utf-8"))
+
+    result = await serial.wait_for_prompt_match(aser, PROMPTS_DOWNLOAD, timeout=120)
+    if result != DOWNLOAD_OK:
+        serial.log_buffer_as_error(aser)
+        raise Exception("Download of sysupgrade image failed or checksum mismatch")
+
+    logging.info("Sysupgrade image downloaded and verified")
+
+
+async def verify_sysupgrade(aser: serial.AsyncSerial, sha256: str, file_name: str):
+    logging.info("Verifying sysupgrade image on AP")
+    aser.write(verify_command(sha256, file_name).encode("utf-8"))
+
+    result = await serial.wait_for_prompt_match(aser, PROMPTS_CHECKSUM, timeout=60)
+    if result != CHECKSUM_OK:
+        serial.log_buffer_as_error(aser)
+        raise Exception(f"Checksum mismatch of sysupgrade image, expected {sha256}")
+
+    logging.info("Sysupgrade image verified")
+
+
+def run_sysupgrade(aser: serial.AsyncSerial, sysupgrade_file_name: str):
+    options = "-n"  # Don't save config
+    if debug_logging_enabled():
+        options += " -v"
+
+    logging.info(f"Running sysupgrade with OpenWrt image {sysupgrade_file_name}")
+    aser.write(f"sysupgrade {options} /tmp/{sysupgrade_file_name}\n".encode("utf-8"))
@@ -0,0 +1,148 @@
+import os
+import re
+import sys
+import asyncio
+import serial
+from ..interaction.serial import Console, PromptMatcher
+from ..log import debug_logging_enabled
+
+
+class AsyncSerial:
+    """
+    Serial port driven by the asyncio event loop.
+
+    Instead of polling `inWaiting()`, the port's file descriptor is registered
+    with the event loop, so waiting for output costs no CPU and no thread.
+    Writes are queued and sent whenever the port can take them, so a slow
+    port doesn't block the loop and with it every other port.
+    """
+
+    def __init__(self, port, baudrate):
+        self.port = port
+        self.ser = serial.Serial(port, baudrate, timeout=0)
+        self.console = Console()
+        self._received = bytearray()
+        self._unsent = bytearray()
+        self._data_available = asyncio.Event()
+        self._error = None
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(self.ser.fileno(), self._on_readable)
+
+    def _on_readable(self):
+        try:
+            data = self.ser.read(self.ser.in_waiting or 1)
+        except serial.SerialException as e:
+            self._loop.remove_reader(self.ser.fileno())
+            self._error = e
+            data = b""
+        self._received += data
+        self._data_available.set()
+
+    async def read(self, timeout=None) -> bytes:
+        """Waits until data is available and returns everything received so far"""
+        if not self._received and self._error is None:
+            self._data_available.clear()
+            await asyncio.wait_for(self._data_available.wait(), timeout)
+        if self._error is not None:
+            raise self._error
+
+        data = bytes(self._received)
+        self._received.clear()
+        return data
+
+    @property
+    def in_waiting(self):
+        return len(self._received)
+
+    def read_available(self) -> bytes:
+        data = bytes(self._received)
+        self._received.clear()
+        return data
+
+    def write(self, data: bytes):
+        if self._error is not None:
+            raise self._error
+        if not self._unsent:
+            self._loop.add_writer(self.ser.fileno(), self._on_writable)
+        self._unsent += data
+
+    def _on_writable(self):
+        try:
+            # The port is non-blocking, see `serial.Serial.open`
+            del self._unsent[: os.write(self.ser.fileno(), self._unsent)]
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._unsent.clear()
+            self._error = serial.SerialException(f"write failed: {e}")
+            self._data_available.set()
+        if not self._unsent:
+            self._loop.remove_writer(self.ser.fileno())
+
+    def close(self):
+        self._loop.remove_reader(self.ser.fileno())
+        self._loop.remove_writer(self.ser.fileno())
+        self.ser.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+
+def log_buffer_as_error(aser: AsyncSerial):
+    aser.console.log_as_error()
+
+
+async def read_until_match(aser: AsyncSerial, prompt_regex, timeout):
+    """Like `wait_for_prompt_match`, but returns None on timeout"""
+    match = await next_match(aser, prompt_regex, timeout)
+    return None if match is None else match.group(0)
+
+
+async def next_match(aser: AsyncSerial, prompt_regex, timeout) -> re.Match:
+    """Like `read_until_match`, but returns the `re.Match`, see `interaction.serial.next_match`"""
+    loop = asyncio.get_running_loop()
+    matcher = PromptMatcher(prompt_regex)
+    echo = sys.stdout.write if debug_logging_enabled() else None
+    deadline = loop.time() + timeout
+    try:
+        while (remaining := deadline - loop.time()) > 0:
+            try:
+                data = await aser.read(timeout=remaining)
+            except asyncio.TimeoutError:
+                break
+
+            new_read = aser.console.decode(data)
+            if echo:
+                echo(new_read)
+            match = matcher.feed(new_read)
+            if match:
+                return match
+
+        return None
+    finally:
+        if echo:
+            sys.stdout.flush()
+
+
+async def wait_for_prompt_match(aser: AsyncSerial, prompt_regex, timeout=60):
+    match = await read_until_match(aser, prompt_regex, timeout)
+    if match is None:
+        log_buffer_as_error(aser)
+        raise Exception(
+            f"Timeout waiting for prompt: '{re.compile(prompt_regex).pattern}'"
+        )
+    return match
+
+
+async def wait_for_quiet(aser: AsyncSerial, quiet_time=0.05, timeout=0.2):
+    """See `interaction.serial.wait_for_quiet`"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while (remaining := deadline - loop.time()) > 0:
+        received = aser.in_waiting
+        await asyncio.sleep(min(quiet_time, remaining))
+        if aser.in_waiting == received:
+            return
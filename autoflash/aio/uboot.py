@@ -0,0 +1,114 @@
+import re
+import logging
+import ipaddress
+from . import serial
+from ..interaction import uboot
+from ..interaction.uboot import RAMBOOT_SETTLE_TIME
+from ..interaction.expect import Dialogue, Rule
+from ..log import debug_logging_enabled
+
+
+async def run_dialogue(
+    aser: serial.AsyncSerial, dialogue: Dialogue, variables: dict = None
+) -> Rule:
+    """Async version of `interaction.expect.Dialogue.run`"""
+    for _ in range(dialogue.max_turns):
+        match = await serial.next_match(aser, dialogue.regex, dialogue.timeout)
+        if match is None:
+            serial.log_buffer_as_error(aser)
+            raise Exception(f"Timeout in dialogue '{dialogue.name}'")
+
+        rule = dialogue.rule(match)
+        logging.debug(f"Dialogue '{dialogue.name}': matched '{rule.pattern}'")
+        if rule.mark:
+            aser.console.clear_history()
+            aser.console.mark(rule.mark)
+        if rule.fail:
+            serial.log_buffer_as_error(aser)
+            raise Exception(rule.fail)
+        if rule.done:
+            return rule
+
+        if rule.send is not None:
+            if rule.wait_for_quiet:
+                await serial.wait_for_quiet(aser)
+            aser.write(rule.send.format_map(variables or {}).encode("utf-8"))
+
+    serial.log_buffer_as_error(aser)
+    raise Exception(
+        f"Dialogue '{dialogue.name}' didn't finish in {dialogue.max_turns} turns"
+    )
+
+
+async def ensure_ready(aser: serial.AsyncSerial, password):
+    """Async version of `interaction.uboot.ensure_ready`"""
+    aser.write(b"\n")
+    await run_dialogue(aser, uboot.script().dialogue("login"), {"password": password})
+
+    if debug_logging_enabled():
+        print()
+
+    logging.info("U-Boot ready")
+
+
+async def send_uboot_cmd(aser: serial.AsyncSerial, cmd: str, wait_for_prompt=True):
+    aser.write(f"{cmd}\n".encode("utf-8"))
+    if wait_for_prompt:
+        await serial.wait_for_prompt_match(aser, uboot.script().prompt)
+
+
+async def send_uboot_cmds(aser: serial.AsyncSerial, cmds: list[str]):
+    """See `interaction.uboot.send_uboot_cmds`"""
+    for line in uboot.script().batch(cmds):
+        await send_uboot_cmd(aser, line)
+
+
+async def configure_ramboot(
+    aser: serial.AsyncSerial,
+    tftp_ip: ipaddress.IPv4Address,
+    ap_ip: ipaddress.IPv4Address,
+    filename: str,
+):
+    logging.info(
+        f"Configuring ramboot with TFTP server '{tftp_ip}', AP IP '{ap_ip}', filename '{filename}'"
+    )
+    await send_uboot_cmd(aser, "")
+    await serial.wait_for_quiet(aser, timeout=1)
+    await send_uboot_cmd(aser, "")
+    await send_uboot_cmds(
+        aser,
+        [
+            f"setenv serverip {tftp_ip}",
+            f"setenv ipaddr {ap_ip}",
+            f"setenv rambootfile {filename}",
+        ],
+    )
+
+
+async def wait_for_link(aser: serial.AsyncSerial, settle_time=RAMBOOT_SETTLE_TIME):
+    """See `interaction.uboot.wait_for_link`"""
+    link_up = uboot.script().pattern("link_up")
+    if aser.console.history_contains(link_up):
+        return
+
+    since_boot = aser.console.seconds_since("uboot_started")
+    remaining = settle_time - (since_boot or 0)
+    if remaining > 0:
+        logging.info(f"Waiting up to {remaining:.1f}s for the LAN link")
+        await serial.read_until_match(aser, link_up, remaining)
+
+
+async def run_ramboot(aser: serial.AsyncSerial, settle_time=RAMBOOT_SETTLE_TIME):
+    logging.info("Starting ramboot")
+    await wait_for_link(aser, settle_time)
+    await send_uboot_cmd(aser, "run ramboot", wait_for_prompt=False)
+
+    result = await serial.wait_for_prompt_match(
+        aser, uboot.prompts_ramboot(), timeout=50
+    )
+
+    if re.match(uboot.script().pattern("ramboot_failed"), result):
+        serial.log_buffer_as_error(aser)
+        raise Exception("Ramboot failed. Is TFTP server started?")
+
+    logging.info("Ramboot successfully started")
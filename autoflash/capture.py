@@ -0,0 +1,278 @@
+"""
+Recording and replay of serial sessions.
+
+Everything read from and written to an AP's serial port is recorded with
+timestamps to a gzip compressed file per AP. Records are handed to a
+background thread, so the read loops never wait for compression or the
+disk. A recorded session can be fed back into the `interaction` functions
+with `ReplaySerial`, at the original or an accelerated speed, eg. to
+reproduce a failure from the field or to benchmark matcher changes
+against real boot logs.
+
+File format: a sequence of records, each a little-endian header of the
+seconds since the session started (double), the kind (`READ`, `WRITE` or
+`BAUDRATE`) and the length of the data (uint32), followed by the data.
+"""
+
+import re
+import gzip
+import time
+import queue
+import struct
+import logging
+import threading
+import contextlib
+from pathlib import Path
+import serial
+from .parallel import port_name
+
+SESSION_SUFFIX = ".session.gz"
+
+READ = b"r"
+WRITE = b"w"
+# The data is the new baud rate in ASCII
+BAUDRATE = b"b"
+
+_HEADER = struct.Struct("<dcI")
+
+
+def session_path(capture_dir: Path, port: str) -> Path:
+    timestamp = time.strftime("%Y%m%d-%H%M%S")
+    return Path(capture_dir) / f"{port_name(port)}-{timestamp}{SESSION_SUFFIX}"
+
+
+class SessionRecorder:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = gzip.open(self.path, "wb")
+        self._start = time.monotonic()
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(
+            target=self._run, name=f"capture-{self.path.name}", daemon=True
+        )
+        self._thread.start()
+
+    def record(self, kind: bytes, data: bytes):
+        self._queue.put((time.monotonic() - self._start, kind, bytes(data)))
+
+    def _run(self):
+        while True:
+            records = [self._queue.get()]
+            # Write everything that piled up in one go
+            while not self._queue.empty():
+                records.append(self._queue.get_nowait())
+
+            chunk = bytearray()
+            for record in records:
+                if record is None:
+                    self._file.write(chunk)
+                    self._file.close()
+                    return
+                t, kind, data = record
+                chunk += _HEADER.pack(t, kind, len(data))
+                chunk += data
+            self._file.write(chunk)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        logging.info(f"Serial session recorded to {self.path}")
+
+
+class CapturingSerial:
+    """
+    Wraps a `serial.Serial` and records its traffic while a session is
+    started. Use it in place of the wrapped port.
+    """
+
+    def __init__(self, ser):
+        self.ser = ser
+        self.recorder = None
+
+    def start_session(self, path: Path):
+        self.stop_session()
+        self.recorder = SessionRecorder(path)
+        self.recorder.record(BAUDRATE, str(self.ser.baudrate).encode("ascii"))
+
+    def stop_session(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def read(self, size=1) -> bytes:
+        data = self.ser.read(size)
+        if data and self.recorder is not None:
+            self.recorder.record(READ, data)
+        return data
+
+    def write(self, data: bytes):
+        if self.recorder is not None:
+            self.recorder.record(WRITE, data)
+        return self.ser.write(data)
+
+    @property
+    def baudrate(self):
+        return self.ser.baudrate
+
+    @baudrate.setter
+    def baudrate(self, baudrate):
+        if self.recorder is not None:
+            self.recorder.record(BAUDRATE, str(baudrate).encode("ascii"))
+        self.ser.baudrate = baudrate
+
+    def close(self):
+        self.stop_session()
+        self.ser.close()
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+@contextlib.contextmanager
+def capturing(ser, capture_dir: Path = None):
+    """Records the session on `ser` to a new file in `capture_dir`, yields the port to use"""
+    if capture_dir is None:
+        yield ser
+        return
+
+    capturing_ser = CapturingSerial(ser)
+    capturing_ser.start_session(session_path(capture_dir, ser.port))
+    try:
+        yield capturing_ser
+    finally:
+        capturing_ser.stop_session()
+
+
+def read_session(path: Path):
+    """Yields the `(seconds, kind, data)` records of a recorded session"""
+    with gzip.open(path, "rb") as f:
+        while header := f.read(_HEADER.size):
+            if len(header) < _HEADER.size:
+                logging.warning(f"{path} is truncated")
+                return
+            t, kind, length = _HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                logging.warning(f"{path} is truncated")
+                return
+            yield t, kind, data
+
+
+class ReplaySerial:
+    """
+    Plays back what was read in a recorded session, in place of a
+    `serial.Serial`. Output becomes available in the recorded chunks at the
+    recorded times divided by `speed` (0 for no delays), starting at the
+    first access. Output that followed something sent to the AP is only
+    handed out once as many writes happened during the replay, so the
+    replayed dialogue stays in step even when accelerated. Writes are
+    otherwise ignored and collected in `written`. Reading past the end of
+    the session raises a `serial.SerialException`.
+    """
+
+    def __init__(self, path: Path, speed=1.0, timeout=1):
+        self.port = Path(path).name
+        self.speed = speed
+        self.timeout = timeout
+        self.baudrate = None
+        self.written = bytearray()
+        self._writes = 0
+
+        # (seconds, number of writes before, data) of every read, last one first
+        self._reads = []
+        self._recorded_writes = []
+        for t, kind, data in read_session(path):
+            if kind == READ:
+                self._reads.append((t, len(self._recorded_writes), data))
+            elif kind == WRITE:
+                self._recorded_writes.append(data)
+            elif kind == BAUDRATE and self.baudrate is None:
+                self.baudrate = int(data)
+        self._reads.reverse()
+        self._buffer = bytearray()
+        self._start = None
+
+    def _elapsed(self):
+        if self._start is None:
+            self._start = time.monotonic()
+        elapsed = time.monotonic() - self._start
+        return elapsed * self.speed if self.speed else float("inf")
+
+    def _receive(self):
+        # Chunks are handed out one at a time, as they were read, so a prompt
+        # is never followed by the answer to something not even sent yet
+        if not self._buffer and self._reads:
+            t, writes, data = self._reads[-1]
+            if writes <= self._writes and t <= self._elapsed():
+                self._buffer += data
+                self._reads.pop()
+
+    def skip_to_write(self, pattern: bytes, missing_ok=False):
+        """
+        Acts as if everything up to the next recorded write that matches
+        `pattern` was sent, for parts of the dialogue that are not replayed
+        or that were sent in more writes when the session was recorded
+        """
+        regex = re.compile(pattern)
+        for i in range(self._writes, len(self._recorded_writes)):
+            if regex.search(self._recorded_writes[i]):
+                self._writes = i + 1
+                return
+        if not missing_ok:
+            raise serial.SerialException(f"{pattern} was never sent in {self.port}")
+
+    def inWaiting(self) -> int:
+        self._receive()
+        return len(self._buffer)
+
+    @property
+    def in_waiting(self) -> int:
+        return self.inWaiting()
+
+    def read(self, size=1) -> bytes:
+        deadline = time.monotonic() + (self.timeout or 0)
+        while True:
+            self._receive()
+            if self._buffer:
+                data = bytes(self._buffer[:size])
+                del self._buffer[:size]
+                return data
+            if not self._reads:
+                raise serial.SerialException(f"End of recorded session {self.port}")
+
+            now = time.monotonic()
+            if now >= deadline:
+                return b""
+            t, writes, _ = self._reads[-1]
+            if writes > self._writes:
+                # Nothing can be written while we wait
+                time.sleep(deadline - now)
+            else:
+                # The chunk might have become due since `_receive`
+                time.sleep(
+                    max(0, min((t - self._elapsed()) / self.speed, deadline - now))
+                )
+
+    def write(self, data: bytes) -> int:
+        self._writes += 1
+        self.written += data
+        return len(data)
+
+    def reset_input_buffer(self):
+        self._buffer.clear()
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,170 @@
+"""
+States of `flash_ap` and the checkpoints to resume from.
+
+Flashing an AP goes through the `STATES` in order. The last state reached
+is saved per port, in `<state_dir>/<port>.json` if a state directory is
+set, so it survives a restart. When `flash_ap` attaches to an AP, or after
+a step failed, the console is probed first (U-Boot, the ramboot image or
+installed firmware) and the AP's actual state is combined with the
+checkpoint, so only the missing steps are run: eg. a failed scp is retried
+on the running ramboot image instead of rambooting the AP again.
+"""
+
+import os
+import re
+import json
+import time
+import logging
+import tempfile
+import threading
+from pathlib import Path
+import autoflash.interaction.serial as serial
+import autoflash.interaction.uboot as uboot
+import autoflash.interaction.openwrt as openwrt
+from .parallel import port_name
+
+# Waiting in U-Boot, or not known yet
+UBOOT = "uboot"
+# The ramboot image is booting or running
+RAMBOOTED = "rambooted"
+# The ramboot image's LAN is up, with the AP's IP
+LAN_READY = "lan_ready"
+# The sysupgrade image is in /tmp on the AP
+TRANSFERRED = "transferred"
+# sysupgrade was started
+SYSUPGRADE = "sysupgrade"
+DONE = "done"
+STATES = (UBOOT, RAMBOOTED, LAN_READY, TRANSFERRED, SYSUPGRADE, DONE)
+
+# Attempts of the step leaving each state, and seconds to wait before retrying
+RETRIES = {
+    UBOOT: (3, 0),
+    RAMBOOTED: (2, 0),
+    LAN_READY: (3, 5),
+    TRANSFERRED: (2, 0),
+    SYSUPGRADE: (1, 0),
+}
+
+# What answers on the console
+CONSOLE_UBOOT = "uboot"
+CONSOLE_RAMBOOT = "ramboot"
+CONSOLE_INSTALLED = "installed"
+
+PROMPTS_SHELL = f"{openwrt.PROMPT_CONSOLE_ACTIVATE}|{openwrt.PROMPT_OPENWRT_SHELL}"
+# Seconds to wait for an answer when probing the console
+PROBE_TIMEOUT = 3
+
+
+def _earliest(*states):
+    return min(states, key=STATES.index)
+
+
+class CheckpointStore:
+    """The last state reached per port, kept in `state_dir` if it is set"""
+
+    def __init__(self, state_dir: Path = None):
+        self.state_dir = Path(state_dir) if state_dir else None
+        self._checkpoints = {}
+        self._lock = threading.Lock()
+        if self.state_dir:
+            self.state_dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, port) -> Path:
+        return self.state_dir / f"{port_name(port)}.json"
+
+    def load(self, port) -> dict:
+        with self._lock:
+            if port in self._checkpoints or not self.state_dir:
+                return self._checkpoints.get(port)
+            try:
+                return json.loads(self._path(port).read_text())
+            except FileNotFoundError:
+                return None
+            except ValueError:
+                logging.warning(f"Ignoring corrupt checkpoint {self._path(port)}")
+                return None
+
+    def save(self, port, state, image, ap_ip):
+        checkpoint = dict(state=state, image=str(image), ap_ip=str(ap_ip))
+        checkpoint["time"] = time.time()
+        with self._lock:
+            self._checkpoints[port] = checkpoint
+            if self.state_dir:
+                fd, tmp_path = tempfile.mkstemp(dir=self.state_dir, suffix=".tmp")
+                with os.fdopen(fd, "w") as f:
+                    json.dump(checkpoint, f)
+                os.replace(tmp_path, self._path(port))
+        logging.debug(f"Checkpoint: {state}")
+
+
+def probe_console(ser, timeout=PROBE_TIMEOUT):
+    """
+    Finds out what answers on the console. Returns one of the `CONSOLE_*`
+    values, or None if nothing does, and U-Boot's prompt if it was read.
+    """
+    # Any prompt of the U-Boot login, as the script might be another model's
+    uboot_prompts = uboot.script().dialogue("login").regex
+    ser.write(b"\n")
+    m = serial.read_until_match(
+        ser, f"{uboot_prompts.pattern}|{PROMPTS_SHELL}", timeout
+    )
+    if m is None:
+        return None, None
+    if uboot_prompts.fullmatch(m):
+        return CONSOLE_UBOOT, m
+
+    if re.match(openwrt.PROMPT_CONSOLE_ACTIVATE, m):
+        ser.write(b"\n")
+        if serial.read_until_match(ser, openwrt.PROMPT_OPENWRT_SHELL, timeout) is None:
+            return None, None
+    return (CONSOLE_RAMBOOT if openwrt.is_ramboot(ser) else CONSOLE_INSTALLED), None
+
+
+def resume_state(ser, checkpoint: dict, image, ap_ip, image_sha256=None):
+    """
+    Probes the console and returns the state to continue from, according to
+    the AP and the `checkpoint` of the last run on this port, and U-Boot's
+    prompt if it was read. With `image_sha256`, installed firmware that is
+    marked with that digest is done already, see `openwrt.write_image_marker`.
+    """
+    saved = checkpoint["state"] if checkpoint else UBOOT
+    if saved == DONE:
+        # The AP of that checkpoint is finished, this is the next one
+        saved = UBOOT
+    if checkpoint and checkpoint["image"] != str(image):
+        # Another image, only what was done to the AP itself still counts
+        saved = _earliest(saved, LAN_READY)
+    if checkpoint and checkpoint["ap_ip"] != str(ap_ip):
+        saved = _earliest(saved, RAMBOOTED)
+
+    console, prompt = probe_console(ser)
+    if console == CONSOLE_UBOOT:
+        state = UBOOT
+    elif console == CONSOLE_RAMBOOT:
+        state = saved if saved in (LAN_READY, TRANSFERRED) else RAMBOOTED
+        if saved == SYSUPGRADE:
+            # sysupgrade would have rebooted the AP
+            state = TRANSFERRED
+    elif console == CONSOLE_INSTALLED:
+        if saved == SYSUPGRADE:
+            state = DONE
+        elif image_sha256 and openwrt.installed_image(ser) == image_sha256:
+            logging.info("The AP already runs the image, skipping it")
+            state = DONE
+        else:
+            # Some other firmware, start over from U-Boot
+            openwrt.reboot(ser)
+            state = UBOOT
+    elif saved in (RAMBOOTED, LAN_READY, TRANSFERRED):
+        # Probably still booting the ramboot image
+        state = RAMBOOTED
+    elif saved == SYSUPGRADE:
+        # sysupgrade closes the shell while it writes the flash
+        state = SYSUPGRADE
+    else:
+        state = UBOOT
+
+    logging.info(
+        f"Console: {console or 'no answer'}, checkpoint: {saved}, continuing at {state}"
+    )
+    return state, prompt
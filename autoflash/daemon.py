@@ -0,0 +1,156 @@
+"""
+Flashing station: keeps the serial ports open and flashes every AP that is
+powered on, one after the other, without restarting autoflash in between.
+
+The state of every port is reported in `<status_dir>/<port>` as a single
+line starting with one of the `STATES`, and optionally by running a status
+command with the port name and the state as arguments, eg. to drive LEDs.
+"""
+
+import os
+import time
+import shlex
+import logging
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+import serial
+import autoflash.interaction.uboot as uboot
+import autoflash.capture as capture
+from . import log
+from .parallel import port_name, format_duration, _add_log_files, _remove_log_files
+
+WAITING = "waiting"
+FLASHING = "flashing"
+DONE = "done"
+FAILED = "failed"
+ERROR = "error"
+STATES = (WAITING, FLASHING, DONE, FAILED, ERROR)
+
+# Seconds between attempts to reopen a serial port that failed, eg. an unplugged adapter
+REOPEN_DELAY = 2
+
+
+class StatusReporter:
+    def __init__(self, status_dir: Path = None, status_command: str = None):
+        self.status_dir = status_dir
+        self.status_command = shlex.split(status_command) if status_command else None
+        if status_dir:
+            status_dir.mkdir(parents=True, exist_ok=True)
+
+    def set(self, port: str, state: str, detail=""):
+        name = port_name(port)
+        line = f"{state} {detail}".strip()
+        logging.info(f"Status: {line}")
+
+        if self.status_dir:
+            fd, tmp_path = tempfile.mkstemp(dir=self.status_dir, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                f.write(line + "\n")
+            os.replace(tmp_path, self.status_dir / name)
+
+        if self.status_command:
+            try:
+                subprocess.Popen([*self.status_command, name, state])
+            except OSError as e:
+                logging.warning(f"Status command failed: {e}")
+
+
+def _flash_loop(
+    ser, flash, status: StatusReporter, stop: threading.Event, capture_dir=None
+):
+    counts = {DONE: 0, FAILED: 0}
+    # A failed flash might leave the port at a faster baud rate
+    speed = ser.baudrate
+    status.set(ser.port, WAITING)
+    while True:
+        prompt = uboot.wait_for_power_on(ser, stop)
+        if prompt is None:
+            break
+
+        status.set(ser.port, FLASHING)
+        start = time.monotonic()
+        if capture_dir:
+            ser.start_session(capture.session_path(capture_dir, ser.port))
+        try:
+            detail = flash(ser, prompt)
+        except serial.SerialException:
+            raise
+        except Exception as e:
+            logging.exception("Flashing failed")
+            counts[FAILED] += 1
+            status.set(ser.port, FAILED, str(e) or type(e).__name__)
+        else:
+            counts[DONE] += 1
+            status.set(ser.port, DONE, detail or "")
+        finally:
+            ser.baudrate = speed
+            if capture_dir:
+                ser.stop_session()
+
+        logging.info(
+            f"Took {format_duration(time.monotonic() - start)}, "
+            f"{counts[DONE]} AP(s) flashed and {counts[FAILED]} failed on this port, "
+            "waiting for the next AP"
+        )
+
+
+def _serve_port(
+    port, speed, flash, status: StatusReporter, stop: threading.Event, capture_dir
+):
+    log.set_port(port_name(port))
+    while not stop.is_set():
+        try:
+            with serial.Serial(port, speed, timeout=1) as ser:
+                if capture_dir:
+                    # Every AP's session is recorded from the moment it powered on
+                    ser = capture.CapturingSerial(ser)
+                _flash_loop(ser, flash, status, stop, capture_dir)
+        except serial.SerialException as e:
+            logging.error(f"Serial port failed: {e}, reopening in {REOPEN_DELAY}s")
+            status.set(port, ERROR, str(e))
+            stop.wait(REOPEN_DELAY)
+
+
+def run_daemon(
+    ports: list[str],
+    speed,
+    flash,
+    status: StatusReporter,
+    log_dir: Path = None,
+    capture_dir: Path = None,
+):
+    """
+    Serves `ports` until Ctrl-C is pressed. `flash(ser, prompt)` is called for
+    every AP that is powered on, with the open port and the U-Boot prompt that
+    has to be passed to `uboot.ensure_ready`. With `capture_dir`, the serial
+    session of every AP is recorded to a new file in it.
+    """
+    stop = threading.Event()
+    handlers = _add_log_files(ports, log_dir)
+
+    threads = [
+        threading.Thread(
+            target=_serve_port,
+            name=port_name(port),
+            args=(port, speed, flash, status, stop, capture_dir),
+            daemon=True,
+        )
+        for port in ports
+    ]
+    for thread in threads:
+        thread.start()
+    logging.info(f"Waiting for APs on {', '.join(ports)}, press Ctrl-C to stop")
+
+    try:
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(0.5)
+    except KeyboardInterrupt:
+        logging.info("Stopping after the running flashes, press Ctrl-C again to abort")
+        stop.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        _remove_log_files(handlers)
@@ -0,0 +1,102 @@
+"""
+SHA-256 digests of sysupgrade images, computed once per version of a file.
+
+A digest is keyed by the file's resolved path, size and mtime, so a file
+that was replaced or modified is hashed again. Digests are kept in memory
+and, with a database, across runs: the image pool keeps them next to its
+index in `.image-pool.sqlite`, see `imagepool.ImagePool.sha256`. The
+digests are checked on the AP before sysupgrade, so a transfer that went
+wrong is repeated instead of flashed, see `openwrt.verify_sysupgrade`.
+"""
+
+import hashlib
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+
+
+def sha256_file(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DigestCache:
+    def __init__(self, db_path: Path = None):
+        self._lock = threading.Lock()
+        self._memory = {}
+        self._con = None
+        if db_path is None:
+            return
+
+        self._con = sqlite3.connect(
+            db_path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        # Might be in the images directory, see `ImagePool`
+        self._con.execute("PRAGMA journal_mode=PERSIST")
+        self._con.execute("""
+            CREATE TABLE IF NOT EXISTS digests (
+                path TEXT PRIMARY KEY NOT NULL,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                sha256 TEXT NOT NULL
+            )
+        """)
+
+    def _stored(self, key: tuple) -> str:
+        if key in self._memory or self._con is None:
+            return self._memory.get(key)
+
+        row = self._con.execute(
+            "SELECT sha256 FROM digests WHERE path = ? AND size = ? AND mtime = ?",
+            key,
+        ).fetchone()
+        if row:
+            self._memory[key] = row[0]
+        return row and row[0]
+
+    def sha256(self, path) -> str:
+        """Returns the digest of the file at `path`, hashing it only if it changed"""
+        path = Path(path).resolve()
+        stat = path.stat()
+        key = (str(path), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            sha256 = self._stored(key)
+        if sha256:
+            return sha256
+
+        # Outside the lock, other ports might need other images meanwhile
+        logging.info(f"Computing SHA-256 of {path}")
+        sha256 = sha256_file(path)
+        with self._lock:
+            self._memory[key] = sha256
+            if self._con is not None:
+                self._con.execute(
+                    "INSERT OR REPLACE INTO digests (path, size, mtime, sha256) "
+                    "VALUES (?, ?, ?, ?)",
+                    (*key, sha256),
+                )
+        return sha256
+
+    def forget(self, path):
+        """Drops the digest of a deleted file"""
+        path = str(Path(path).resolve())
+        with self._lock:
+            self._memory = {k: v for k, v in self._memory.items() if k[0] != path}
+            if self._con is not None:
+                self._con.execute("DELETE FROM digests WHERE path = ?", (path,))
+
+    def close(self):
+        if self._con is not None:
+            self._con.close()
+
+
+# For images that aren't in a pool, eg. the one image of `autoflash.py`
+_cache = DigestCache()
+
+
+def sha256(path) -> str:
+    return _cache.sha256(path)
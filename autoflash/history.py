@@ -0,0 +1,159 @@
+"""
+Flash history: durations of the flash phases, used to tell a hung AP early.
+
+The duration of every successful phase is kept in the database set with
+`configure`, together with the longest time the AP didn't send anything
+during the phase, per AP model and port. Once a phase was seen
+`MIN_SAMPLES` times for the model, its bounds are derived from the recent
+samples: the `PERCENTILE` of the durations and of the silences, times
+`MARGIN` plus `SLACK`. A phase that runs longer, or an AP that stays
+silent longer, fails right away, instead of when the phase's hard-coded
+timeouts run out, see `serial.Watchdog`. The failed step is then retried
+like any other.
+
+Ports whose phases take much longer than on the other ports are reported,
+they often have a flaky serial adapter or cable.
+"""
+
+import time
+import sqlite3
+import logging
+import threading
+import contextlib
+from .interaction import serial
+
+# Samples of a phase needed before it is bounded
+MIN_SAMPLES = 20
+# Most recent samples the bounds are derived from
+WINDOW = 200
+PERCENTILE = 0.99
+MARGIN = 1.5
+# Seconds added to every bound, for phases that are short but vary
+SLACK = 10
+# A port is reported if its median of a phase is this much above the model's
+SLOW_PORT_FACTOR = 1.5
+# Phases that span several others and their retries
+UNBOUNDED_PHASES = {"total"}
+
+_lock = threading.RLock()
+_db_path = None
+_model = "default"
+_con = None
+# (port, phase) already reported as slow
+_reported = set()
+
+
+def configure(db_path=None, model: str = None):
+    """Enables the history in `db_path`, kept separately for every AP `model`"""
+    global _db_path, _model, _con
+    with _lock:
+        if _con is not None:
+            _con.close()
+            _con = None
+        _db_path = str(db_path) if db_path is not None else None
+        if model:
+            _model = model
+
+
+def enabled() -> bool:
+    return _db_path is not None
+
+
+def _connection() -> sqlite3.Connection:
+    global _con
+    if _con is None:
+        # Shared by all ports flashing in parallel, every statement commits on its own
+        _con = sqlite3.connect(
+            _db_path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        _con.executescript("""
+            CREATE TABLE IF NOT EXISTS phases (
+                model TEXT NOT NULL,
+                port TEXT NOT NULL,
+                phase TEXT NOT NULL,
+                duration REAL NOT NULL,
+                silence REAL NOT NULL,
+                finished_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS phases_recent ON phases (model, phase, finished_at);
+        """)
+    return _con
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """Nearest-rank percentile of `values`"""
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(fraction * len(values)) - 1))]
+
+
+def _recent(phase: str, port: str = None) -> list[tuple[float, float]]:
+    query = "SELECT duration, silence FROM phases WHERE model = ? AND phase = ?"
+    params = [_model, phase]
+    if port is not None:
+        query += " AND port = ?"
+        params.append(port)
+    query += " ORDER BY finished_at DESC LIMIT ?"
+    with _lock:
+        return _connection().execute(query, (*params, WINDOW)).fetchall()
+
+
+def bounds(phase: str) -> tuple[float, float]:
+    """
+    Returns the longest duration of `phase` and silence during it that are
+    still normal, or None for both if the phase wasn't seen often enough
+    """
+    samples = _recent(phase)
+    if len(samples) < MIN_SAMPLES:
+        return None, None
+
+    durations, silences = zip(*samples)
+    return (
+        percentile(durations, PERCENTILE) * MARGIN + SLACK,
+        percentile(silences, PERCENTILE) * MARGIN + SLACK,
+    )
+
+
+def record(port: str, phase: str, duration: float, silence: float):
+    with _lock:
+        _connection().execute(
+            "INSERT INTO phases (model, port, phase, duration, silence, finished_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (_model, port, phase, duration, silence, time.time()),
+        )
+    _check_port(port, phase)
+
+
+def _check_port(port: str, phase: str):
+    if (port, phase) in _reported:
+        return
+
+    own = [duration for duration, _ in _recent(phase, port)[:MIN_SAMPLES]]
+    all_ports = [duration for duration, _ in _recent(phase)]
+    if len(own) < MIN_SAMPLES or len(all_ports) < 2 * MIN_SAMPLES:
+        return
+
+    median, model_median = percentile(own, 0.5), percentile(all_ports, 0.5)
+    # Not for a fraction of a second in short phases
+    if median > model_median * SLOW_PORT_FACTOR + 1:
+        _reported.add((port, phase))
+        logging.warning(
+            f"Phase '{phase}' takes {median:.1f}s on {port}, but {model_median:.1f}s "
+            "on all ports (median), check its serial adapter and cable"
+        )
+
+
+@contextlib.contextmanager
+def watched(port: str, phase: str):
+    """
+    Fails waits for the AP's output in the context when `phase` exceeds its
+    bounds, and records the phase if it succeeds
+    """
+    if not enabled() or phase in UNBOUNDED_PHASES:
+        yield
+        return
+
+    bound, stall = bounds(phase)
+    watchdog = serial.Watchdog(phase, bound, stall)
+    with serial.watching(watchdog):
+        yield
+    record(port, phase, watchdog.elapsed(), watchdog.max_silence())
@@ -0,0 +1,252 @@
+"""
+Index of the images of `flash_autoconf`, shared by all ports and processes.
+
+The images directory is scanned only when its mtime changed, ie. when images
+were added or removed by someone else, and the found images are kept in
+`.image-pool.sqlite` in the images directory. Images are handed out with
+`claim`, which runs in a single `BEGIN IMMEDIATE` transaction, so two
+workers never get the same image. Flashed images are deleted with
+`complete`, failed ones are returned to the pool with `release`, and claims
+of crashed workers are returned after `CLAIM_TIMEOUT`, unless the same
+holder (port) claims again before, which gets its image back to resume.
+The digests of the sysupgrade images are cached in the same database, see
+`digests`.
+"""
+
+import time
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+from .digests import DigestCache
+
+DB_NAME = ".image-pool.sqlite"
+# Seconds after which a claimed image is considered abandoned
+CLAIM_TIMEOUT = 3600
+# Consumption rate is measured over this many seconds
+RATE_WINDOW = 3600
+
+FREE = "free"
+CLAIMED = "claimed"
+DONE = "done"
+
+
+class ImagePool:
+    def __init__(self, images_dir: Path):
+        self.images_dir = Path(images_dir)
+        self._lock = threading.Lock()
+        # Shared by all ports flashing in parallel, transactions are explicit
+        self._con = sqlite3.connect(
+            self.images_dir / DB_NAME,
+            timeout=30,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        # The database is in the images directory, so the journal must not be
+        # created and deleted by every transaction, which would change the
+        # directory's mtime and cause a rescan
+        self._con.execute("PRAGMA journal_mode=PERSIST")
+        self._con.executescript("""
+            CREATE TABLE IF NOT EXISTS images (
+                name TEXT PRIMARY KEY NOT NULL,
+                state TEXT NOT NULL,
+                holder TEXT,
+                claimed_at REAL,
+                completed_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS images_state ON images (state, claimed_at);
+            CREATE INDEX IF NOT EXISTS images_completed ON images (completed_at);
+            CREATE TABLE IF NOT EXISTS scans (
+                directory TEXT PRIMARY KEY NOT NULL,
+                mtime INTEGER NOT NULL
+            );
+        """)
+        self.digests = DigestCache(self.images_dir / DB_NAME)
+
+    def metadata_file(self, name: str) -> Path:
+        return self.images_dir / f"{name}.json"
+
+    def sysupgrade_file(self, name: str) -> Path:
+        return self.images_dir / f"{name}.bin"
+
+    def sha256(self, name: str) -> str:
+        """Returns the digest of the image's sysupgrade file, see `digests`"""
+        return self.digests.sha256(self.sysupgrade_file(name))
+
+    def _dir_mtime(self) -> int:
+        return self.images_dir.stat().st_mtime_ns
+
+    def _store_mtime(self, cur):
+        cur.execute(
+            "INSERT OR REPLACE INTO scans (directory, mtime) VALUES (?, ?)",
+            (str(self.images_dir.resolve()), self._dir_mtime()),
+        )
+
+    def _refresh(self, cur):
+        """Rescans the images directory if it changed since the last scan"""
+        row = cur.execute(
+            "SELECT mtime FROM scans WHERE directory = ?",
+            (str(self.images_dir.resolve()),),
+        ).fetchone()
+        if row and row[0] == self._dir_mtime():
+            return
+
+        start = time.monotonic()
+        files = {entry.name for entry in self.images_dir.iterdir()}
+        names = {
+            name[: -len(".json")]
+            for name in files
+            if name.endswith(".json") and f"{name[: -len('.json')]}.bin" in files
+        }
+        # Flashed images might have been added again under the same name
+        cur.executemany(
+            "INSERT INTO images (name, state) VALUES (?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET state = excluded.state WHERE state = ?",
+            ((name, FREE, DONE) for name in names),
+        )
+        # Images that were removed by someone else
+        free = [
+            r[0]
+            for r in cur.execute("SELECT name FROM images WHERE state = ?", (FREE,))
+        ]
+        cur.executemany(
+            "DELETE FROM images WHERE name = ?",
+            ((name,) for name in free if name not in names),
+        )
+        self._store_mtime(cur)
+        logging.info(
+            f"Scanned {self.images_dir}: {len(names)} images in {time.monotonic() - start:.2f}s"
+        )
+
+    def refresh(self):
+        self._transaction(self._refresh)
+
+    def _transaction(self, body):
+        with self._lock:
+            cur = self._con.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                result = body(cur)
+                cur.execute("COMMIT")
+            except BaseException:
+                cur.execute("ROLLBACK")
+                raise
+            return result
+
+    def claim(self, holder="") -> str:
+        """Returns the name of a free image and marks it as claimed by `holder`"""
+
+        def claim(cur):
+            self._refresh(cur)
+            now = time.time()
+
+            abandoned = cur.execute(
+                "UPDATE images SET state = ?, holder = NULL WHERE state = ? AND claimed_at < ?",
+                (FREE, CLAIMED, now - CLAIM_TIMEOUT),
+            ).rowcount
+            if abandoned:
+                logging.warning(f"Returned {abandoned} abandoned image(s) to the pool")
+
+            # An image the holder didn't return, eg. after a crash, might
+            # already be on the AP
+            row = (
+                holder
+                and cur.execute(
+                    "SELECT name FROM images WHERE state = ? AND holder = ? LIMIT 1",
+                    (CLAIMED, holder),
+                ).fetchone()
+            )
+            row = (
+                row
+                or cur.execute(
+                    "SELECT name FROM images WHERE state = ? LIMIT 1", (FREE,)
+                ).fetchone()
+            )
+            if row is None:
+                raise Exception(f"No images left in {self.images_dir}")
+
+            cur.execute(
+                "UPDATE images SET state = ?, holder = ?, claimed_at = ? WHERE name = ?",
+                (CLAIMED, holder, now, row[0]),
+            )
+            return row[0]
+
+        name = self._transaction(claim)
+        logging.info(f"Claimed image {name}")
+        return name
+
+    def complete(self, name: str):
+        """Deletes a flashed image"""
+
+        def complete(cur):
+            self.metadata_file(name).unlink(missing_ok=True)
+            self.sysupgrade_file(name).unlink(missing_ok=True)
+            cur.execute(
+                "UPDATE images SET state = ?, completed_at = ? WHERE name = ?",
+                (DONE, time.time(), name),
+            )
+            # Our own changes to the directory don't need a rescan
+            self._store_mtime(cur)
+
+        self._transaction(complete)
+        self.digests.forget(self.sysupgrade_file(name))
+        self.log_stats()
+
+    def hand_over(self, name: str, holder: str, new_holder: str) -> bool:
+        """
+        Passes a claimed image from `holder` on to `new_holder` and renews the
+        claim. Returns False if `holder` lost the claim, eg. after `CLAIM_TIMEOUT`.
+        """
+        return bool(
+            self._transaction(
+                lambda cur: cur.execute(
+                    "UPDATE images SET holder = ?, claimed_at = ? "
+                    "WHERE name = ? AND state = ? AND holder = ?",
+                    (new_holder, time.time(), name, CLAIMED, holder),
+                ).rowcount
+            )
+        )
+
+    def release(self, name: str):
+        """Returns a claimed image to the pool, eg. after a failed flash"""
+        self._transaction(
+            lambda cur: cur.execute(
+                "UPDATE images SET state = ?, holder = NULL, claimed_at = NULL WHERE name = ?",
+                (FREE, name),
+            )
+        )
+        logging.info(f"Returned image {name} to the pool")
+
+    def stats(self) -> dict:
+        """Returns the number of images per state and the images flashed per hour"""
+        with self._lock:
+            counts = dict(
+                self._con.execute(
+                    "SELECT state, COUNT(*) FROM images GROUP BY state"
+                ).fetchall()
+            )
+            recent = self._con.execute(
+                "SELECT COUNT(*) FROM images WHERE completed_at > ?",
+                (time.time() - RATE_WINDOW,),
+            ).fetchone()[0]
+
+        return {
+            FREE: counts.get(FREE, 0),
+            CLAIMED: counts.get(CLAIMED, 0),
+            DONE: counts.get(DONE, 0),
+            "per_hour": recent * 3600 / RATE_WINDOW,
+        }
+
+    def log_stats(self):
+        stats = self.stats()
+        message = (
+            f"Image pool: {stats[FREE]} free, {stats[CLAIMED]} claimed, "
+            f"{stats['per_hour']:.0f} flashed in the last hour"
+        )
+        if stats["per_hour"]:
+            message += f", empty in {stats[FREE] / stats['per_hour']:.1f}h"
+        logging.info(message)
+
+    def close(self):
+        self.digests.close()
+        self._con.close()
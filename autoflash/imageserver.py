@@ -0,0 +1,94 @@
+"""
+Embedded HTTP server the APs download their sysupgrade images from.
+
+Images are published under a random URL for as long as they are needed,
+so the served directory doesn't have to be known in advance and images
+with the same file name don't collide. Files are sent with `sendfile`.
+"""
+
+import logging
+import secrets
+import threading
+import contextlib
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from . import TFTP_IP
+
+
+class _ImageRequestHandler(BaseHTTPRequestHandler):
+    server_version = "autoflash"
+
+    def _send_headers(self):
+        path = self.server.images.get(self.path)
+        if path is None:
+            self.send_error(404)
+            return None
+
+        f = open(path, "rb")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(path.stat().st_size))
+        self.end_headers()
+        return f
+
+    def do_HEAD(self):
+        f = self._send_headers()
+        if f:
+            f.close()
+
+    def do_GET(self):
+        f = self._send_headers()
+        if not f:
+            return
+
+        with f:
+            self.wfile.flush()
+            sent = self.connection.sendfile(f)
+        logging.info(f"HTTP: sent {sent} bytes of {f.name} to {self.client_address[0]}")
+
+    def log_message(self, format, *args):
+        logging.debug(f"HTTP: {self.client_address[0]} {format % args}")
+
+
+class ImageServer:
+    def __init__(self, host=str(TFTP_IP), port=8080):
+        self.httpd = ThreadingHTTPServer((host, port), _ImageRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.images = {}
+        self.host, self.port = self.httpd.server_address[:2]
+        self._thread = threading.Thread(
+            target=self.httpd.serve_forever, name="http", daemon=True
+        )
+
+    def publish(self, path) -> str:
+        """Makes `path` available for download and returns its URL"""
+        path = Path(path).resolve()
+        url_path = f"/{secrets.token_hex(8)}/{path.name}"
+        self.httpd.images[url_path] = path
+        return f"http://{self.host}:{self.port}{url_path}"
+
+    def unpublish(self, url: str):
+        self.httpd.images.pop(url[url.index("/", len("http://")) :], None)
+
+    @contextlib.contextmanager
+    def published(self, path):
+        url = self.publish(path)
+        try:
+            yield url
+        finally:
+            self.unpublish(url)
+
+    def start(self):
+        logging.info(f"Starting HTTP image server on {self.host}:{self.port}")
+        self._thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,166 @@
+"""
+Declarative dialogues with a device's console.
+
+A dialogue is a list of rules, each a regex the device prints and what to
+do when it does: text to send, formatted with the dialogue's variables (eg.
+`{password}`), a mark to set on the console, and whether the dialogue is
+finished or failed with it. All rules of a dialogue are compiled into a
+single regex with a named group per rule, so every chunk of output is
+searched once, whatever the number of prompts.
+
+A script holds the dialogues of a device model, together with the prompt of
+its boot loader and the other patterns the flashing steps wait for. Scripts
+are nested dicts, eg. loaded from JSON. A script file only needs to contain
+what differs from a base script, see `load_script`:
+
+    {
+        "prompt": "ar7241>",
+        "dialogues": {"login": {"rules": [...]}}
+    }
+"""
+
+import re
+import json
+import logging
+from pathlib import Path
+from dataclasses import dataclass
+import autoflash.interaction.serial as serial
+
+
+@dataclass
+class Rule:
+    pattern: str
+    # Text to send when the pattern matched, formatted with the dialogue's variables
+    send: str = None
+    # The dialogue is finished
+    done: bool = False
+    # The dialogue failed with this message
+    fail: str = None
+    # Forgets the console's history and marks the console with this name,
+    # eg. "uboot_started" when the AP booted
+    mark: str = None
+    # Don't send while the device is still printing
+    wait_for_quiet: bool = True
+
+
+class Dialogue:
+    def __init__(self, name: str, rules: list, timeout=60, max_turns=10):
+        self.name = name
+        try:
+            self.rules = [Rule(**rule) for rule in rules]
+        except TypeError as e:
+            raise Exception(f"Invalid rule in dialogue '{name}': {e}")
+        # Seconds to wait for each prompt
+        self.timeout = timeout
+        self.max_turns = max_turns
+        self.regex = re.compile(
+            "|".join(f"(?P<_r{i}>{rule.pattern})" for i, rule in enumerate(self.rules))
+        )
+
+    def rule(self, match: re.Match) -> Rule:
+        """The rule that matched, for a match of `regex`"""
+        # The rule's group encloses any groups of its pattern, so it is the last one closed
+        return self.rules[int(match.lastgroup[len("_r") :])]
+
+    def run(self, ser, variables: dict = None, prompt: str = None) -> Rule:
+        """
+        Answers the device's prompts until a `done` rule matches, and returns
+        that rule. If the first prompt was already read, it is passed as `prompt`.
+        """
+        matcher = serial.PromptMatcher(self.regex)
+        for _ in range(self.max_turns):
+            if prompt is not None:
+                match = self.regex.search(prompt)
+                prompt = None
+            else:
+                match = serial.next_match(ser, matcher, self.timeout)
+            if match is None:
+                serial.log_buffer_as_error(ser)
+                raise Exception(f"Timeout in dialogue '{self.name}'")
+
+            rule = self.rule(match)
+            logging.debug(f"Dialogue '{self.name}': matched '{rule.pattern}'")
+            if rule.mark:
+                console = serial.get_console(ser)
+                console.clear_history()
+                console.mark(rule.mark)
+            if rule.fail:
+                serial.log_buffer_as_error(ser)
+                raise Exception(rule.fail)
+            if rule.done:
+                return rule
+
+            if rule.send is not None:
+                if rule.wait_for_quiet:
+                    serial.wait_for_quiet(ser)
+                ser.write(rule.send.format_map(variables or {}).encode("utf-8"))
+
+        serial.log_buffer_as_error(ser)
+        raise Exception(
+            f"Dialogue '{self.name}' didn't finish in {self.max_turns} turns"
+        )
+
+
+def batch(commands: list[str], separator: str, max_line_length: int) -> list[str]:
+    """
+    Joins `commands` with `separator` into as few lines as possible that
+    are at most `max_line_length` long, or one line per command without a separator
+    """
+    if not separator:
+        return list(commands)
+
+    lines = []
+    for command in commands:
+        if lines and len(lines[-1]) + len(separator) + len(command) <= max_line_length:
+            lines[-1] += separator + command
+        else:
+            lines.append(command)
+    return lines
+
+
+class Script:
+    def __init__(self, definition: dict):
+        self.definition = definition
+        self.prompt = definition["prompt"]
+        self.separator = definition.get("separator")
+        self.max_line_length = definition.get("max_line_length", 256)
+        self.patterns = dict(definition.get("patterns", {}))
+        self.dialogues = {
+            name: Dialogue(name, **dialogue)
+            for name, dialogue in definition.get("dialogues", {}).items()
+        }
+
+    def dialogue(self, name: str) -> Dialogue:
+        if name not in self.dialogues:
+            raise Exception(f"The script has no dialogue '{name}'")
+        return self.dialogues[name]
+
+    def pattern(self, name: str) -> str:
+        if name not in self.patterns:
+            raise Exception(f"The script has no pattern '{name}'")
+        return self.patterns[name]
+
+    def batch(self, commands: list[str]) -> list[str]:
+        return batch(commands, self.separator, self.max_line_length)
+
+
+def _merge(base: dict, override: dict) -> dict:
+    merged = dict(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            merged[key] = _merge(base[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def load_script(path: Path, base: dict = None) -> Script:
+    """
+    Loads a JSON script. Its values override those of `base`: dicts are
+    merged key by key, everything else, like a dialogue's rules, is replaced.
+    """
+    try:
+        definition = json.loads(Path(path).read_text())
+    except ValueError as e:
+        raise Exception(f"Invalid script {path}: {e}")
+    return Script(_merge(base or {}, definition))
@@ -1,65 +1,208 @@
 import re
 import os
-import sys
 import time
 import logging
 import ipaddress
 import subprocess
 from . import serial
+from .uboot import PROMPT_STOP_AUTOBOOT
 from .. import network
 from ..log import debug_logging_enabled
 
 PROMPT_OPENWRT_SHELL = r"root@\S+:\S+#"
 PROMPT_SYSUPGRADE_COMPLETE = r"Rebooting system..."
+PROMPT_CONSOLE_ACTIVATE = r"Please press Enter to activate this console"
+PROMPT_LAN_FORWARDING = r"br-lan: port \d+\(\S+\) entered forwarding state"
 
+PROMPTS_SHELL_READY = re.compile(f"{PROMPT_CONSOLE_ACTIVATE}|{PROMPT_OPENWRT_SHELL}")
+# In case "Rebooting system..." is not printed, the kernel's restart message
+# or U-Boot's banner prove the reboot, too.
+PROMPTS_SYSUPGRADE_COMPLETE = re.compile(
+    f"{PROMPT_SYSUPGRADE_COMPLETE}|reboot: Restarting system|{PROMPT_STOP_AUTOBOOT}"
+)
 
-def wait_for_shell_ready(ser):
-    for _ in range(100):
-        ser.write(b"\n")
-        time.sleep(1)
-        read = ser.read(ser.inWaiting()).decode("utf-8", errors="ignore")
-        if debug_logging_enabled() and read != "\n":
-            print(read, end="")
-            sys.stdout.flush()
-        if re.search(PROMPT_OPENWRT_SHELL, read):
+# Seconds between pressing Enter while waiting for the shell
+SHELL_PROBE_INTERVAL = 10
+# Fallback if the kernel doesn't log that br-lan is forwarding
+LAN_SETTLE_TIME = 5
+
+# The markers are split in the command line, so the shell's echo of the
+# command itself doesn't match.
+DOWNLOAD_OK = "AUTOFLASH_DOWNLOAD_OK"
+DOWNLOAD_FAILED = "AUTOFLASH_DOWNLOAD_FAILED"
+PROMPTS_DOWNLOAD = re.compile(f"{DOWNLOAD_OK}|{DOWNLOAD_FAILED}")
+CHECKSUM_OK = "AUTOFLASH_CHECKSUM_OK"
+CHECKSUM_FAILED = "AUTOFLASH_CHECKSUM_FAILED"
+PROMPTS_CHECKSUM = re.compile(f"{CHECKSUM_OK}|{CHECKSUM_FAILED}")
+# Only the installed firmware mounts an overlay, ramboot runs from an initramfs
+FIRMWARE_INSTALLED = "AUTOFLASH_INSTALLED"
+FIRMWARE_RAMBOOT = "AUTOFLASH_RAMBOOT"
+PROMPTS_FIRMWARE = re.compile(f"{FIRMWARE_INSTALLED}|{FIRMWARE_RAMBOOT}")
+
+# Digest of the sysupgrade image the installed firmware was flashed with,
+# written after sysupgrade. sysupgrade -n drops it with the rest of the config.
+IMAGE_MARKER_FILE = "/etc/autoflash-image"
+IMAGE_MARKED = "AUTOFLASH_MARKED"
+# Followed by the image marker, or "none", and the firmware's release
+FIRMWARE_INFO = "AUTOFLASH_FIRMWARE"
+PROMPT_FIRMWARE_INFO = re.compile(rf"{FIRMWARE_INFO}=(\S+) ?(.*?)\r?\n")
+
+
+def _echo_marker(marker: str) -> str:
+    return f'echo "{marker[:9]}""{marker[9:]}"'
+
+
+def wait_for_shell_ready(ser, timeout=100):
+    """
+    Waits for procd to ask for Enter to activate the console. In case that
+    message was missed (eg. the shell is already active), Enter is also pressed
+    every `SHELL_PROBE_INTERVAL` seconds.
+    """
+    deadline = time.monotonic() + timeout
+    ser.write(b"\n")
+    while (remaining := deadline - time.monotonic()) > 0:
+        m = serial.read_until_match(
+            ser, PROMPTS_SHELL_READY, min(SHELL_PROBE_INTERVAL, remaining)
+        )
+        if m is not None and re.match(PROMPT_OPENWRT_SHELL, m):
             if debug_logging_enabled():
                 print()
 
             logging.info("OpenWRT shell ready")
             return
+        ser.write(b"\n")
 
+    serial.log_buffer_as_error(ser)
     raise Exception("Timeout waiting for OpenWrt shell ready")
 
 
-def wait_for_lan_ready(ser):
+def is_ramboot(ser) -> bool:
+    """Tells the ramboot image from installed firmware, at the shell prompt"""
+    installed = _echo_marker(FIRMWARE_INSTALLED)
+    ramboot = _echo_marker(FIRMWARE_RAMBOOT)
+    command = f'grep -q " /overlay " /proc/mounts && {installed} || {ramboot}\n'
+    ser.write(command.encode("utf-8"))
+    m = serial.wait_for_prompt_match(ser, PROMPTS_FIRMWARE, timeout=10)
+    # Let the shell print its prompt again
+    serial.wait_for_quiet(ser)
+    return m == FIRMWARE_RAMBOOT
+
+
+def write_image_marker(ser, sha256: str):
+    """Marks the installed firmware as flashed with the image with digest `sha256`"""
+    marked = _echo_marker(IMAGE_MARKED)
+    ser.write(f"echo {sha256} > {IMAGE_MARKER_FILE} && sync && {marked}\n".encode())
+    serial.wait_for_prompt_match(ser, IMAGE_MARKED, timeout=10)
+    serial.wait_for_quiet(ser)
+
+
+def installed_image(ser) -> str:
+    """
+    Returns the digest of the image the installed firmware was flashed with,
+    or None if it isn't marked, see `write_image_marker`
+    """
+    marker = f"$(cat {IMAGE_MARKER_FILE} 2>/dev/null || echo none)"
+    release = "$(. /etc/openwrt_release 2>/dev/null; echo $DISTRIB_DESCRIPTION)"
+    ser.write(f'{_echo_marker(FIRMWARE_INFO)}"={marker} {release}"\n'.encode())
+    m = serial.wait_for_prompt_match(ser, PROMPT_FIRMWARE_INFO, timeout=10)
+    serial.wait_for_quiet(ser)
+
+    sha256, release = PROMPT_FIRMWARE_INFO.match(m).groups()
+    sha256 = None if sha256 == "none" else sha256
+    logging.info(
+        f"Installed firmware: {release or 'unknown release'}, "
+        f"image {sha256 or 'not marked'}"
+    )
+    return sha256
+
+
+def reboot(ser):
+    logging.info("Rebooting AP")
+    ser.write(b"reboot\n")
+
+
+def switch_baudrate(ser, baudrate) -> bool:
+    """
+    Switches the OpenWrt console and `ser` to `baudrate`. Returns False if
+    that didn't work, the current rate is kept then.
+    """
+    old_baudrate = ser.baudrate
+    if baudrate == old_baudrate:
+        return True
+
+    logging.info(f"Switching OpenWrt console to {baudrate} baud")
+    ser.write(f"stty {baudrate}\n".encode("utf-8"))
+    serial.wait_for_quiet(ser, timeout=0.5)
+    ser.baudrate = baudrate
+    if serial.probe_prompt(ser, PROMPT_OPENWRT_SHELL):
+        return True
+
+    # Eg. stty is missing, so the console is still at the old rate
+    ser.baudrate = old_baudrate
+    if serial.probe_prompt(ser, PROMPT_OPENWRT_SHELL):
+        logging.warning(f"OpenWrt console didn't switch, staying at {old_baudrate}")
+        return False
+
+    serial.log_buffer_as_error(ser)
+    raise Exception(f"OpenWrt console doesn't answer at {baudrate} baud")
+
+
+def wait_for_sysupgrade_complete(ser, timeout=300, console_baudrate=None):
+    """
+    Waits until the AP reboots after sysupgrade, so no stale shell prompt is
+    mistaken for the new one. If the console was switched to another baud
+    rate, `ser` is switched back to the AP's default `console_baudrate`.
+    Returns the prompt that showed the reboot.
+    """
+    prompt = serial.wait_for_prompt_match(
+        ser, PROMPTS_SYSUPGRADE_COMPLETE, timeout=timeout
+    )
+    logging.info("Sysupgrade complete, AP is rebooting")
+    if console_baudrate:
+        ser.baudrate = console_baudrate
+    return prompt
+
+
+def wait_for_lan_ready(ser, settle_time=LAN_SETTLE_TIME):
     logging.info("Waiting for OpenWrt's 'br-lan' LAN interface to be ready")
 
     ser.write(b"\n")
     serial.wait_for_prompt_match(ser, PROMPT_OPENWRT_SHELL)
 
     # Bash oneliner that waits until the output of the command `ip link show br-lan` contains "br-lan"
-    ser.write(b'while ! ip link show br-lan | grep -q "br-lan"; do sleep 3; done\n')
+    ser.write(b'while ! ip link show br-lan | grep -q "br-lan"; do sleep 1; done\n')
 
     serial.wait_for_prompt_match(ser, PROMPT_OPENWRT_SHELL, timeout=180)
-    time.sleep(5)
+
+    # The kernel might already have logged the forwarding state while we were waiting
+    if not serial.get_console(ser).history_contains(PROMPT_LAN_FORWARDING):
+        serial.read_until_match(ser, PROMPT_LAN_FORWARDING, settle_time)
     if debug_logging_enabled():
         print()
 
     logging.info("OpenWrt LAN ready")
 
 
-def wait_for_pingable(ser, ip: ipaddress.IPv4Address):
-    logging.info(f"Waiting for AP @ {ip} to be pingable")
-    for _ in range(180):
-        if debug_logging_enabled():
-            print(ser.read(ser.inWaiting()).decode("utf-8", errors="ignore"), end="")
+def wait_for_pingable(
+    ser, ip: ipaddress.IPv4Address, port=network.SSH_PORT, timeout=180
+):
+    """Waits until the AP accepts connections on `port`, which is needed by the next phase"""
+    logging.info(f"Waiting for AP @ {ip} to accept connections on port {port}")
+    deadline = time.monotonic() + timeout
+    with network.Prober(port) as prober:
+        prober.add(ip)
+        while (remaining := deadline - time.monotonic()) > 0:
+            # Into the console's history like any other output, see `serial.next_match`
+            read = serial.get_console(ser).decode(ser.read(ser.inWaiting()))
+            if debug_logging_enabled():
+                print(read, end="")
 
-        if network.ip_responds_to_ping(ip):
-            logging.info(f"AP @ {ip} is pingable now")
-            return
-        time.sleep(1)
+            if prober.poll(min(remaining, 0.5)):
+                logging.info(f"AP @ {ip} is reachable now")
+                return
+            serial.check_watchdog()
 
-    raise Exception(f"Timeout waiting for AP @ {ip} to be pingable")
+    raise Exception(f"Timeout waiting for AP @ {ip} to be reachable on port {port}")
 
 
 def set_lan_ip(ser, ip: ipaddress.IPv4Address):
@@ -69,7 +212,16 @@ def set_lan_ip(ser, ip: ipaddress.IPv4Address):
     ser.write(b"/etc/init.d/network restart\n")
 
 
-def flash_openwrt(ser, ap_ip: ipaddress.IPv4Address, sysupgrade_file: str):
+def flash_openwrt(
+    ser, ap_ip: ipaddress.IPv4Address, sysupgrade_file: str, sha256: str = None
+):
+    copy_sysupgrade(ap_ip, sysupgrade_file)
+    if sha256:
+        verify_sysupgrade(ser, sha256, os.path.basename(sysupgrade_file))
+    run_sysupgrade(ser, os.path.basename(sysupgrade_file))
+
+
+def copy_sysupgrade(ap_ip: ipaddress.IPv4Address, sysupgrade_file: str):
     logging.info("Copying sysupgrade image to AP using scp")
 
     scp_command = [
@@ -89,10 +241,69 @@ def flash_openwrt(ser, ap_ip: ipaddress.IPv4Address, sysupgrade_file: str):
         logging.error("Failed to copy sysupgrade image using scp")
         raise
 
+
+def _checksum_command(sha256: str, path: str) -> str:
+    return f'echo "{sha256}  {path}" | sha256sum -c >/dev/null'
+
+
+def verify_command(sha256: str, file_name: str) -> str:
+    """
+    Shell command that checks the checksum of /tmp/`file_name` on the AP and
+    prints the actual one on a mismatch
+    """
+    path = f"/tmp/{file_name}"
+    ok = _echo_marker(CHECKSUM_OK)
+    failed = _echo_marker(CHECKSUM_FAILED)
+    return f"{_checksum_command(sha256, path)} && {ok} || {{ sha256sum {path}; {failed}; }}\n"
+
+
+def verify_sysupgrade(ser, sha256: str, file_name: str):
+    """
+    Checks the sysupgrade image copied to the AP, eg. with scp, against
+    `sha256`. Raises on a mismatch, so only the transfer is retried.
+    """
+    logging.info("Verifying sysupgrade image on AP")
+    ser.write(verify_command(sha256, file_name).encode("utf-8"))
+
+    result = serial.wait_for_prompt_match(ser, PROMPTS_CHECKSUM, timeout=60)
+    if result != CHECKSUM_OK:
+        serial.log_buffer_as_error(ser)
+        raise Exception(f"Checksum mismatch of sysupgrade image, expected {sha256}")
+
+    logging.info("Sysupgrade image verified")
+
+
+def download_command(url: str, sha256: str, file_name: str, retries=10) -> str:
+    """
+    Shell command that downloads `url` to /tmp/`file_name` on the AP and checks
+    its checksum. The LAN might still be restarting, so wget is retried.
+    """
+    path = f"/tmp/{file_name}"
+    download = (
+        f"for i in $(seq {retries}); do wget -q -O {path} {url} && break; sleep 2; done"
+    )
+    verify = _checksum_command(sha256, path)
+    ok = _echo_marker(DOWNLOAD_OK)
+    failed = _echo_marker(DOWNLOAD_FAILED)
+    return f"{download}; {verify} && {ok} || {failed}\n"
+
+
+def download_sysupgrade(ser, url: str, sha256: str, file_name: str):
+    logging.info(f"Letting AP download sysupgrade image from {url}")
+    ser.write(download_command(url, sha256, file_name).encode("utf-8"))
+
+    result = serial.wait_for_prompt_match(ser, PROMPTS_DOWNLOAD, timeout=120)
+    if result != DOWNLOAD_OK:
+        serial.log_buffer_as_error(ser)
+        raise Exception("Download of sysupgrade image failed or checksum mismatch")
+
+    logging.info("Sysupgrade image downloaded and verified")
+
+
+def run_sysupgrade(ser, sysupgrade_file_name: str):
     options = "-n"  # Don't save config
     if debug_logging_enabled():
         options += " -v"
 
-    sysupgrade_file_name = os.path.basename(sysupgrade_file)
     logging.info(f"Running sysupgrade with OpenWrt image {sysupgrade_file_name}")
     ser.write(f"sysupgrade {options} /tmp/{sysupgrade_file_name}\n".encode("utf-8"))
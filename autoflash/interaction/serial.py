@@ -1,36 +1,278 @@
 import re
 import sys
 import time
+import codecs
 import logging
+import threading
+import weakref
+import contextlib
+import contextvars
+from collections import deque
 from ..log import debug_logging_enabled
 
-_buffer = ""
+# Prompts never span multiple lines, so only the current (unterminated) line
+# has to be kept for matching. Its length is capped for binary garbage.
+MAX_LINE_LENGTH = 4096
+HISTORY_LINES = 200
 
 
-def log_buffer_as_error():
-    for line in _buffer.splitlines():
-        logging.error(line)
+class Console:
+    """
+    Per-connection state of a serial console: an incremental decoder, so UTF-8
+    sequences split across reads are not lost, and a bounded history of the
+    last lines for error dumps.
+    """
 
-
-def wait_for_prompt_match(ser, prompt_regex, timeout=60):
-    global _buffer
-    _buffer = ""
-    start = time.time()
-    while time.time() - start < timeout:
+    def __init__(self, history_lines=HISTORY_LINES):
         # There might be weird things happening over serial
         # (eg. the AP resets before everything is transmitted).
         # Therefore, we have to ignore decoding errors here.
-        bytes_to_read = 1 if ser.inWaiting() == 0 else ser.inWaiting()
-        new_read = ser.read(bytes_to_read).decode("utf-8", errors="ignore")
-        if debug_logging_enabled():
-            print(new_read, end="")
-            sys.stdout.flush()
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self.history = deque(maxlen=history_lines)
+        self.marks = {}
+        self._line = ""
+
+    def decode(self, data: bytes) -> str:
+        text = self._decoder.decode(data)
+        lines = (self._line + text).split("\n")
+        self._line = lines.pop()[-MAX_LINE_LENGTH:]
+        self.history.extend(lines)
+        return text
+
+    def mark(self, name):
+        """Remembers when something happened on this console, eg. the AP booted"""
+        self.marks[name] = time.monotonic()
+
+    def seconds_since(self, name):
+        if name not in self.marks:
+            return None
+        return time.monotonic() - self.marks[name]
 
-        _buffer += new_read
+    def clear_history(self):
+        self.history.clear()
 
-        match = re.search(prompt_regex, _buffer)
+    def history_contains(self, regex) -> bool:
+        regex = re.compile(regex)
+        return any(regex.search(line) for line in self.history) or bool(
+            regex.search(self._line)
+        )
+
+    def log_as_error(self):
+        for line in self.history:
+            logging.error(line)
+        if self._line:
+            logging.error(self._line)
+
+
+class PromptMatcher:
+    """
+    Searches a stream of text for a regex incrementally.
+
+    Only new text plus the current line is searched on every `feed`, so the
+    cost per read does not grow with the amount of output received so far.
+    The current line is the search window: prompts never span lines, and
+    patterns like `.*` have no longest match a window could be sized to.
+    """
+
+    def __init__(self, prompt_regex):
+        self.regex = re.compile(prompt_regex)
+        self._tail = ""
+
+    def feed(self, text: str):
+        window = self._tail + text
+        match = self.regex.search(window)
         if match:
-            return match.group(0)
+            self._tail = ""
+            return match
+
+        self._tail = window[window.rfind("\n") + 1 :][-MAX_LINE_LENGTH:]
+        return None
+
+
+class Watchdog:
+    """
+    Bounds of the current phase of a flash, see `history`: waits for the
+    device's output fail once the phase took longer than `bound` seconds or
+    the device didn't send anything for `stall` seconds. Either can be None.
+    """
+
+    def __init__(self, phase: str, bound: float = None, stall: float = None):
+        self.phase = phase
+        self.bound = bound
+        self.stall = stall
+        self.start = self.last_output = time.monotonic()
+        self._max_silence = 0.0
+
+    def output(self):
+        now = time.monotonic()
+        self._max_silence = max(self._max_silence, now - self.last_output)
+        self.last_output = now
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start
+
+    def max_silence(self) -> float:
+        """Longest time without output so far, including the current one"""
+        return max(self._max_silence, time.monotonic() - self.last_output)
+
+    def check(self):
+        if self.bound is not None and self.elapsed() > self.bound:
+            raise Exception(
+                f"AP hung: phase '{self.phase}' took longer than {self.bound:.0f}s"
+            )
+        silence = time.monotonic() - self.last_output
+        if self.stall is not None and silence > self.stall:
+            raise Exception(
+                f"AP hung: no output for {silence:.0f}s in phase '{self.phase}'"
+            )
+
+
+# The watchdog of the phase the current thread is in
+_watchdog = contextvars.ContextVar("watchdog", default=None)
+
+
+@contextlib.contextmanager
+def watching(watchdog: Watchdog):
+    token = _watchdog.set(watchdog)
+    try:
+        yield watchdog
+    finally:
+        _watchdog.reset(token)
+
+
+def check_watchdog():
+    """Raises if the current phase exceeded its bounds, for waits that don't read the console"""
+    watchdog = _watchdog.get()
+    if watchdog is not None:
+        watchdog.check()
+
+
+_consoles = weakref.WeakKeyDictionary()
+_consoles_lock = threading.Lock()
+
+
+def get_console(ser) -> Console:
+    with _consoles_lock:
+        console = _consoles.get(ser)
+        if console is None:
+            console = _consoles[ser] = Console()
+        return console
+
+
+def log_buffer_as_error(ser):
+    get_console(ser).log_as_error()
+
+
+def read_until_match(ser, prompt_regex, timeout):
+    """Like `wait_for_prompt_match`, but returns None on timeout"""
+    return feed_until_match(ser, PromptMatcher(prompt_regex), timeout)
+
+
+def feed_until_match(ser, matcher: PromptMatcher, timeout):
+    """
+    Like `read_until_match`, but with a matcher that can be reused across
+    calls, so a prompt split across two calls is still found
+    """
+    match = next_match(ser, matcher, timeout)
+    return None if match is None else match.group(0)
+
+
+def next_match(ser, matcher: PromptMatcher, timeout) -> re.Match:
+    """Like `feed_until_match`, but returns the `re.Match`, eg. to tell which group matched"""
+    console = get_console(ser)
+    watchdog = _watchdog.get()
+    echo = sys.stdout.write if debug_logging_enabled() else None
+    start = time.time()
+    try:
+        while time.time() - start < timeout:
+            in_waiting = ser.inWaiting()
+            new_read = console.decode(ser.read(in_waiting or 1))
+            if watchdog is not None:
+                if new_read:
+                    watchdog.output()
+                try:
+                    watchdog.check()
+                except Exception:
+                    console.log_as_error()
+                    raise
+            if not new_read:
+                continue
+
+            if echo:
+                echo(new_read)
+            match = matcher.feed(new_read)
+            if match:
+                return match
+
+        return None
+    finally:
+        if echo:
+            sys.stdout.flush()
+
+
+def wait_for_prompt_match(ser, prompt_regex, timeout=60):
+    match = read_until_match(ser, prompt_regex, timeout)
+    if match is None:
+        log_buffer_as_error(ser)
+        raise Exception(
+            f"Timeout waiting for prompt: '{re.compile(prompt_regex).pattern}'"
+        )
+    return match
+
+
+def wait_for_quiet(ser, quiet_time=0.05, timeout=0.2):
+    """
+    Waits until the device hasn't sent anything for `quiet_time`, but at most
+    `timeout`. Nothing is read, so no output is lost for the next match.
+    """
+    deadline = time.monotonic() + timeout
+    last_change = time.monotonic()
+    in_waiting = ser.inWaiting()
+    while (now := time.monotonic()) < deadline and now - last_change < quiet_time:
+        time.sleep(0.01)
+        if ser.inWaiting() != in_waiting:
+            in_waiting = ser.inWaiting()
+            last_change = time.monotonic()
+
+
+def probe_prompt(ser, prompt_regex, probe=b"\n", attempts=3, timeout=1) -> bool:
+    """Sends `probe` until the device answers with `prompt_regex`, eg. to verify a new baud rate"""
+    for _ in range(attempts):
+        ser.write(probe)
+        if read_until_match(ser, prompt_regex, timeout) is not None:
+            return True
+    return False
+
+
+def looks_like_text(data: bytes) -> bool:
+    """At a wrong baud rate, the received bytes are mostly not printable ASCII"""
+    if len(data) < 2:
+        return False
+    printable = sum(32 <= b < 127 or b in b"\r\n\t" for b in data)
+    return printable / len(data) >= 0.9
+
+
+def detect_baudrate(ser, baudrates, probe=b"\n", listen_time=0.5):
+    """
+    Finds the baud rate the device talks at, eg. when attaching while it is
+    booting: the first of `baudrates` at which its output, or its answer to
+    `probe`, is readable. Returns None and keeps the current rate if there is none.
+    """
+    original = ser.baudrate
+    for baudrate in baudrates:
+        ser.baudrate = baudrate
+        ser.reset_input_buffer()
+        ser.write(probe)
+
+        data = b""
+        deadline = time.monotonic() + listen_time
+        while time.monotonic() < deadline:
+            data += ser.read(ser.inWaiting() or 1)
+        if looks_like_text(data):
+            logging.info(f"Detected {baudrate} baud")
+            get_console(ser).decode(data)
+            return baudrate
 
-    log_buffer_as_error()
-    raise Exception(f"Timeout waiting for prompt: '{prompt_regex}'")
+    ser.baudrate = original
+    logging.warning(f"Couldn't detect the baud rate, staying at {original}")
+    return None
@@ -1,8 +1,9 @@
 import re
-import time
 import logging
 import ipaddress
+from pathlib import Path
 import autoflash.interaction.serial as serial
+import autoflash.interaction.expect as expect
 from ..log import debug_logging_enabled
 
 PROMPT_STOP_AUTOBOOT = r"Press f or F  to stop Auto-Boot"
@@ -12,47 +13,107 @@ PROMPT_UBOOT_READY = r"ar7240>"
 PROMPT_NEW_PASSWORD = r"New password:"
 PROMPT_CONFIRM_PASSWORD = r"Confirm  password:"
 
+# Messages of the Ethernet driver when the PHY has a link
+LINK_UP = r"[Ll]ink (is )?[Uu]p"
+# Fallback if no link up message is seen: The LAN interface needs some time after
+# power on to be (really) ready. Otherwise, the TFTP connection might abort
+# during ramboot image transfer.
+RAMBOOT_SETTLE_TIME = 5
 
-def ensure_ready(ser, password):
+# Printed after `setenv baudrate`, U-Boot then waits for Enter at the new rate
+PROMPT_SWITCH_BAUDRATE = r"Switch baudrate to \d+ bps"
+PROMPT_STARTING_KERNEL = r"Starting kernel"
+
+RAMBOOT_STARTED = r"Linux version"
+RAMBOOT_FAILED = r"Execute .* Fail"
+
+
+# Digest of the last sysupgrade image the AP was flashed with, see `autoflash.flash_ap`
+ENV_IMAGE = "autoflash_image"
+
+# Printed by U-Boot right after power on
+PROMPTS_POWER_ON = re.compile(f"{PROMPT_STOP_AUTOBOOT}|{PROMPT_SKIP_BUS_TEST}")
+
+# The dialogue with the U-Boot of the Huawei APs, see `expect`. Other models
+# and U-Boot variants only need a script file that overrides the parts that
+# differ, see `use_script`.
+SCRIPT = {
+    "prompt": PROMPT_UBOOT_READY,
+    # U-Boot runs commands separated by ';' one after the other, so several
+    # commands need only one round trip. Lines are limited by its console buffer.
+    "separator": "; ",
+    "max_line_length": 200,
+    "patterns": {
+        "power_on": PROMPTS_POWER_ON.pattern,
+        "link_up": LINK_UP,
+        "switch_baudrate": PROMPT_SWITCH_BAUDRATE,
+        "starting_kernel": PROMPT_STARTING_KERNEL,
+        "ramboot_started": RAMBOOT_STARTED,
+        "ramboot_failed": RAMBOOT_FAILED,
+    },
+    "dialogues": {
+        # From power on, or any later point, to the U-Boot prompt
+        "login": {
+            "timeout": 60,
+            "max_turns": 6,
+            "rules": [
+                {"pattern": PROMPT_SKIP_BUS_TEST, "send": "j", "mark": "uboot_started"},
+                {"pattern": PROMPT_STOP_AUTOBOOT, "send": "f", "mark": "uboot_started"},
+                {"pattern": PROMPT_PASSWORD, "send": "{password}\n"},
+                {
+                    "pattern": f"{PROMPT_NEW_PASSWORD}|{PROMPT_CONFIRM_PASSWORD}",
+                    "send": "{password}\n",
+                },
+                {"pattern": PROMPT_UBOOT_READY, "done": True},
+            ],
+        },
+    },
+}
+
+_script = expect.Script(SCRIPT)
+
+
+def use_script(path: Path):
+    """Talks to U-Boot according to the script file at `path`, on top of `SCRIPT`"""
+    global _script
+    _script = expect.load_script(path, SCRIPT)
+
+
+def script() -> expect.Script:
+    return _script
+
+
+def prompts_ramboot() -> str:
+    """What U-Boot prints when ramboot started or failed, see `run_ramboot`"""
+    return f"{_script.pattern('ramboot_started')}|{_script.pattern('ramboot_failed')}"
+
+
+def wait_for_power_on(ser, stop=None):
+    """
+    Waits until an AP is powered on and returns U-Boot's first prompt, which
+    has to be passed to `ensure_ready`. Returns None once `stop` is set.
+    """
+    matcher = serial.PromptMatcher(_script.pattern("power_on"))
+    while not (stop and stop.is_set()):
+        m = serial.feed_until_match(ser, matcher, timeout=1)
+        if m is not None:
+            logging.info("AP powered on")
+            return m
+    return None
+
+
+def ensure_ready(ser, password, prompt=None):
     """
     The script can be started at two points in time:
         1. Before the AP is powered on. Then, we have to stop auto-boot AND enter the password
         2. After the AP has been powered on for a while. Then, we only have to enter the password.
            We only get the prompt when we press enter.
         3. The password has already been entered. We only get the prompt when we press enter.
+    If the first prompt was already read, eg. by `wait_for_power_on`, it is passed as `prompt`.
     """
-    ser.write(b"\n")
-    for _ in range(4):
-        m = serial.wait_for_prompt_match(
-            ser,
-            "|".join(
-                [
-                    PROMPT_STOP_AUTOBOOT,
-                    PROMPT_PASSWORD,
-                    PROMPT_UBOOT_READY,
-                    PROMPT_SKIP_BUS_TEST,
-                    PROMPT_NEW_PASSWORD,
-                    PROMPT_CONFIRM_PASSWORD,
-                ]
-            ),
-        )
-        if m == PROMPT_SKIP_BUS_TEST:
-            time.sleep(0.2)
-            ser.write(b"j")
-        elif m == PROMPT_STOP_AUTOBOOT:
-            time.sleep(0.2)
-            ser.write(b"f")
-        elif m == PROMPT_PASSWORD:
-            time.sleep(0.2)
-            ser.write(f"{password}\n".encode("utf-8"))
-        elif m == PROMPT_NEW_PASSWORD or m == PROMPT_CONFIRM_PASSWORD:
-            time.sleep(0.2)
-            ser.write(f"{password}\n".encode("utf-8"))
-        elif m == PROMPT_UBOOT_READY:
-            break
-        else:
-            serial.log_buffer_as_error()
-            raise Exception("Unexpected prompt")
+    if prompt is None:
+        ser.write(b"\n")
+    _script.dialogue("login").run(ser, {"password": password}, prompt)
 
     if debug_logging_enabled():
         print()
@@ -63,7 +124,69 @@ def ensure_ready(ser, password):
 def send_uboot_cmd(ser, cmd: str, wait_for_prompt=True):
     ser.write(f"{cmd}\n".encode("utf-8"))
     if wait_for_prompt:
-        serial.wait_for_prompt_match(ser, PROMPT_UBOOT_READY)
+        serial.wait_for_prompt_match(ser, _script.prompt)
+
+
+def send_uboot_cmds(ser, cmds: list[str]):
+    """Sends `cmds` in as few lines as the script allows, waits for the prompt after each"""
+    for line in _script.batch(cmds):
+        send_uboot_cmd(ser, line)
+
+
+def read_env(ser, name: str) -> str:
+    """Returns the value of the environment variable `name`, or None if it isn't set"""
+    ser.write(f"printenv {name}\n".encode("utf-8"))
+    # The echo of the command has no '='
+    m = serial.read_until_match(ser, rf"{name}=\S*\r?\n|not defined", timeout=5)
+    # Let U-Boot print its prompt again
+    serial.wait_for_quiet(ser)
+    if m is None or not m.startswith(f"{name}="):
+        return None
+    return m[len(name) + 1 :].strip()
+
+
+def save_env(ser, variables: dict):
+    """Sets the environment `variables` and writes the environment to the flash"""
+    send_uboot_cmds(
+        ser, [f"setenv {name} {value}" for name, value in variables.items()]
+    )
+    send_uboot_cmd(ser, "saveenv")
+
+
+def boot(ser):
+    """Boots the installed firmware"""
+    logging.info("Booting the installed firmware")
+    send_uboot_cmd(ser, "boot", wait_for_prompt=False)
+
+
+def switch_baudrate(ser, baudrate) -> bool:
+    """
+    Switches U-Boot and `ser` to `baudrate`. Returns False if U-Boot can't
+    switch, the current rate is kept then. The change is not saved, so the AP
+    is back at its default rate after the next reset.
+    """
+    old_baudrate = ser.baudrate
+    if baudrate == old_baudrate:
+        return True
+
+    logging.info(f"Switching U-Boot to {baudrate} baud")
+    send_uboot_cmd(ser, f"setenv baudrate {baudrate}", wait_for_prompt=False)
+    m = serial.read_until_match(
+        ser, f"{_script.pattern('switch_baudrate')}|{_script.prompt}", timeout=5
+    )
+    if m is None or re.match(_script.prompt, m):
+        logging.warning(
+            f"U-Boot didn't switch the baud rate, staying at {old_baudrate}"
+        )
+        return False
+
+    serial.wait_for_quiet(ser)
+    ser.baudrate = baudrate
+    # U-Boot only continues after a carriage return at the new rate
+    if not serial.probe_prompt(ser, _script.prompt, probe=b"\r"):
+        serial.log_buffer_as_error(ser)
+        raise Exception(f"U-Boot doesn't answer at {baudrate} baud")
+    return True
 
 
 def configure_ramboot(
@@ -73,29 +196,58 @@ def configure_ramboot(
         f"Configuring ramboot with TFTP server '{tftp_ip}', AP IP '{ap_ip}', filename '{filename}'"
     )
     send_uboot_cmd(ser, "")
-    time.sleep(1)
+    serial.wait_for_quiet(ser, timeout=1)
     send_uboot_cmd(ser, "")
-    send_uboot_cmd(ser, f"setenv serverip {tftp_ip}")
-    send_uboot_cmd(ser, f"setenv ipaddr {ap_ip}")
-    send_uboot_cmd(ser, f"setenv rambootfile {filename}")
+    send_uboot_cmds(
+        ser,
+        [
+            f"setenv serverip {tftp_ip}",
+            f"setenv ipaddr {ap_ip}",
+            f"setenv rambootfile {filename}",
+        ],
+    )
+
+
+def wait_for_link(ser, settle_time=RAMBOOT_SETTLE_TIME):
+    """
+    Waits until the AP's LAN interface is ready: Either the driver reported a
+    link, or `settle_time` has passed since U-Boot started.
+    """
+    link_up = _script.pattern("link_up")
+    console = serial.get_console(ser)
+    if console.history_contains(link_up):
+        return
 
+    since_boot = console.seconds_since("uboot_started")
+    remaining = settle_time - (since_boot or 0)
+    if remaining > 0:
+        logging.info(f"Waiting up to {remaining:.1f}s for the LAN link")
+        serial.read_until_match(ser, link_up, remaining)
 
-def run_ramboot(ser):
+
+def run_ramboot(ser, settle_time=RAMBOOT_SETTLE_TIME, console_baudrate=None):
+    """
+    If U-Boot was switched to another baud rate, pass the AP's default rate as
+    `console_baudrate`: the kernel starts with that one.
+    """
     logging.info("Starting ramboot")
-    # We should wait a bit for the LAN interface to be (really) ready.
-    # Otherwise, the TFTP connection might abort during ramboot image transfer.
-    time.sleep(5)
+    wait_for_link(ser, settle_time)
     send_uboot_cmd(ser, "run ramboot", wait_for_prompt=False)
 
-    ramboot_failed = r"Execute .* Fail"
-    result = serial.wait_for_prompt_match(
-        ser,
-        "|".join(["Linux version", ramboot_failed]),
-        timeout=50,
-    )
+    failed = _script.pattern("ramboot_failed")
+    if console_baudrate and console_baudrate != ser.baudrate:
+        starting_kernel = _script.pattern("starting_kernel")
+        result = serial.wait_for_prompt_match(
+            ser, f"{starting_kernel}|{failed}", timeout=50
+        )
+        if re.match(starting_kernel, result):
+            ser.baudrate = console_baudrate
+            result = serial.wait_for_prompt_match(ser, prompts_ramboot(), timeout=50)
+    else:
+        result = serial.wait_for_prompt_match(ser, prompts_ramboot(), timeout=50)
 
-    if re.match(ramboot_failed, result):
-        serial.log_buffer_as_error()
+    if re.match(failed, result):
+        serial.log_buffer_as_error(ser)
         raise Exception("Ramboot failed. Is TFTP server started?")
 
     logging.info("Ramboot successfully started")
@@ -1,34 +1,196 @@
+"""
+Leases of AP IPs, shared by all ports and processes via `ips.sqlite`.
+
+IPs that were never handed out are taken from a per-network counter, so a
+network is cycled through before any IP is reused, which keeps stale ARP
+entries of previously flashed APs from getting in the way. After that, the
+IP whose lease expired or was released first is reused. All lookups,
+including the lease a holder still has, are indexed, so they don't slow
+down with the size of the network. Claims
+run in a single `BEGIN IMMEDIATE` transaction, so concurrent processes never
+get the same IP.
+"""
+
+import time
 import sqlite3
+import logging
+import threading
 import ipaddress
 from . import IP_NETWORK
 
-con = sqlite3.connect("ips.sqlite")
-cur = con.cursor()
+# Seconds until an IP that wasn't released can be handed out again
+LEASE_TIME = 3600
 
-# Ensure the table exists
-cur.execute("""
-CREATE TABLE IF NOT EXISTS ips (
-    ip TEXT PRIMARY KEY NOT NULL
-)
-""")
-con.commit()
+_lock = threading.RLock()
+_db_path = "ips.sqlite"
+_network = IP_NETWORK
+_con = None
 
 
-def get_free_ip(reserved_ips: list[ipaddress.IPv4Address]) -> ipaddress.IPv4Address:
-    cur.execute("SELECT ip FROM ips")
+def configure(db_path=None, network: ipaddress.IPv4Network = None):
+    """Sets the database file and the default network to hand out IPs from"""
+    global _db_path, _network, _con
+    with _lock:
+        if db_path is not None and str(db_path) != _db_path:
+            if _con is not None:
+                _con.close()
+                _con = None
+            _db_path = str(db_path)
+        if network is not None:
+            _network = network
+
+
+def _connection() -> sqlite3.Connection:
+    global _con
+    if _con is None:
+        # The connection is shared by all ports flashing in parallel, transactions are explicit
+        _con = sqlite3.connect(
+            _db_path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        _con.executescript("""
+            CREATE TABLE IF NOT EXISTS pools (
+                network TEXT PRIMARY KEY NOT NULL,
+                next_ip INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS leases (
+                network TEXT NOT NULL,
+                ip INTEGER NOT NULL,
+                holder TEXT NOT NULL,
+                expires REAL NOT NULL,
+                PRIMARY KEY (network, ip)
+            );
+            CREATE INDEX IF NOT EXISTS leases_expires ON leases (network, expires);
+            CREATE INDEX IF NOT EXISTS leases_holder ON leases (network, holder, expires);
+        """)
+    return _con
+
+
+def _claim_held(cur, network, reserved, holder, now):
+    """Takes the IP `holder` still has a lease for, eg. to resume an interrupted flash"""
+    for (ip,) in cur.execute(
+        "SELECT ip FROM leases WHERE network = ? AND holder = ? AND expires > ?",
+        (str(network), holder, now),
+    ):
+        if ip not in reserved:
+            return ip
+    return None
+
+
+def _claim_new(cur, network, reserved):
+    """Takes the next IP that was never handed out from the network's counter"""
+    first, last = _host_range(network)
+    row = cur.execute(
+        "SELECT next_ip FROM pools WHERE network = ?", (str(network),)
+    ).fetchone()
+    ip = row[0] if row else first
+
+    while ip <= last and ip in reserved:
+        ip += 1
+
+    cur.execute(
+        "INSERT OR REPLACE INTO pools (network, next_ip) VALUES (?, ?)",
+        (str(network), min(ip, last) + 1),
+    )
+    return ip if ip <= last else None
 
-    # make a copy for us
-    existing_ips = reserved_ips.copy()
-    existing_ips.extend(ipaddress.IPv4Address(row[0]) for row in cur.fetchall())
 
-    for ip in IP_NETWORK.hosts():
-        if ip not in existing_ips:
-            cur.execute("INSERT INTO ips (ip) VALUES (?)", (str(ip),))
-            con.commit()
+def _claim_expired(cur, network, reserved, now):
+    """Takes the IP whose lease expired first"""
+    for (ip,) in cur.execute(
+        "SELECT ip FROM leases WHERE network = ? AND expires <= ? ORDER BY expires",
+        (str(network), now),
+    ):
+        if ip not in reserved:
             return ip
+    return None
 
-    # We're at the end, so the first ones should be free again :)
-    cur.execute("DELETE FROM ips")
-    con.commit()
 
-    return get_free_ip(reserved_ips)
+def _host_range(network: ipaddress.IPv4Network):
+    if network.num_addresses <= 2:
+        return int(network[0]), int(network[-1])
+    return int(network[1]), int(network[-2])
+
+
+def claim_ip(
+    reserved_ips=(),
+    holder="",
+    network: ipaddress.IPv4Network = None,
+    lease_time=LEASE_TIME,
+) -> ipaddress.IPv4Address:
+    """
+    Leases a free IP of `network` (default set with `configure`) that's not
+    in `reserved_ips` for `lease_time` seconds. Release it with `release_ip`.
+    A lease of `holder` that wasn't released, eg. after a failed flash, is
+    renewed instead, as the AP on that port might still use the IP.
+    """
+    network = network or _network
+    reserved = {int(ip) for ip in reserved_ips}
+    now = time.time()
+
+    with _lock:
+        cur = _connection().cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            ip = _claim_held(cur, network, reserved, holder, now) if holder else None
+            if ip is None:
+                ip = _claim_new(cur, network, reserved)
+            if ip is None:
+                ip = _claim_expired(cur, network, reserved, now)
+            if ip is None:
+                raise Exception(f"No free IP left in {network}")
+
+            cur.execute(
+                "INSERT OR REPLACE INTO leases (network, ip, holder, expires) VALUES (?, ?, ?, ?)",
+                (str(network), ip, holder, now + lease_time),
+            )
+            cur.execute("COMMIT")
+        except BaseException:
+            cur.execute("ROLLBACK")
+            raise
+
+    ip = ipaddress.IPv4Address(ip)
+    logging.debug(f"Leased {ip} to '{holder}' for {lease_time}s")
+    return ip
+
+
+def release_ip(ip: ipaddress.IPv4Address, network: ipaddress.IPv4Network = None):
+    """Makes a leased IP available again"""
+    network = network or _network
+    with _lock:
+        _connection().execute(
+            "UPDATE leases SET expires = ? WHERE network = ? AND ip = ?",
+            (time.time(), str(network), int(ip)),
+        )
+    logging.debug(f"Released {ip}")
+
+
+def hand_over_ip(
+    ip: ipaddress.IPv4Address,
+    holder: str,
+    new_holder: str,
+    network: ipaddress.IPv4Network = None,
+    lease_time=LEASE_TIME,
+) -> bool:
+    """
+    Passes the lease of `ip` from `holder` on to `new_holder` and renews it.
+    Returns False if `holder`'s lease expired.
+    """
+    network = network or _network
+    now = time.time()
+    with _lock:
+        updated = (
+            _connection()
+            .execute(
+                "UPDATE leases SET holder = ?, expires = ? "
+                "WHERE network = ? AND ip = ? AND holder = ? AND expires > ?",
+                (new_holder, now + lease_time, str(network), int(ip), holder, now),
+            )
+            .rowcount
+        )
+    if updated:
+        logging.debug(f"Handed {ip} over from '{holder}' to '{new_holder}'")
+    return bool(updated)
+
+
+def get_free_ip(reserved_ips: list[ipaddress.IPv4Address]) -> ipaddress.IPv4Address:
+    return claim_ip(reserved_ips, holder=threading.current_thread().name)
@@ -1,9 +1,47 @@
 import logging
-
+import contextvars
+from pathlib import Path
 
 FORMAT = "%(asctime)s - %(levelname)s: %(message)s"
+PARALLEL_FORMAT = "%(asctime)s - %(levelname)s [%(port)s]: %(message)s"
 DATEFMT = "%d.%m.%Y %H:%M:%S"
 
 
 def debug_logging_enabled():
     return logging.getLogger().level == logging.DEBUG
+
+
+# Name of the port the current thread or asyncio task is flashing
+_port = contextvars.ContextVar("port", default=None)
+_default_record_factory = logging.getLogRecordFactory()
+
+
+def set_port(name: str):
+    _port.set(name)
+
+
+def _record_factory(*args, **kwargs):
+    record = _default_record_factory(*args, **kwargs)
+    record.port = _port.get() or record.threadName
+    return record
+
+
+logging.setLogRecordFactory(_record_factory)
+
+
+class PortFilter(logging.Filter):
+    def __init__(self, port):
+        super().__init__()
+        self.port = port
+
+    def filter(self, record):
+        return record.port == self.port
+
+
+def add_port_log_file(name: str, log_dir: Path) -> logging.Handler:
+    """Writes all log records of the port called `name` to `<log_dir>/<name>.log`"""
+    handler = logging.FileHandler(log_dir / f"{name}.log")
+    handler.setFormatter(logging.Formatter(FORMAT, DATEFMT))
+    handler.addFilter(PortFilter(name))
+    logging.getLogger().addHandler(handler)
+    return handler
@@ -0,0 +1,188 @@
+"""
+Timing of the flash phases.
+
+Every phase of `run_autoflash` is timed by a `Trace`. Finished phases are
+written as JSON lines to the file set with `configure` and aggregated into
+histograms and counters, which can be exposed in the Prometheus text format.
+With `history` enabled, phases that exceed the bounds learned from previous
+flashes fail early.
+"""
+
+import json
+import time
+import logging
+import threading
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from . import history
+
+BUCKETS = (1, 2, 5, 10, 20, 30, 60, 90, 120, 180, 300, 600, float("inf"))
+
+_lock = threading.Lock()
+_events_file = None
+
+# (phase, port) -> [bucket counts, sum, count]
+_phase_durations = {}
+# port -> count
+_aps_flashed = {}
+# (phase, port) -> count
+_failures = {}
+
+
+def configure(events_path=None, prometheus_port=None):
+    """Enables writing events to `events_path` and serving metrics on `prometheus_port`"""
+    global _events_file
+    if events_path:
+        _events_file = open(events_path, "a", buffering=1)
+    if prometheus_port:
+        _start_prometheus_server(prometheus_port)
+
+
+def _emit(event: dict):
+    if _events_file is None:
+        return
+    line = json.dumps(event)
+    with _lock:
+        _events_file.write(line + "\n")
+
+
+def _observe(phase, port, duration, outcome):
+    with _lock:
+        histogram = _phase_durations.setdefault(
+            (phase, port), [[0] * len(BUCKETS), 0.0, 0]
+        )
+        for i, bound in enumerate(BUCKETS):
+            if duration <= bound:
+                histogram[0][i] += 1
+        histogram[1] += duration
+        histogram[2] += 1
+
+        if outcome != "ok":
+            _failures[(phase, port)] = _failures.get((phase, port), 0) + 1
+
+
+def _count_flashed(port):
+    with _lock:
+        _aps_flashed[port] = _aps_flashed.get(port, 0) + 1
+
+
+class Trace:
+    """Times the phases of flashing one AP"""
+
+    def __init__(self, port, ap_ip, image):
+        self.port = port
+        self.ap_ip = str(ap_ip)
+        self.image = str(image)
+        self.durations = {}
+
+    def _record(self, phase, start, duration, outcome):
+        self.durations[phase] = duration
+        _observe(phase, self.port, duration, outcome)
+        _emit(
+            {
+                "port": self.port,
+                "ap_ip": self.ap_ip,
+                "image": self.image,
+                "phase": phase,
+                "start": start,
+                "duration": round(duration, 3),
+                "outcome": outcome,
+            }
+        )
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        started = time.monotonic()
+        outcome = "failed"
+        try:
+            with history.watched(self.port, name):
+                yield
+            outcome = "ok"
+        finally:
+            duration = time.monotonic() - started
+            logging.info(f"Phase '{name}' {outcome} after {duration:.1f}s")
+            self._record(name, start, duration, outcome)
+
+    @contextlib.contextmanager
+    def run(self):
+        """Times the whole flash and counts the AP as flashed on success"""
+        with self.phase("total"):
+            yield
+        _count_flashed(self.port)
+
+
+def phase_summary() -> dict:
+    """Returns `{phase: (count, mean duration)}` over all ports"""
+    totals = {}
+    with _lock:
+        for (phase, _), (_, total, count) in _phase_durations.items():
+            phase_total, phase_count = totals.get(phase, (0.0, 0))
+            totals[phase] = (phase_total + total, phase_count + count)
+    return {phase: (count, total / count) for phase, (total, count) in totals.items()}
+
+
+def reset():
+    with _lock:
+        _phase_durations.clear()
+        _aps_flashed.clear()
+        _failures.clear()
+
+
+def _labels(**labels):
+    return ",".join(f'{k}="{v}"' for k, v in labels.items())
+
+
+def render_prometheus() -> str:
+    lines = [
+        "# HELP autoflash_phase_duration_seconds Duration of the flash phases",
+        "# TYPE autoflash_phase_duration_seconds histogram",
+    ]
+    with _lock:
+        for (phase, port), (counts, total, count) in sorted(_phase_durations.items()):
+            for bound, bucket_count in zip(BUCKETS, counts):
+                le = "+Inf" if bound == float("inf") else str(bound)
+                lines.append(
+                    f"autoflash_phase_duration_seconds_bucket{{{_labels(phase=phase, port=port, le=le)}}} {bucket_count}"
+                )
+            labels = _labels(phase=phase, port=port)
+            lines.append(f"autoflash_phase_duration_seconds_sum{{{labels}}} {total}")
+            lines.append(f"autoflash_phase_duration_seconds_count{{{labels}}} {count}")
+
+        lines.append("# HELP autoflash_aps_flashed_total Successfully flashed APs")
+        lines.append("# TYPE autoflash_aps_flashed_total counter")
+        for port, count in sorted(_aps_flashed.items()):
+            lines.append(f"autoflash_aps_flashed_total{{{_labels(port=port)}}} {count}")
+
+        lines.append("# HELP autoflash_failures_total Failed flashes by phase")
+        lines.append("# TYPE autoflash_failures_total counter")
+        for (phase, port), count in sorted(_failures.items()):
+            lines.append(
+                f"autoflash_failures_total{{{_labels(phase=phase, port=port)}}} {count}"
+            )
+
+    return "\n".join(lines) + "\n"
+
+
+class _PrometheusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _start_prometheus_server(port):
+    httpd = ThreadingHTTPServer(("", port), _PrometheusHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"Serving Prometheus metrics on port {port}")
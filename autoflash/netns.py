@@ -0,0 +1,116 @@
+"""
+A network namespace per serial port.
+
+Every AP's ramboot image comes up at `OPENWRT_DEFAULT_LAN_IP` and fetches
+it from `TFTP_IP`. If every port is paired with its own host interface (eg.
+a USB Ethernet adapter or a switch port's VLAN), that interface can be
+moved into a namespace of its own with `TFTP_IP`. Then all APs keep the
+default IP: no IPs have to be leased, `openwrt.set_lan_ip` and its network
+restart are not needed, and any number of APs are flashed in parallel
+without IP conflicts.
+
+A port's worker thread enters the namespace with `setns`, which only
+affects the calling thread: the sockets it creates, the threads it starts
+(eg. of a TFTP or HTTP server) and the processes it runs (eg. scp) all
+belong to the namespace. The namespaces are left in place afterwards, so
+the next run only enters them. Creating and entering them needs root.
+"""
+
+import os
+import ctypes
+import logging
+import threading
+import subprocess
+import contextlib
+from pathlib import Path
+from . import TFTP_IP, IP_NETWORK
+from .parallel import port_name
+
+NETNS_DIR = Path("/run/netns")
+NAME_PREFIX = "autoflash-"
+
+CLONE_NEWNET = 0x40000000
+
+# `ip netns add` sets up /run/netns on first use, which must not run twice at once
+_create_lock = threading.Lock()
+
+
+def namespace_name(port: str) -> str:
+    return f"{NAME_PREFIX}{port_name(port)}"
+
+
+def parse_interfaces(mappings: list[str], ports: list[str]) -> dict:
+    """
+    Parses `PORT=INTERFACE` arguments, where PORT is a port's name (eg.
+    `ttyUSB0`), and returns the interface of every port by port name
+    """
+    interfaces = {}
+    for mapping in mappings:
+        name, sep, interface = mapping.partition("=")
+        if not sep or not name or not interface:
+            raise ValueError(f"Expected PORT=INTERFACE, got '{mapping}'")
+        interfaces[port_name(name)] = interface
+
+    missing = [port for port in ports if port_name(port) not in interfaces]
+    if missing:
+        raise ValueError(f"No network interface for {', '.join(missing)}")
+    return interfaces
+
+
+def _ip(*args, check=True) -> bool:
+    result = subprocess.run(["ip", *args], capture_output=True, text=True)
+    if check and result.returncode != 0:
+        raise Exception(f"'ip {' '.join(args)}' failed: {result.stderr.strip()}")
+    return result.returncode == 0
+
+
+def create(name: str, interface: str):
+    """
+    Creates the namespace `name`, unless it exists, and moves `interface`
+    into it with `TFTP_IP`, unless it is there already
+    """
+    with _create_lock:
+        if not (NETNS_DIR / name).exists():
+            logging.info(f"Creating network namespace {name}")
+            _ip("netns", "add", name)
+
+    if not _ip("-n", name, "link", "show", interface, check=False):
+        logging.info(f"Moving {interface} into network namespace {name}")
+        _ip("link", "set", interface, "netns", name)
+
+    address = f"{TFTP_IP}/{IP_NETWORK.prefixlen}"
+    _ip("-n", name, "addr", "replace", address, "dev", interface)
+    _ip("-n", name, "link", "set", interface, "up")
+    _ip("-n", name, "link", "set", "lo", "up")
+
+
+def _setns(fd: int):
+    if hasattr(os, "setns"):
+        os.setns(fd, CLONE_NEWNET)
+        return
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.setns(fd, CLONE_NEWNET) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+@contextlib.contextmanager
+def entered(name: str):
+    """Moves the calling thread into the namespace `name` until the context is left"""
+    with open("/proc/thread-self/ns/net") as own, open(NETNS_DIR / name) as target:
+        _setns(target.fileno())
+        try:
+            yield
+        finally:
+            _setns(own.fileno())
+
+
+@contextlib.contextmanager
+def isolated(port: str, interface: str):
+    """Creates the namespace of `port` with `interface` if needed and enters it"""
+    name = namespace_name(port)
+    create(name, interface)
+    with entered(name):
+        logging.info(f"Using {interface} in network namespace {name}")
+        yield
@@ -1,18 +1,274 @@
+"""
+Reachability probing of APs without spawning processes.
+
+`Prober` watches many AP IPs from a single loop: it starts non-blocking TCP
+connects to the port needed for the next phase (eg. 22 for scp), and uses
+ICMP echo replies and the kernel's ARP table as hints that the host is up.
+While a host is silent, probes back off to `MAX_PROBE_INTERVAL`; as soon as
+it shows signs of life, it is probed every `MIN_PROBE_INTERVAL` until the
+port accepts connections.
+"""
+
+import time
+import errno
+import socket
+import struct
+import logging
+import selectors
 import subprocess
 
+SSH_PORT = 22
+HTTP_PORT = 80
+
+MIN_PROBE_INTERVAL = 0.1
+MAX_PROBE_INTERVAL = 1.0
+CONNECT_TIMEOUT = 1.0
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+# Flag of complete entries in /proc/net/arp
+ATF_COM = 0x2
+
+
+def arp_neighbours() -> set:
+    """Returns the IPs with a complete entry in the kernel's ARP table"""
+    neighbours = set()
+    try:
+        # The calling thread's network namespace, see `netns`
+        with open("/proc/thread-self/net/arp") as f:
+            next(f, None)
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 3 and int(fields[2], 16) & ATF_COM:
+                    neighbours.add(fields[0])
+    except OSError:
+        pass
+    return neighbours
+
+
+def _checksum(data: bytes) -> int:
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+def icmp_echo_request(ident: int, seq: int) -> bytes:
+    payload = b"autoflash"
+    header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    checksum = _checksum(header + payload)
+    return struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, checksum, ident, seq) + payload
+
 
-def ip_responds_to_ping(ip):
-    ping_cmd = [
-        "ping",
-        "-c",
-        "1",
-        "-W",
-        "1",
-        str(ip),
-    ]
+def open_icmp_socket():
+    """
+    Opens an unprivileged ICMP datagram socket (see `net.ipv4.ping_group_range`),
+    or a raw socket if that's not allowed. Returns None if neither is possible.
+    """
+    for kind in (socket.SOCK_DGRAM, socket.SOCK_RAW):
+        try:
+            sock = socket.socket(socket.AF_INET, kind, socket.IPPROTO_ICMP)
+        except OSError:
+            continue
+        sock.setblocking(False)
+        return sock
 
+    logging.debug("No ICMP socket available, falling back to the ping command")
+    return None
+
+
+def parse_echo_reply(sock, packet: bytes) -> bool:
+    """Whether `packet` received on the ICMP socket `sock` is an echo reply"""
+    if sock.type == socket.SOCK_RAW:
+        # Raw sockets receive the IP header, too
+        packet = packet[(packet[0] & 0x0F) * 4 :] if packet else b""
+    return len(packet) >= 8 and packet[0] == ICMP_ECHO_REPLY
+
+
+def _ping_command(ip) -> bool:
     return_code = subprocess.call(
-        ping_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        ["ping", "-c", "1", "-W", "1", str(ip)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
     )
-
     return return_code == 0
+
+
+def ip_responds_to_ping(ip, timeout=1.0) -> bool:
+    sock = open_icmp_socket()
+    if sock is None:
+        return _ping_command(ip)
+
+    ip = str(ip)
+    deadline = time.monotonic() + timeout
+    with sock, selectors.DefaultSelector() as selector:
+        selector.register(sock, selectors.EVENT_READ)
+        sock.sendto(icmp_echo_request(0, 1), (ip, 0))
+        while (remaining := deadline - time.monotonic()) > 0:
+            if not selector.select(remaining):
+                break
+            packet, (source, _) = sock.recvfrom(1024)
+            if source == ip and parse_echo_reply(sock, packet):
+                return True
+    return False
+
+
+class _Target:
+    def __init__(self, ip: str):
+        self.ip = ip
+        self.alive = False
+        self.interval = MIN_PROBE_INTERVAL
+        self.next_probe = 0.0
+        self.sock = None
+        self.connect_deadline = None
+
+
+class Prober:
+    """
+    Waits for TCP `port` of many IPs to accept connections, see the module
+    documentation. Add IPs with `add` and call `poll` until they are returned.
+    """
+
+    def __init__(self, port=SSH_PORT):
+        self.port = port
+        self._targets = {}
+        self._selector = selectors.DefaultSelector()
+        self._icmp = open_icmp_socket()
+        self._seq = 0
+        if self._icmp is not None:
+            self._selector.register(self._icmp, selectors.EVENT_READ)
+
+    def add(self, ip):
+        self._targets.setdefault(str(ip), _Target(str(ip)))
+
+    def remove(self, ip):
+        target = self._targets.pop(str(ip), None)
+        if target is not None:
+            self._close_connection(target)
+
+    def close(self):
+        for ip in list(self._targets):
+            self.remove(ip)
+        if self._icmp is not None:
+            self._selector.unregister(self._icmp)
+            self._icmp.close()
+        self._selector.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _close_connection(self, target: _Target):
+        if target.sock is not None:
+            self._selector.unregister(target.sock)
+            target.sock.close()
+            target.sock = None
+
+    def _probe(self, target: _Target, neighbours: set):
+        if target.ip in neighbours:
+            target.alive = True
+
+        if self._icmp is not None:
+            self._seq = (self._seq + 1) & 0xFFFF
+            try:
+                self._icmp.sendto(icmp_echo_request(0, self._seq), (target.ip, 0))
+            except OSError:
+                pass
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        result = sock.connect_ex((target.ip, self.port))
+        if result not in (0, errno.EINPROGRESS):
+            sock.close()
+            self._schedule_retry(target, result)
+            return
+
+        target.sock = sock
+        target.connect_deadline = time.monotonic() + CONNECT_TIMEOUT
+        self._selector.register(sock, selectors.EVENT_WRITE, target)
+
+    def _schedule_retry(self, target: _Target, error):
+        self._close_connection(target)
+        # A refused connection means the host is up, only the service isn't yet
+        if error == errno.ECONNREFUSED:
+            target.alive = True
+
+        if target.alive:
+            target.interval = MIN_PROBE_INTERVAL
+        else:
+            target.interval = min(target.interval * 2, MAX_PROBE_INTERVAL)
+        target.next_probe = time.monotonic() + target.interval
+
+    def _receive_icmp(self):
+        while True:
+            try:
+                packet, (source, _) = self._icmp.recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+            target = self._targets.get(source)
+            if target is not None and parse_echo_reply(self._icmp, packet):
+                target.alive = True
+                # Don't wait for the backed off interval of the next probe
+                if target.sock is None:
+                    target.next_probe = min(
+                        target.next_probe, time.monotonic() + MIN_PROBE_INTERVAL
+                    )
+
+    def poll(self, timeout) -> list:
+        """
+        Probes the added IPs for up to `timeout` seconds. Returns the IPs that
+        accept connections, which are no longer watched afterwards.
+        """
+        deadline = time.monotonic() + timeout
+        reachable = []
+        while True:
+            now = time.monotonic()
+            wakeup = deadline
+            due = [
+                t
+                for t in self._targets.values()
+                if t.sock is None and now >= t.next_probe
+            ]
+            neighbours = arp_neighbours() if due else set()
+            for target in due:
+                self._probe(target, neighbours)
+
+            for target in self._targets.values():
+                if target.sock is not None and now >= target.connect_deadline:
+                    self._schedule_retry(target, errno.ETIMEDOUT)
+                wakeup = min(
+                    wakeup,
+                    (
+                        target.next_probe
+                        if target.sock is None
+                        else target.connect_deadline
+                    ),
+                )
+
+            events = self._selector.select(max(0, wakeup - time.monotonic()))
+            for key, _ in events:
+                if key.data is None:
+                    self._receive_icmp()
+                    continue
+
+                target = key.data
+                error = target.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error == 0:
+                    reachable.append(target.ip)
+                    self.remove(target.ip)
+                else:
+                    self._schedule_retry(target, error)
+
+            if reachable or time.monotonic() >= deadline:
+                return reachable
+
+
+def wait_for_reachable(ip, port=SSH_PORT, timeout=180) -> bool:
+    """Waits until `port` of `ip` accepts connections, returns False on timeout"""
+    with Prober(port) as prober:
+        prober.add(ip)
+        return bool(prober.poll(timeout))
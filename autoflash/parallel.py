@@ -0,0 +1,150 @@
+import glob
+import time
+import asyncio
+import logging
+import threading
+from pathlib import Path
+from dataclasses import dataclass
+from . import log
+
+
+@dataclass
+class PortResult:
+    port: str
+    ok: bool = False
+    duration: float = 0.0
+    detail: str = ""
+
+
+def expand_ports(patterns: list[str]) -> list[str]:
+    """
+    Expands serial port arguments like `/dev/ttyUSB*` into a sorted list of
+    ports. Arguments without glob characters are passed through unchanged.
+    """
+    ports = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            logging.warning(f"No serial ports match '{pattern}'")
+        for port in matches:
+            if port not in ports:
+                ports.append(port)
+    return ports
+
+
+def port_name(port: str) -> str:
+    return Path(port).name
+
+
+def _record_result(result: PortResult, start, detail=None, error=None):
+    result.duration = time.monotonic() - start
+    if error is None:
+        result.ok = True
+        result.detail = str(detail) if detail is not None else ""
+    else:
+        logging.error(f"Flashing on {result.port} failed", exc_info=error)
+        result.detail = str(error) or type(error).__name__
+
+
+def _run_port(port, flash, result: PortResult):
+    log.set_port(port_name(port))
+    start = time.monotonic()
+    try:
+        detail = flash(port)
+    except Exception as e:
+        _record_result(result, start, error=e)
+    else:
+        _record_result(result, start, detail)
+
+
+async def _run_port_async(port, flash, result: PortResult):
+    log.set_port(port_name(port))
+    start = time.monotonic()
+    try:
+        detail = await flash(port)
+    except Exception as e:
+        _record_result(result, start, error=e)
+    else:
+        _record_result(result, start, detail)
+
+
+def _add_log_files(ports, log_dir: Path):
+    if not log_dir:
+        return []
+    log_dir.mkdir(parents=True, exist_ok=True)
+    return [log.add_port_log_file(port_name(port), log_dir) for port in ports]
+
+
+def _remove_log_files(handlers):
+    for handler in handlers:
+        logging.getLogger().removeHandler(handler)
+        handler.close()
+
+
+def run_on_ports(ports: list[str], flash, log_dir: Path = None) -> list[PortResult]:
+    """
+    Runs `flash(port)` for every port concurrently, one thread per port.
+
+    Log records are tagged with the port name (see `log.PARALLEL_FORMAT`) and,
+    if `log_dir` is given, additionally written to a `<port>.log` file per port.
+    The return value of `flash` is shown in the result table.
+    """
+    results = [PortResult(port) for port in ports]
+    handlers = _add_log_files(ports, log_dir)
+
+    threads = [
+        threading.Thread(
+            target=_run_port, name=port_name(port), args=(port, flash, result)
+        )
+        for port, result in zip(ports, results)
+    ]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        _remove_log_files(handlers)
+
+    return results
+
+
+async def run_on_ports_async(
+    ports: list[str], flash, log_dir: Path = None
+) -> list[PortResult]:
+    """Like `run_on_ports`, but `flash` is a coroutine function and all ports share one event loop"""
+    results = [PortResult(port) for port in ports]
+    handlers = _add_log_files(ports, log_dir)
+
+    try:
+        await asyncio.gather(
+            *(
+                _run_port_async(port, flash, result)
+                for port, result in zip(ports, results)
+            )
+        )
+    finally:
+        _remove_log_files(handlers)
+
+    return results
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}:{seconds:02d}"
+
+
+def print_results(results: list[PortResult]):
+    rows = [("Port", "Result", "Duration", "Details")]
+    for r in results:
+        rows.append(
+            (r.port, "OK" if r.ok else "FAILED", format_duration(r.duration), r.detail)
+        )
+
+    widths = [max(len(row[i]) for row in rows) for i in range(3)]
+    print()
+    for row in rows:
+        print("  ".join(col.ljust(w) for col, w in zip(row, widths)) + "  " + row[3])
+
+    ok = sum(r.ok for r in results)
+    print(f"\n{ok}/{len(results)} APs flashed successfully")
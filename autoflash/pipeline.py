@@ -0,0 +1,186 @@
+"""
+Look-ahead for the flashing station: the next APs of a port are prepared
+while its current AP is flashed, so an AP that is powered on only waits for
+the device-bound phases.
+
+What a preparation does is up to the caller, eg. `flash_autoconf` claims an
+image of the pool, hashes it, prints its labels and leases an IP. Up to
+`depth` prepared jobs are kept per port. Every job is prepared under a
+holder of its own, one of the slots `<port>+1` to `<port>+<depth>`, and
+handed over to the port when it is taken, which frees its slot. After a
+crash, the next run resumes the port's current job first, like without
+look-ahead, and then the prepared ones, as it prepares under the same
+slots. Prepared jobs are renewed before their claims expire, and returned
+when the pipeline is closed. A failed flash only gives up its own job, the
+prepared ones stay queued.
+"""
+
+import time
+import logging
+import threading
+import collections
+from .parallel import port_name
+
+# Seconds after which prepared jobs are renewed, well within `imagepool.CLAIM_TIMEOUT`
+RENEW_INTERVAL = 600
+
+
+class Pipeline:
+    def __init__(self, port: str, prepare, hand_over, release, depth=1):
+        """
+        `prepare(holder)` returns a new job claimed by `holder`,
+        `hand_over(job, holder, new_holder)` passes it on and renews it, and
+        returns False if `holder` lost it, `release(job)` returns it unused
+        """
+        self.port = port
+        self.depth = depth
+        self._prepare = prepare
+        self._hand_over = hand_over
+        self._release = release
+        # [holder, slot, job, renewed_at] per prepared job, oldest first
+        self._jobs = collections.deque()
+        self._free_slots = set(range(1, depth + 1))
+        self._first = True
+        self._preparing = False
+        # After a failed preparation, the next one is left to `take`
+        self._failed = False
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name=port_name(port), daemon=True
+        )
+
+    def _holder(self) -> tuple[str, int]:
+        """Returns the holder for the next job and its slot, None for the port itself"""
+        if self._first:
+            # Resumes the job a crashed run left on the port, see `ImagePool.claim`
+            self._first = False
+            return self.port, None
+        slot = min(self._free_slots)
+        self._free_slots.remove(slot)
+        return f"{self.port}+{slot}", slot
+
+    def _free(self, slot: int):
+        if slot is not None:
+            with self._cond:
+                self._free_slots.add(slot)
+                self._cond.notify_all()
+
+    def _wants_job(self) -> bool:
+        # A taken job's slot is only free once it is handed over
+        return (
+            not self._failed
+            and len(self._jobs) < self.depth
+            and (self._first or bool(self._free_slots))
+        )
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._stopped or self._wants_job(), timeout=RENEW_INTERVAL
+                )
+                if self._stopped:
+                    self._preparing = False
+                    self._cond.notify_all()
+                    return
+                holder, slot = self._holder() if self._wants_job() else (None, None)
+                self._preparing = holder is not None
+
+            self._renew()
+            if holder is None:
+                continue
+
+            start = time.monotonic()
+            try:
+                job = self._prepare(holder)
+            except Exception as e:
+                logging.error(f"Preparing the next flash failed: {e}")
+                job = None
+            else:
+                logging.info(
+                    f"Prepared the next flash in {time.monotonic() - start:.1f}s"
+                )
+
+            with self._cond:
+                self._preparing = False
+                if job is None:
+                    self._failed = True
+                    self._free(slot)
+                else:
+                    self._jobs.append([holder, slot, job, time.monotonic()])
+                self._cond.notify_all()
+
+    def _renew(self):
+        with self._cond:
+            due = [
+                entry
+                for entry in self._jobs
+                if time.monotonic() - entry[3] >= RENEW_INTERVAL
+            ]
+
+        for entry in due:
+            holder, slot, job, _ = entry
+            renewed = self._hand_over(job, holder, holder)
+            with self._cond:
+                if renewed:
+                    entry[3] = time.monotonic()
+                elif entry in self._jobs:
+                    logging.warning(f"Lost prepared job {job}, preparing another one")
+                    self._jobs.remove(entry)
+                    self._free(slot)
+                    self._cond.notify_all()
+
+    def _refill(self):
+        with self._cond:
+            self._failed = False
+            self._cond.notify_all()
+
+    def take(self):
+        """
+        Returns the oldest prepared job, handed over to the port. If none is
+        ready, one is prepared, which raises if that fails.
+        """
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._jobs or not self._preparing)
+                entry = self._jobs.popleft() if self._jobs else None
+
+            if entry is None:
+                job = self._prepare(self.port)
+                self._refill()
+                return job
+
+            holder, slot, job, _ = entry
+            handed_over = holder == self.port or self._hand_over(job, holder, self.port)
+            self._free(slot)
+            self._refill()
+            if handed_over:
+                return job
+            logging.warning(f"Lost prepared job {job}, taking the next one")
+
+    def start(self):
+        # The first job is prepared under the port itself, so `take` must wait
+        # for it instead of claiming the same image again
+        with self._cond:
+            self._preparing = True
+        self._thread.start()
+        return self
+
+    def close(self):
+        """Stops preparing and returns the prepared jobs"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join()
+
+        while self._jobs:
+            _, slot, job, _ = self._jobs.popleft()
+            self._release(job)
+            self._free(slot)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,429 @@
+"""
+Simulated Huawei AP on a pseudo-terminal.
+
+The simulator speaks the serial dialogue `interaction.uboot` and
+`interaction.openwrt` expect: U-Boot with autoboot interruption and
+password, `run ramboot`, the kernel boot log, the OpenWrt shell and
+sysupgrade followed by a reboot into the installed firmware.
+`setenv baudrate` in U-Boot and `stty` in OpenWrt switch the console's baud
+rate; while the rate set on the port doesn't match, the AP's output is
+garbled and its input is lost, like on a real serial line.
+The sysupgrade image is downloaded for real when the HTTP delivery of
+`imageserver` is used; scp is not simulated.
+"""
+
+import os
+import re
+import pty
+import tty
+import time
+import termios
+import queue
+import random
+import select
+import hashlib
+import logging
+import threading
+import urllib.request
+
+UBOOT_BANNER = (
+    "\r\n\r\nU-Boot 1.1.4 (Simulated AP)\r\n\r\nDRAM:  128 MB\r\nFlash: 16 MB\r\n"
+)
+UBOOT_PROMPT = "ar7240> "
+SHELL_PROMPT = "root@OpenWrt:/# "
+
+# Possible faults, values in `faults` are the probability of each one
+FAULT_RAMBOOT_FAIL = "ramboot_fail"
+FAULT_BOOT_HANG = "boot_hang"
+FAULT_GARBAGE = "garbage"
+FAULT_CORRUPT_DOWNLOAD = "corrupt_download"
+FAULTS = (FAULT_RAMBOOT_FAIL, FAULT_BOOT_HANG, FAULT_GARBAGE, FAULT_CORRUPT_DOWNLOAD)
+
+
+# termios speed constants by baud rate
+_TERMIOS_BAUDRATES = {
+    getattr(termios, f"B{rate}"): rate
+    for rate in (1200, 2400, 4800, 9600, 19200, 38400, 57600, 115200, 230400)
+    if hasattr(termios, f"B{rate}")
+}
+
+
+class _Reboot(Exception):
+    pass
+
+
+class _Stopped(Exception):
+    pass
+
+
+class SimulatedAP:
+    """
+    An AP that boots as soon as it is started. Connect to it using `port`.
+
+    `baudrate` limits the output rate like a real serial line (None for no
+    limit), all boot delays are multiplied by `time_scale`. The console starts
+    at `console_baudrate` after every reset.
+    """
+
+    def __init__(
+        self,
+        password="admin@huawei.com",
+        baudrate=9600,
+        time_scale=1.0,
+        faults: dict = None,
+        seed=None,
+        power_on_delay=1.0,
+        boot_log_lines=150,
+        console_baudrate=9600,
+    ):
+        self.password = password
+        self.baudrate = baudrate
+        self.time_scale = time_scale
+        self.faults = faults or {}
+        self.power_on_delay = power_on_delay
+        self.boot_log_lines = boot_log_lines
+        self.console_baudrate = console_baudrate
+        self._line_baudrate = console_baudrate
+        self._throttle_baudrate = baudrate
+        self.env = {}
+        # Survives power cycles, written by `saveenv`
+        self.saved_env = {}
+        self.installed_sha256 = None
+        # Content of /etc/autoflash-image on the installed firmware
+        self.image_marker = None
+        self.sysupgrades = 0
+        self._downloaded_sha256 = None
+
+        self._random = random.Random(seed)
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._input = queue.Queue()
+        self._stopped = threading.Event()
+        self._power_cycled = threading.Event()
+        self._threads = [
+            threading.Thread(target=self._read_input, daemon=True),
+            threading.Thread(target=self._run, daemon=True),
+        ]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def power_cycle(self):
+        """Simulates unplugging the AP and plugging in the next one"""
+        self._power_cycled.set()
+
+    def receive_file(self, data: bytes):
+        """Stores `data` as the sysupgrade image in /tmp, in place of scp, which isn't simulated"""
+        self._downloaded_sha256 = hashlib.sha256(data).hexdigest()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    # I/O
+
+    def _read_input(self):
+        while not self._stopped.is_set():
+            readable, _, _ = select.select([self._master], [], [], 0.1)
+            if readable:
+                garbled = self._garbled()
+                for byte in os.read(self._master, 1024):
+                    if not garbled:
+                        self._input.put(bytes([byte]))
+
+    def _port_baudrate(self):
+        """The baud rate the host set on the port"""
+        speed = termios.tcgetattr(self._slave)[5]
+        return _TERMIOS_BAUDRATES.get(speed)
+
+    def _garbled(self):
+        return self._port_baudrate() != self._line_baudrate
+
+    def _set_line_baudrate(self, baudrate):
+        self._line_baudrate = baudrate
+        if self._throttle_baudrate:
+            self.baudrate = baudrate * self._throttle_baudrate // self.console_baudrate
+
+    def _send(self, text):
+        data = text.encode("utf-8") if isinstance(text, str) else text
+        if self._garbled():
+            data = bytes(0x80 | self._random.getrandbits(7) for _ in data)
+        if not self.baudrate:
+            os.write(self._master, data)
+            return
+
+        # 8N1: 10 bits per byte
+        chunk_size = max(1, self.baudrate // 1000)
+        for i in range(0, len(data), chunk_size):
+            chunk = data[i : i + chunk_size]
+            os.write(self._master, chunk)
+            self._wait(len(chunk) * 10 / self.baudrate)
+
+    def _wait(self, seconds):
+        if self._stopped.wait(seconds):
+            raise _Stopped()
+        self._check_power_cycled()
+
+    def _check_power_cycled(self):
+        if self._power_cycled.is_set():
+            self._power_cycled.clear()
+            self.env = dict(self.saved_env)
+            raise _Reboot()
+
+    def _sleep(self, seconds):
+        self._wait(seconds * self.time_scale)
+
+    def _read_char(self, timeout):
+        deadline = time.monotonic() + timeout
+        while not self._stopped.is_set():
+            try:
+                return self._input.get(
+                    timeout=min(0.1, max(0, deadline - time.monotonic()))
+                )
+            except queue.Empty:
+                self._check_power_cycled()
+                if time.monotonic() >= deadline:
+                    return None
+        raise _Stopped()
+
+    def _read_line(self, echo=True) -> str:
+        line = b""
+        while True:
+            char = self._read_char(timeout=0.5)
+            if char is None:
+                continue
+            if char in b"\r\n":
+                if echo:
+                    self._send("\r\n")
+                return line.decode("utf-8", errors="ignore")
+            line += char
+            if echo:
+                self._send(char)
+
+    def _discard_input(self):
+        while not self._input.empty():
+            self._input.get_nowait()
+
+    def _fault(self, name):
+        return self._random.random() < self.faults.get(name, 0)
+
+    # Dialogue
+
+    def _run(self):
+        try:
+            try:
+                self._wait(self.power_on_delay)
+            except _Reboot:
+                pass
+            while True:
+                try:
+                    self._boot()
+                except _Reboot:
+                    pass
+        except _Stopped:
+            pass
+        except OSError:
+            logging.exception("Simulated AP crashed")
+
+    def _boot(self):
+        self._set_line_baudrate(self.console_baudrate)
+        self._sleep(0.5)
+        self._send(UBOOT_BANNER)
+        self._send("Press f or F  to stop Auto-Boot in 3 seconds\r\n")
+        self._discard_input()
+
+        deadline = time.monotonic() + 3 * self.time_scale
+        while (remaining := deadline - time.monotonic()) > 0:
+            char = self._read_char(remaining)
+            if char in (b"f", b"F"):
+                self._uboot_login()
+                self._uboot_shell()
+                return
+        self._boot_kernel(ramboot=False)
+
+    def _uboot_login(self):
+        while True:
+            self._send("\r\nPassword for uboot cmd line :")
+            if self._read_line(echo=False) == self.password:
+                self._send(f"\r\n{UBOOT_PROMPT}")
+                return
+            self._send("\r\nPassword error\r\n")
+
+    def _uboot_shell(self):
+        while True:
+            # Like U-Boot, run commands separated by ';' one after the other
+            for cmd in self._read_line().split(";"):
+                cmd = cmd.strip()
+                if m := re.fullmatch(r"setenv baudrate (\d+)", cmd):
+                    self._switch_uboot_baudrate(int(m.group(1)))
+                elif m := re.fullmatch(r"setenv (\S+) (.*)", cmd):
+                    self.env[m.group(1)] = m.group(2)
+                elif m := re.fullmatch(r"printenv (\S+)", cmd):
+                    if m.group(1) in self.env:
+                        self._send(f"{m.group(1)}={self.env[m.group(1)]}\r\n")
+                    else:
+                        self._send(f'## Error: "{m.group(1)}" not defined\r\n')
+                elif cmd == "saveenv":
+                    self._send("Saving Environment to Flash...\r\nErasing Flash...")
+                    self._sleep(0.5)
+                    self._send("done\r\nWriting to Flash... done\r\n")
+                    self.saved_env = dict(self.env)
+                elif cmd == "boot":
+                    self._boot_kernel(ramboot=False)
+                    return
+                elif cmd == "run ramboot":
+                    if self._tftp_ramboot():
+                        self._boot_kernel(ramboot=True)
+                        return
+                elif cmd:
+                    self._send(f"Unknown command '{cmd}' - try 'help'\r\n")
+            self._send(UBOOT_PROMPT)
+
+    def _switch_uboot_baudrate(self, baudrate):
+        self._send(f"## Switch baudrate to {baudrate} bps and press ENTER ...\r\n")
+        self._set_line_baudrate(baudrate)
+        while self._read_char(timeout=0.5) != b"\r":
+            pass
+
+    def _tftp_ramboot(self):
+        self._send(
+            "dev=eth0\r\nUsing eth0 device\r\n"
+            f"TFTP from server {self.env.get('serverip')}; "
+            f"our IP address is {self.env.get('ipaddr')}\r\n"
+            f"Filename '{self.env.get('rambootfile')}'.\r\nLoading: "
+        )
+        for _ in range(10):
+            self._sleep(0.3)
+            self._send("#")
+
+        if self._fault(FAULT_RAMBOOT_FAIL):
+            self._send(
+                "\r\nRetry count exceeded; starting again\r\nExecute ramboot Fail\r\n"
+            )
+            return False
+
+        self._send("\r\ndone\r\nBytes transferred = 4194304 (400000 hex)\r\n")
+        return True
+
+    def _boot_kernel(self, ramboot):
+        self._send("## Booting image at 81000000 ...\r\nStarting kernel ...\r\n\r\n")
+        # The kernel's console starts at the default rate, not at U-Boot's
+        self._set_line_baudrate(self.console_baudrate)
+        self._sleep(0.5)
+        self._send(
+            "[    0.000000] Linux version 5.15.150 (builder@buildhost) "
+            "(mips-openwrt-linux-musl-gcc 12.3.0) #0 Sat Jan 1 00:00:00 2024\r\n"
+        )
+
+        hang = self._fault(FAULT_BOOT_HANG)
+        for i in range(self.boot_log_lines):
+            self._sleep(10 / self.boot_log_lines)
+            if hang and i == self.boot_log_lines // 2:
+                while not self._stopped.wait(0.1):
+                    self._check_power_cycled()
+                raise _Stopped()
+            if self._fault(FAULT_GARBAGE):
+                self._send(bytes(self._random.getrandbits(8) for _ in range(16)))
+            self._send(f"[{1 + i * 0.1:12.6f}] simulated boot message {i}\r\n")
+
+        self._send("[   20.000000] eth0: link up (1000Mbps/Full duplex)\r\n")
+        self._send("Please press Enter to activate this console.\r\n")
+        self._discard_input()
+        self._read_line(echo=False)
+        self._send(
+            f"\r\n\r\nBusyBox v1.36.1 built-in shell (ash)\r\n\r\n"
+            f"{'OpenWrt (ramboot)' if ramboot else 'OpenWrt'}\r\n\r\n{SHELL_PROMPT}"
+        )
+        self._openwrt_shell(ramboot)
+
+    def _openwrt_shell(self, ramboot):
+        while True:
+            cmd = self._read_line().strip()
+            if cmd.startswith("while ! ip link show br-lan"):
+                self._sleep(2)
+                self._send(
+                    "[   25.000000] br-lan: port 1(eth0) entered forwarding state\r\n"
+                )
+            elif cmd.startswith("/etc/init.d/network restart"):
+                self._sleep(1)
+            elif '"AUTOFLASH""_FIRMWARE"' in cmd:
+                marker = None if ramboot else self.image_marker
+                self._send(
+                    f"AUTOFLASH_FIRMWARE={marker or 'none'} OpenWrt 23.05.3 r23809\r\n"
+                )
+            elif m := re.match(r"echo (\S+) > /etc/autoflash-image", cmd):
+                if not ramboot:
+                    self.image_marker = m.group(1)
+                self._send("AUTOFLASH_MARKED\r\n")
+            elif '"AUTOFLASH""_CHECKSUM' in cmd:
+                self._verify(cmd)
+            elif "/proc/mounts" in cmd:
+                self._send(
+                    "AUTOFLASH_RAMBOOT\r\n" if ramboot else "AUTOFLASH_INSTALLED\r\n"
+                )
+            elif cmd == "reboot":
+                self._sleep(1)
+                self._send("reboot: Restarting system\r\n")
+                raise _Reboot()
+            elif m := re.fullmatch(r"stty (\d+)", cmd):
+                self._set_line_baudrate(int(m.group(1)))
+            elif "wget" in cmd:
+                self._download(cmd)
+            elif cmd.startswith("sysupgrade"):
+                self._sysupgrade(cmd)
+            elif cmd and not cmd.startswith("uci "):
+                self._send(f"-ash: {cmd.split()[0]}: not found\r\n")
+            self._send(SHELL_PROMPT)
+
+    def _download(self, cmd):
+        url = re.search(r"wget -q -O (\S+) (\S+)", cmd).group(2)
+        expected = re.search(r'echo "([0-9a-f]{64})  ', cmd).group(1)
+
+        with urllib.request.urlopen(url) as response:
+            data = response.read()
+        if self._fault(FAULT_CORRUPT_DOWNLOAD):
+            data = data[:-1]
+
+        self._downloaded_sha256 = hashlib.sha256(data).hexdigest()
+        if self._downloaded_sha256 == expected:
+            self._send("AUTOFLASH_DOWNLOAD_OK\r\n")
+        else:
+            self._send(
+                "sha256sum: WARNING: 1 of 1 computed checksums did NOT match\r\n"
+            )
+            self._send("AUTOFLASH_DOWNLOAD_FAILED\r\n")
+
+    def _verify(self, cmd):
+        expected, path = re.search(r'echo "([0-9a-f]{64})  (\S+)"', cmd).groups()
+        if self._downloaded_sha256 == expected:
+            self._send("AUTOFLASH_CHECKSUM_OK\r\n")
+        elif self._downloaded_sha256 is None:
+            self._send(f"sha256sum: {path}: No such file or directory\r\n")
+            self._send("AUTOFLASH_CHECKSUM_FAILED\r\n")
+        else:
+            self._send(f"{self._downloaded_sha256}  {path}\r\n")
+            self._send("AUTOFLASH_CHECKSUM_FAILED\r\n")
+
+    def _sysupgrade(self, cmd):
+        self._send("Commencing upgrade. Closing all shell sessions.\r\n")
+        self._sleep(5)
+        self._send("Writing from <stdin> to firmware ...\r\n")
+        self._sleep(10)
+        self._send("Upgrade completed\r\nRebooting system...\r\n")
+        self.installed_sha256 = self._downloaded_sha256
+        # sysupgrade -n doesn't keep any files
+        self.image_marker = None
+        self.sysupgrades += 1
+        raise _Reboot()
@@ -0,0 +1,286 @@
+"""
+Minimal read-only TFTP server for serving ramboot images.
+
+Supports the blksize, tsize, timeout (RFC 2348/2349) and windowsize
+(RFC 7440) options. Files are read once and served from memory, so many
+APs can fetch the same image concurrently.
+"""
+
+import time
+import stat
+import socket
+import struct
+import logging
+import threading
+from pathlib import Path
+from . import TFTP_IP
+
+OP_RRQ = 1
+OP_WRQ = 2
+OP_DATA = 3
+OP_ACK = 4
+OP_ERROR = 5
+OP_OACK = 6
+
+ERR_NOT_DEFINED = 0
+ERR_FILE_NOT_FOUND = 1
+ERR_ACCESS_VIOLATION = 2
+ERR_ILLEGAL_OPERATION = 4
+ERR_OPTION_NEGOTIATION = 8
+
+DEFAULT_BLKSIZE = 512
+MAX_BLKSIZE = 65464
+MAX_WINDOWSIZE = 64
+DEFAULT_TIMEOUT = 1
+MAX_RETRIES = 5
+
+
+class TftpError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+def _parse_request(packet: bytes):
+    fields = packet[2:].split(b"\0")
+    if len(fields) < 3:
+        raise TftpError(ERR_ILLEGAL_OPERATION, "Malformed request")
+
+    filename, mode, *raw_options = (
+        field.decode("ascii", errors="replace") for field in fields[:-1]
+    )
+    options = {
+        name.lower(): value for name, value in zip(raw_options[::2], raw_options[1::2])
+    }
+    return filename, mode.lower(), options
+
+
+def _error_packet(code, message):
+    return struct.pack("!HH", OP_ERROR, code) + message.encode("ascii") + b"\0"
+
+
+class FileCache:
+    """Keeps files of the TFTP root in memory, reloading them when they change"""
+
+    def __init__(self, root: Path):
+        self.root = root.resolve()
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def get(self, filename: str) -> bytes:
+        path = (self.root / filename.lstrip("/")).resolve()
+        if not path.is_relative_to(self.root):
+            raise TftpError(ERR_ACCESS_VIOLATION, "Access violation")
+
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            raise TftpError(ERR_FILE_NOT_FOUND, "File not found")
+        # eg. an empty file name or a subdirectory
+        if not stat.S_ISREG(st.st_mode):
+            raise TftpError(ERR_FILE_NOT_FOUND, "File not found")
+        mtime = st.st_mtime_ns
+
+        with self._lock:
+            cached = self._files.get(path)
+            if cached is None or cached[0] != mtime:
+                logging.debug(f"TFTP: loading {path} into memory")
+                cached = self._files[path] = (mtime, path.read_bytes())
+            return cached[1]
+
+
+class Transfer:
+    def __init__(self, client, data: bytes, filename: str, options: dict, host: str):
+        self.client = client
+        self.data = data
+        self.filename = filename
+        self.blksize = DEFAULT_BLKSIZE
+        self.windowsize = 1
+        self.timeout = DEFAULT_TIMEOUT
+        self.oack = self._negotiate(options)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, 0))
+        self.sock.settimeout(self.timeout)
+
+    def _negotiate(self, options: dict) -> dict:
+        """Returns the accepted options, which are acknowledged with an OACK"""
+        accepted = {}
+        try:
+            if "blksize" in options:
+                self.blksize = min(max(int(options["blksize"]), 8), MAX_BLKSIZE)
+                accepted["blksize"] = self.blksize
+            if "windowsize" in options:
+                self.windowsize = min(
+                    max(int(options["windowsize"]), 1), MAX_WINDOWSIZE
+                )
+                accepted["windowsize"] = self.windowsize
+            if "timeout" in options:
+                self.timeout = min(max(int(options["timeout"]), 1), 255)
+                accepted["timeout"] = self.timeout
+            if "tsize" in options:
+                accepted["tsize"] = len(self.data)
+        except ValueError:
+            raise TftpError(ERR_OPTION_NEGOTIATION, "Invalid option value")
+        return accepted
+
+    def _send_and_wait_for_ack(self, packets, expected_blocks):
+        """
+        Sends `packets` and waits for an ACK of one of `expected_blocks`
+        (block numbers mod 65536). Returns the index of the ACKed block.
+        """
+        for _ in range(MAX_RETRIES):
+            for packet in packets:
+                self.sock.sendto(packet, self.client)
+
+            deadline = time.monotonic() + self.timeout
+            while (remaining := deadline - time.monotonic()) > 0:
+                self.sock.settimeout(remaining)
+                try:
+                    packet, addr = self.sock.recvfrom(4 + MAX_BLKSIZE)
+                except socket.timeout:
+                    break
+                if addr != self.client or len(packet) < 4:
+                    continue
+
+                opcode, block = struct.unpack("!HH", packet[:4])
+                if opcode == OP_ERROR:
+                    message = packet[4:].rstrip(b"\0").decode("ascii", "replace")
+                    raise TftpError(block, f"Client aborted transfer: {message}")
+                if opcode == OP_ACK and block in expected_blocks:
+                    return expected_blocks.index(block)
+
+        raise TftpError(ERR_NOT_DEFINED, "Timeout waiting for ACK")
+
+    def run(self):
+        start = time.monotonic()
+        size = len(self.data)
+        block_count = size // self.blksize + 1
+        logging.info(
+            f"TFTP: sending {self.filename} ({size} bytes) to {self.client[0]}, "
+            f"blksize {self.blksize}, windowsize {self.windowsize}"
+        )
+
+        try:
+            if self.oack:
+                oack = struct.pack("!H", OP_OACK) + b"".join(
+                    f"{k}\0{v}\0".encode("ascii") for k, v in self.oack.items()
+                )
+                self._send_and_wait_for_ack([oack], [0])
+
+            acked = 0
+            next_report = 0.1
+            while acked < block_count:
+                window = range(acked + 1, min(acked + self.windowsize, block_count) + 1)
+                packets = [
+                    struct.pack("!HH", OP_DATA, b & 0xFFFF)
+                    + self.data[(b - 1) * self.blksize : b * self.blksize]
+                    for b in window
+                ]
+                # The client ACKs the last block it received in order, which
+                # might be any block of the window.
+                acked = window[
+                    self._send_and_wait_for_ack(packets, [b & 0xFFFF for b in window])
+                ]
+
+                if acked / block_count >= next_report:
+                    logging.debug(
+                        f"TFTP: {self.filename} to {self.client[0]}: {acked * 100 // block_count}%"
+                    )
+                    next_report += 0.1
+        except TftpError as e:
+            logging.error(
+                f"TFTP: transfer of {self.filename} to {self.client[0]} failed: {e}"
+            )
+            self.sock.sendto(_error_packet(e.code, str(e)), self.client)
+            return
+        finally:
+            self.sock.close()
+
+        duration = time.monotonic() - start
+        logging.info(
+            f"TFTP: sent {self.filename} to {self.client[0]} in {duration:.1f}s "
+            f"({size / max(duration, 1e-6) / 1024:.0f} KiB/s)"
+        )
+
+
+class TftpServer:
+    """
+    Serves the files in `root` via TFTP from a background thread.
+    Every transfer runs in its own thread with its own socket.
+    """
+
+    def __init__(self, root: Path, host=str(TFTP_IP), port=69):
+        self.cache = FileCache(Path(root))
+        self.host = host
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        # Wake up regularly to notice `stop()`
+        self.sock.settimeout(0.5)
+        self.address = self.sock.getsockname()
+        self._thread = threading.Thread(target=self._serve, name="tftp", daemon=True)
+        self._running = False
+
+    def _handle_request(self, packet: bytes, client):
+        try:
+            opcode = struct.unpack("!H", packet[:2])[0]
+            if opcode != OP_RRQ:
+                raise TftpError(ERR_ILLEGAL_OPERATION, "Only reading is supported")
+
+            filename, mode, options = _parse_request(packet)
+            if mode != "octet":
+                raise TftpError(ERR_ILLEGAL_OPERATION, "Only octet mode is supported")
+
+            transfer = Transfer(
+                client, self.cache.get(filename), filename, options, self.host
+            )
+        except TftpError as e:
+            logging.warning(f"TFTP: rejecting request from {client[0]}: {e}")
+            self._send_error(client, e.code, str(e))
+            return
+        except OSError as e:
+            # eg. an unreadable file or no port left for the transfer, which
+            # must not stop the server
+            logging.error(f"TFTP: request from {client[0]} failed: {e}")
+            if isinstance(e, PermissionError):
+                self._send_error(client, ERR_ACCESS_VIOLATION, "Access violation")
+            else:
+                self._send_error(client, ERR_NOT_DEFINED, "Server error")
+            return
+
+        threading.Thread(target=transfer.run, name="tftp-transfer", daemon=True).start()
+
+    def _send_error(self, client, code, message):
+        try:
+            self.sock.sendto(_error_packet(code, message), client)
+        except OSError as e:
+            logging.warning(f"TFTP: couldn't send error to {client[0]}: {e}")
+
+    def _serve(self):
+        while self._running:
+            try:
+                packet, client = self.sock.recvfrom(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if len(packet) >= 2:
+                self._handle_request(packet, client)
+
+    def start(self):
+        logging.info(f"Starting TFTP server on {self.address[0]}:{self.address[1]}")
+        self._running = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        self.sock.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
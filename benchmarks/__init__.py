@@ -0,0 +1,89 @@
+"""
+Micro-benchmarks of the hot paths: prompt matching, IP leases, label
+rendering and a whole `run_autoflash` against a replayed serial session.
+
+Run all of them with `python -m benchmarks`, which can save the results as
+JSON and compare them against a saved baseline, see `--help`.
+
+A benchmark is a generator function decorated with `benchmark`: it prepares
+everything, yields the function to time and cleans up after the timing.
+"""
+
+import time
+import platform
+import statistics
+import contextlib
+
+# name -> (setup, iterations, repeat)
+BENCHMARKS = {}
+
+# Slowdown of the median against the baseline that counts as a regression
+THRESHOLD = 0.2
+
+
+def register(name: str, setup, iterations=100, repeat=5):
+    """
+    Adds a benchmark. `setup` is a generator function that yields the function
+    to time, which is called `iterations` times in each of `repeat` rounds.
+    """
+    BENCHMARKS[name] = (contextlib.contextmanager(setup), iterations, repeat)
+
+
+def benchmark(name: str, iterations=100, repeat=5):
+    def decorator(setup):
+        register(name, setup, iterations, repeat)
+        return setup
+
+    return decorator
+
+
+def measure(setup, iterations, repeat) -> dict:
+    """Returns the median and the minimum seconds per call over all rounds"""
+    with setup() as run:
+        rounds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(iterations):
+                run()
+            rounds.append((time.perf_counter() - start) / iterations)
+
+    return {
+        "median": statistics.median(rounds),
+        "min": min(rounds),
+        "iterations": iterations,
+        "repeat": repeat,
+    }
+
+
+def run(names=None, scale=1.0) -> dict:
+    """
+    Runs the benchmarks in `names` (default all) with `scale` times their
+    iterations, returns the results in the format of the JSON file
+    """
+    results = {}
+    for name, (setup, iterations, repeat) in BENCHMARKS.items():
+        if names is None or name in names:
+            results[name] = measure(setup, max(1, round(iterations * scale)), repeat)
+    return {
+        "time": time.time(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+
+def compare(results: dict, baseline: dict, threshold=THRESHOLD) -> list[str]:
+    """Returns the names of the benchmarks whose median got slower than `threshold` allows"""
+    regressions = []
+    for name, result in results["results"].items():
+        base = baseline["results"].get(name)
+        if base and result["median"] > base["median"] * (1 + threshold):
+            regressions.append(name)
+    return regressions
+
+
+def format_duration(seconds: float) -> str:
+    for unit, factor in (("s", 1), ("ms", 1e3), ("us", 1e6)):
+        if seconds * factor >= 1:
+            return f"{seconds * factor:.2f} {unit}"
+    return f"{seconds * 1e9:.0f} ns"
@@ -0,0 +1,117 @@
+import sys
+import json
+import logging
+import argparse
+import importlib
+from pathlib import Path
+import benchmarks
+
+MODULES = ["prompts", "leases", "labels", "flash"]
+
+
+def load_modules():
+    for module in MODULES:
+        try:
+            importlib.import_module(f"benchmarks.{module}")
+        except ImportError as e:
+            # eg. the label printer's dependencies are not installed
+            print(f"Skipping benchmarks.{module}: {e}", file=sys.stderr)
+
+
+def print_results(results: dict, baseline: dict = None, regressions=()):
+    width = max(map(len, results["results"]), default=0)
+    for name, result in results["results"].items():
+        line = (
+            f"{name:<{width}} {benchmarks.format_duration(result['median']):>10} "
+            f"(min {benchmarks.format_duration(result['min'])})"
+        )
+        base = baseline and baseline["results"].get(name)
+        if base:
+            change = result["median"] / base["median"] - 1
+            line += f"  {change:+7.1%}"
+            if name in regressions:
+                line += "  REGRESSION"
+        print(line)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog="benchmarks",
+        description="Micro-benchmarks of the hot paths, prints the median and minimum time per call",
+    )
+    parser.add_argument(
+        "-k",
+        "--filter",
+        action="append",
+        help="Only run benchmarks whose name contains this, can be repeated",
+    )
+    parser.add_argument(
+        "--list", action="store_true", help="List the benchmarks and exit"
+    )
+    parser.add_argument(
+        "--session",
+        type=Path,
+        action="append",
+        default=[],
+        help="Also benchmark prompt matching on a session recorded with --capture-dir, "
+        "can be repeated",
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="Factor for the iterations of every benchmark, eg. 0.2 for a quick run",
+    )
+    parser.add_argument("--json", type=Path, help="Write the results to this file")
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        help="Compare with results saved with --json, exit with 1 on regressions",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=benchmarks.THRESHOLD,
+        help="Slowdown of the median that counts as a regression, "
+        f"default is {benchmarks.THRESHOLD}",
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # Keep the log messages of the benchmarked code out of the results
+    logging.basicConfig(level=logging.ERROR)
+
+    load_modules()
+    from benchmarks.prompts import register_session
+
+    for session in args.session:
+        register_session(session)
+
+    names = [
+        name
+        for name in benchmarks.BENCHMARKS
+        if not args.filter or any(f in name for f in args.filter)
+    ]
+    if args.list:
+        print("\n".join(names))
+        return
+
+    baseline = json.loads(args.baseline.read_text()) if args.baseline else None
+    results = benchmarks.run(names, args.scale)
+    regressions = (
+        benchmarks.compare(results, baseline, args.threshold) if baseline else []
+    )
+    print_results(results, baseline, regressions)
+
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2) + "\n")
+    if regressions:
+        print(f"{len(regressions)} regression(s) against {args.baseline}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
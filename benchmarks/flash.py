@@ -0,0 +1,30 @@
+"""
+A whole `run_autoflash` without a sysupgrade image, against a synthetic
+session of an AP that is rambooted from power on, replayed without delays.
+This includes what the dialogue waits for on purpose, eg. for the console
+to be quiet before typing, so it catches added round trips and waits.
+"""
+
+import tempfile
+from pathlib import Path
+from unittest import mock
+import autoflash
+from autoflash.capture import ReplaySerial
+from . import benchmark
+from .sessions import write_ramboot_session
+
+
+@benchmark("flash.run_autoflash.ramboot", iterations=3, repeat=3)
+def run_autoflash_ramboot():
+    with tempfile.TemporaryDirectory() as tmp:
+        session = Path(tmp) / "ramboot.session.gz"
+        write_ramboot_session(session)
+
+        def open_port(port, speed, timeout):
+            return ReplaySerial(session, speed=0, timeout=timeout)
+
+        def run():
+            autoflash.run_autoflash("ramboot.bin", port="bench", speed=9600)
+
+        with mock.patch("autoflash.serial.Serial", open_port):
+            yield run
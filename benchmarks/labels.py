@@ -0,0 +1,72 @@
+"""
+Micro-benchmark of rendering and encoding a label pair, like `flash_autoconf` does for every AP.
+
+Run with `python -m benchmarks.labels`, the single steps are also part of
+`python -m benchmarks`.
+"""
+
+import time
+import argparse
+from labelprinter import labels, printer
+from . import benchmark
+
+
+def render_wifi():
+    return labels.render_wifi(ssid="stuttgart-EX", password="Faem3heiweetae6e")
+
+
+def render_login():
+    return labels.render_login(
+        ip="192.168.0.1", password="eeG1phoo", bootloader_pw="dasuboot"
+    )
+
+
+@benchmark("labels.render_wifi", iterations=20)
+def bench_render_wifi():
+    yield render_wifi
+
+
+@benchmark("labels.render_login", iterations=20)
+def bench_render_login():
+    yield render_login
+
+
+@benchmark("labels.format_surface", iterations=20)
+def bench_format_surface():
+    surface = render_wifi()
+    yield lambda: printer.format_surface(surface)
+
+
+def render_label_pair():
+    return render_wifi(), render_login()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="benchmarks.labels", description="Label rendering micro-benchmark"
+    )
+    parser.add_argument(
+        "-n",
+        "--iterations",
+        type=int,
+        default=50,
+        help="Number of label pairs, default is 50",
+    )
+    args = parser.parse_args()
+
+    timings = {"render": 0.0, "format_surface": 0.0}
+    for _ in range(args.iterations):
+        start = time.perf_counter()
+        surfaces = render_label_pair()
+        rendered = time.perf_counter()
+        for surf in surfaces:
+            printer.format_surface(surf)
+        timings["render"] += rendered - start
+        timings["format_surface"] += time.perf_counter() - rendered
+
+    for name, total in timings.items():
+        print(f"{name:<16} {total * 1000 / args.iterations:8.2f} ms per label pair")
+
+
+if __name__ == "__main__":
+    main()
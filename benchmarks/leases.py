@@ -0,0 +1,49 @@
+"""
+`ips.get_free_ip` when nearly every IP of the network is leased, so every
+claim has to fall back to the expired leases.
+"""
+
+import time
+import tempfile
+import ipaddress
+from pathlib import Path
+from autoflash import ips
+from . import benchmark
+
+NETWORK = ipaddress.IPv4Network("10.0.0.0/22")
+# Leases that expired, all others are held by other ports
+FREE = 8
+
+
+@benchmark("leases.get_free_ip.nearly_full", iterations=200)
+def get_free_ip_nearly_full():
+    with tempfile.TemporaryDirectory() as tmp:
+        ips.configure(db_path=Path(tmp) / "ips.sqlite", network=NETWORK)
+        hosts = list(NETWORK.hosts())
+        now = time.time()
+        con = ips._connection()
+        con.executemany(
+            "INSERT INTO leases (network, ip, holder, expires) VALUES (?, ?, ?, ?)",
+            (
+                (
+                    str(NETWORK),
+                    int(ip),
+                    f"port{i % 16}",
+                    now - 60 if i < FREE else now + ips.LEASE_TIME,
+                )
+                for i, ip in enumerate(hosts)
+            ),
+        )
+        # Every IP was handed out before
+        con.execute(
+            "INSERT INTO pools (network, next_ip) VALUES (?, ?)",
+            (str(NETWORK), int(hosts[-1]) + 1),
+        )
+        reserved = [ipaddress.IPv4Address(int(hosts[0]) + i) for i in range(4)]
+
+        def run():
+            ips.release_ip(ips.get_free_ip(reserved))
+
+        yield run
+        # Don't leave the connection to the deleted database behind
+        ips.configure(db_path="ips.sqlite")
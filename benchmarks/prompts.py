@@ -0,0 +1,96 @@
+"""
+Prompt matching with `serial.wait_for_prompt_match` on a synthetic boot log
+and on recorded sessions (see `capture`), read in chunks of several sizes:
+a slow console hands out a few bytes per read, a fast one whole buffers.
+"""
+
+from pathlib import Path
+import autoflash.interaction.serial as serial
+import autoflash.interaction.uboot as uboot
+from autoflash.capture import read_session, READ
+from . import benchmark, register
+from .sessions import boot_log
+
+CHUNK_SIZES = (1, 16, 256, 4096)
+
+# Not in any session, so the whole stream is searched, with a prompt-like regex
+PROMPT_MISSING = r"root@\S+:\S+# AUTOFLASH_BENCHMARK"
+
+
+class EndOfStream(Exception):
+    pass
+
+
+class ChunkedSerial:
+    """Hands out `data` in reads of at most `chunk_size` bytes, in place of a `serial.Serial`"""
+
+    def __init__(self, data: bytes, chunk_size: int):
+        self.data = data
+        self.chunk_size = chunk_size
+        self.position = 0
+
+    def inWaiting(self) -> int:
+        return min(self.chunk_size, len(self.data) - self.position)
+
+    def read(self, size=1) -> bytes:
+        if self.position >= len(self.data):
+            raise EndOfStream()
+        data = self.data[self.position : self.position + size]
+        self.position += len(data)
+        return data
+
+
+def _match_boot_log(chunk_size):
+    data = boot_log()
+
+    def run():
+        # A new port every time, so every run decodes the stream from the start
+        ser = ChunkedSerial(data, chunk_size)
+        serial.wait_for_prompt_match(ser, uboot.prompts_ramboot())
+
+    yield run
+
+
+def _scan_session(data, chunk_size):
+    def run():
+        try:
+            serial.read_until_match(
+                ChunkedSerial(data, chunk_size), PROMPT_MISSING, timeout=60
+            )
+        except EndOfStream:
+            pass
+
+    yield run
+
+
+for chunk_size in CHUNK_SIZES:
+    register(
+        f"prompts.boot_log.chunk{chunk_size}",
+        lambda chunk_size=chunk_size: _match_boot_log(chunk_size),
+        iterations=2 if chunk_size == 1 else 10,
+    )
+
+
+def register_session(path: Path):
+    """Adds benchmarks that scan what the AP sent in the recorded session at `path`"""
+    data = b"".join(data for _, kind, data in read_session(path) if kind == READ)
+    name = Path(path).name.split(".")[0]
+    for chunk_size in CHUNK_SIZES:
+        register(
+            f"prompts.session.{name}.chunk{chunk_size}",
+            lambda chunk_size=chunk_size: _scan_session(data, chunk_size),
+            iterations=1 if chunk_size == 1 else 5,
+        )
+
+
+@benchmark("prompts.matcher.feed", iterations=1000)
+def matcher_feed():
+    """Only the incremental search, on kernel log lines"""
+    lines = boot_log().decode("ascii").splitlines(keepends=True)[-100:]
+
+    def run():
+        matcher = serial.PromptMatcher(PROMPT_MISSING)
+        for line in lines:
+            matcher.feed(line)
+
+    yield run
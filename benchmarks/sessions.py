@@ -0,0 +1,80 @@
+"""
+Synthetic serial output of an AP, for benchmarks that don't depend on
+hardware or a recorded session.
+"""
+
+from pathlib import Path
+from autoflash.capture import SessionRecorder, READ, WRITE
+
+UBOOT_BANNER = (
+    b"\r\n\r\nU-Boot 1.1.4 (Jan  1 2015 - 00:00:00)\r\n\r\n"
+    b"AP5030DN (ar934x) U-boot\r\nDRAM:  128 MB\r\nTop of RAM usable for U-Boot at: 84000000\r\n"
+    b"Flash Manuf Id 0xc2, DeviceId0 0x20, DeviceId1 0x18\r\nFlash:  16 MB\r\n"
+    b"In:    serial\r\nOut:   serial\r\nErr:   serial\r\nNet:   eth0, eth1\r\n"
+)
+PROMPT_AUTOBOOT = b"Press f or F  to stop Auto-Boot in 3 seconds\r\n"
+PROMPT_PASSWORD = b"\r\nPassword for uboot cmd line :"
+PROMPT_UBOOT = b"\r\nar7240> "
+
+
+def tftp_output(hashes=2000) -> bytes:
+    """U-Boot loading the ramboot image: a single line of `hashes` progress marks"""
+    return (
+        b"dev=eth0\r\nUsing eth0 device\r\n"
+        b"TFTP from server 192.168.1.10; our IP address is 192.168.1.1\r\n"
+        b"Filename 'ramboot.bin'.\r\nLoading: " + b"#" * hashes + b"\r\ndone\r\n"
+        b"Bytes transferred = 4194304 (400000 hex)\r\n"
+        b"## Booting image at 81000000 ...\r\nStarting kernel ...\r\n\r\n"
+    )
+
+
+def kernel_log(lines=1000) -> bytes:
+    """Kernel messages of about the length of an OpenWrt boot"""
+    return b"".join(
+        f"[{i * 0.0123:12.6f}] ath79: driver message {i} for device {i % 7}, "
+        f"value 0x{i * 2654435761 % 2**32:08x}\r\n".encode("ascii")
+        for i in range(lines)
+    )
+
+
+def boot_log() -> bytes:
+    """From power on to the ramboot kernel's messages, ending with the kernel's banner"""
+    return (
+        UBOOT_BANNER
+        + PROMPT_AUTOBOOT
+        + tftp_output()
+        + kernel_log()
+        + b"Linux version 5.15.137 (builder@buildhost) #0 Tue Nov 14 13:38:11 2023\r\n"
+    )
+
+
+def write_ramboot_session(path: Path, password="admin@huawei.com"):
+    """
+    Records the serial session of rambooting an AP from power on, as
+    `run_autoflash` without a sysupgrade image does it
+    """
+    recorder = SessionRecorder(path)
+    for kind, data in (
+        (READ, UBOOT_BANNER + PROMPT_AUTOBOOT),
+        # Probe of the console
+        (WRITE, b"\n"),
+        (WRITE, b"f"),
+        (READ, PROMPT_PASSWORD),
+        (WRITE, f"{password}\n".encode("utf-8")),
+        (READ, b"\r\neth0: link up" + PROMPT_UBOOT),
+        (WRITE, b"\n"),
+        (READ, PROMPT_UBOOT),
+        (WRITE, b"\n"),
+        (READ, PROMPT_UBOOT),
+        (
+            WRITE,
+            b"setenv serverip 192.168.1.10; setenv ipaddr 192.168.1.1; "
+            b"setenv rambootfile ramboot.bin\n",
+        ),
+        (READ, PROMPT_UBOOT),
+        (WRITE, b"run ramboot\n"),
+        (READ, tftp_output() + b"Linux version 5.15.137 (builder@buildhost)\r\n"),
+        (READ, kernel_log()),
+    ):
+        recorder.record(kind, data)
+    recorder.close()
@@ -1,66 +1,176 @@
 import json
-import random
-import shutil
 import logging
-import tempfile
 import argparse
-from autoflash import TFTP_IP
-from autoflash import run_autoflash
-from autoflash.ips import get_free_ip
+import ipaddress
+import contextlib
+from dataclasses import dataclass
+from autoflash import TFTP_IP, IP_NETWORK, OPENWRT_DEFAULT_LAN_IP
+from autoflash import run_autoflash, flash_ap
+from autoflash import daemon
+from autoflash import parallel
+from autoflash import metrics
+from autoflash import history
+from autoflash.tftp import TftpServer
+from autoflash.imageserver import ImageServer
+from autoflash import ips
+from autoflash import netns
+from autoflash.pipeline import Pipeline
+import autoflash.interaction.uboot as uboot
+from autoflash.imagepool import ImagePool
+from autoflash.checkpoint import CheckpointStore
 from pathlib import Path
 import autoflash.log as log
-from labelprinter import labels, printer
+from labelprinter.spooler import PrintSpooler, SPOOL_DIR_NAME
+from labelprinter.cache import LabelCache, CACHE_DIR_NAME, label_params
 
 
-def flash_autoconf(
-    images_dir: Path,
-    serial_port: str,
-    baudrate: int,
-    bootloader_password: str,
-    labelprinter: str = None,
-):
-    with tempfile.TemporaryDirectory() as tmpdir:
-        tmpdir = Path(tmpdir)
-        logging.info(f"Using temporary directory {tmpdir}")
+@dataclass
+class Job:
+    """An image claimed from the pool, with its labels submitted and the AP's IP"""
 
-        metadata_file = random.choice(list(images_dir.glob("*.json")))
-        sysupgrade_file = metadata_file.with_suffix(".bin")
+    name: str
+    ap_ip: ipaddress.IPv4Address
+    # Whether `ap_ip` is leased from `ips`
+    leased: bool
+    sha256: str
 
-        logging.info(f"Using metadata file {metadata_file}")
+    def __str__(self):
+        return f"{self.name} ({self.ap_ip})"
 
-        shutil.move(metadata_file, tmpdir / metadata_file.name)
-        shutil.move(sysupgrade_file, tmpdir / sysupgrade_file.name)
-        metadata_file = tmpdir / metadata_file.name
-        sysupgrade_file = tmpdir / sysupgrade_file.name
 
+def prepare_job(
+    image_pool: ImagePool,
+    holder: str,
+    bootloader_password: str,
+    print_spooler: PrintSpooler = None,
+    ap_ip: ipaddress.IPv4Address = None,
+) -> Job:
+    """
+    Claims an image for `holder`, hashes it and prints its labels. The AP's IP
+    is leased from `ips` for `holder`, unless `ap_ip` is passed.
+    """
+    name = image_pool.claim(holder=holder)
+    try:
+        metadata_file = image_pool.metadata_file(name)
+        logging.info(f"Using metadata file {metadata_file}")
         metadata = json.loads(metadata_file.read_text())
 
-        if labelprinter:
-            wifi_label = labels.render_wifi(
-                ssid=metadata["ssid"], password=metadata["wifi_password"]
-            )
-            printer.print_to_ip(wifi_label, labelprinter)
-
-            login_label = labels.render_login(
-                ip="192.168.0.1",
-                password=metadata["root_password"],
-                bootloader_pw=bootloader_password,
-            )
-            printer.print_to_ip(surf=login_label, ip=labelprinter)
+        if print_spooler:
+            cache = LabelCache(image_pool.images_dir / CACHE_DIR_NAME)
+            pages = [
+                cache.get(kind, params)
+                for kind, params in label_params(metadata, bootloader_password).items()
+            ]
+            print_spooler.submit(pages, name)
         else:
             logging.info("No labelprinter set, skipping label printing")
 
-        run_autoflash(
-            ramboot_file_name="ramboot.bin",
-            sysupgrade_path=sysupgrade_file,
-            port=serial_port,
-            speed=baudrate,
-            password=bootloader_password,
-            ap_ip=get_free_ip(reserved_ips=[TFTP_IP]),
+        sha256 = image_pool.sha256(name)
+        leased = ap_ip is None
+        if leased:
+            ap_ip = ips.claim_ip(reserved_ips=[TFTP_IP], holder=holder)
+    except BaseException:
+        image_pool.release(name)
+        raise
+
+    return Job(name, ap_ip, leased, sha256)
+
+
+def hand_over_job(image_pool: ImagePool, job: Job, holder: str, new_holder: str):
+    """
+    Passes a prepared job on to `new_holder`, see `pipeline`. Returns False if
+    the image's claim was lost. A lost lease is replaced, labels don't show the IP.
+    """
+    if not image_pool.hand_over(job.name, holder, new_holder):
+        return False
+    if job.leased and not ips.hand_over_ip(job.ap_ip, holder, new_holder):
+        job.ap_ip = ips.claim_ip(reserved_ips=[TFTP_IP], holder=new_holder)
+    return True
+
+
+def release_job(image_pool: ImagePool, job: Job):
+    """Returns a prepared job that wasn't flashed"""
+    logging.warning(f"Returning prepared image {job.name}, discard its printed labels")
+    image_pool.release(job.name)
+    if job.leased:
+        ips.release_ip(job.ap_ip)
+
+
+def flash_autoconf(
+    image_pool: ImagePool,
+    serial_port: str,
+    baudrate: int,
+    bootloader_password: str,
+    print_spooler: PrintSpooler = None,
+    image_server: ImageServer = None,
+    ser=None,
+    prompt=None,
+    fast_baudrate: int = None,
+    detect_baudrate=False,
+    capture_dir: Path = None,
+    checkpoint_dir: Path = None,
+    ap_ip: ipaddress.IPv4Address = None,
+    job: Job = None,
+):
+    """
+    Flashes the AP on `serial_port` with an image of the pool. In daemon mode,
+    the already open port `ser` and U-Boot's first `prompt` are passed. The
+    AP's IP is leased from `ips`, unless `ap_ip` is passed. A `job` that was
+    prepared ahead, see `pipeline`, is flashed instead of preparing one.
+    """
+    if job is None:
+        job = prepare_job(
+            image_pool, serial_port, bootloader_password, print_spooler, ap_ip
         )
+    try:
+        if ser is not None:
+            flash_ap(
+                ser,
+                ramboot_file_name="ramboot.bin",
+                sysupgrade_path=image_pool.sysupgrade_file(job.name),
+                password=bootloader_password,
+                ap_ip=job.ap_ip,
+                image_server=image_server,
+                prompt=prompt,
+                fast_speed=fast_baudrate,
+                detect_speed=detect_baudrate,
+                checkpoints=CheckpointStore(checkpoint_dir),
+                sysupgrade_sha256=job.sha256,
+            )
+        else:
+            run_autoflash(
+                ramboot_file_name="ramboot.bin",
+                sysupgrade_path=image_pool.sysupgrade_file(job.name),
+                port=serial_port,
+                speed=baudrate,
+                password=bootloader_password,
+                ap_ip=job.ap_ip,
+                image_server=image_server,
+                fast_speed=fast_baudrate,
+                detect_speed=detect_baudrate,
+                capture_dir=capture_dir,
+                checkpoint_dir=checkpoint_dir,
+                sysupgrade_sha256=job.sha256,
+            )
+    except BaseException:
+        image_pool.release(job.name)
+        raise
+
+    # After a failure the AP might still use its IP, so that lease is left to expire
+    if job.leased:
+        ips.release_ip(job.ap_ip)
+    image_pool.complete(job.name)
 
-        sysupgrade_file.unlink()
-        metadata_file.unlink()
+    return f"{job.ap_ip} {job.name}"
+
+
+def start_servers(args, stack: contextlib.ExitStack):
+    """Starts the built-in servers requested on the command line, returns the image server"""
+    if args.tftp_dir:
+        stack.enter_context(TftpServer(args.tftp_dir))
+    if args.http:
+        return stack.enter_context(ImageServer(port=args.http_port))
+    return None
 
 
 def parse_args():
@@ -77,12 +187,25 @@ def parse_args():
     parser.add_argument(
         "--port",
         type=str,
-        default="/dev/ttyUSB0",
-        help="Serial port, default is /dev/ttyUSB0",
+        nargs="+",
+        default=["/dev/ttyUSB0"],
+        help="Serial port(s) or glob like '/dev/ttyUSB*', default is /dev/ttyUSB0. "
+        "With multiple ports, one AP per port is flashed in parallel.",
     )
     parser.add_argument(
         "-s", "--speed", type=int, default=9600, help="Baudrate, default is 9600"
     )
+    parser.add_argument(
+        "--fast-speed",
+        type=int,
+        metavar="BAUD",
+        help="Switch U-Boot and OpenWrt to this baudrate after logging in, eg. 115200",
+    )
+    parser.add_argument(
+        "--detect-speed",
+        action="store_true",
+        help="Detect whether the AP talks at --speed or --fast-speed before logging in",
+    )
     parser.add_argument(
         "-p",
         "--password",
@@ -96,6 +219,105 @@ def parse_args():
         type=str,
         help="Hostname of the labelprinter to print labels. If not set, no labels will be printed.",
     )
+    parser.add_argument(
+        "--ip-network",
+        type=ipaddress.IPv4Network,
+        default=IP_NETWORK,
+        help=f"Network to lease AP IPs from, default is {IP_NETWORK}",
+    )
+    parser.add_argument(
+        "--http",
+        action="store_true",
+        help="Let the AP download the sysupgrade image from the built-in HTTP server "
+        "instead of copying it with scp",
+    )
+    parser.add_argument(
+        "--http-port",
+        type=int,
+        default=8080,
+        help="Port of the built-in HTTP server, default is 8080",
+    )
+    parser.add_argument(
+        "--tftp-dir",
+        type=Path,
+        help=f"Serve ramboot.bin from this directory with the built-in TFTP server on {TFTP_IP}:69 "
+        "instead of using an external TFTP server",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        type=Path,
+        help="Append timing events of all flash phases as JSON lines to this file",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Serve Prometheus metrics on this port at /metrics",
+    )
+    parser.add_argument(
+        "--uboot-script",
+        type=Path,
+        help="JSON file with the U-Boot prompts and dialogues of another AP model or U-Boot version, "
+        "see README",
+    )
+    parser.add_argument(
+        "--history",
+        type=Path,
+        metavar="FILE",
+        help="Keep the durations of all flash phases in this SQLite file and fail a phase early "
+        "once it takes much longer than before, see README",
+    )
+    parser.add_argument(
+        "--model",
+        type=str,
+        help="AP model the history is kept for, default is the name of the --uboot-script "
+        "or 'default'",
+    )
+    parser.add_argument(
+        "--checkpoint-dir",
+        type=Path,
+        help="Save the progress of every port to this directory and resume from it on the next run",
+    )
+    parser.add_argument(
+        "--capture-dir",
+        type=Path,
+        help="Record the serial session of every AP to a compressed file in this directory",
+    )
+    parser.add_argument(
+        "--log-dir",
+        type=Path,
+        help="When flashing multiple ports, additionally write one log file per port to this directory",
+    )
+    parser.add_argument(
+        "--netns",
+        action="append",
+        metavar="PORT=INTERFACE",
+        help="Flash the AP on PORT (eg. ttyUSB0) in a network namespace of its own with INTERFACE "
+        f"at {TFTP_IP}, so every AP keeps its default IP. Needs root, repeat for every port",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep the serial ports open and flash every AP that is powered on, until Ctrl-C is pressed",
+    )
+    parser.add_argument(
+        "--prepare-ahead",
+        type=int,
+        default=0,
+        metavar="N",
+        help="In daemon mode, prepare the next N APs of every port while the current one is flashed: "
+        "claim and hash their images, print their labels and lease their IPs",
+    )
+    parser.add_argument(
+        "--status-dir",
+        type=Path,
+        help="In daemon mode, write the state of every port to a file named after the port in this directory",
+    )
+    parser.add_argument(
+        "--status-command",
+        type=str,
+        help="In daemon mode, run this command with the port name and the new state as arguments "
+        f"whenever the state of a port changes. States: {', '.join(daemon.STATES)}",
+    )
     parser.add_argument(
         "-d",
         "--debug",
@@ -111,15 +333,125 @@ def parse_args():
 
 def main():
     args = parse_args()
-    logging.basicConfig(level=args.loglevel, format=log.FORMAT, datefmt=log.DATEFMT)
+    ports = parallel.expand_ports(args.port)
+    if not ports:
+        raise SystemExit("No serial ports found")
 
-    flash_autoconf(
-        images_dir=args.images_dir,
-        serial_port=args.port,
-        baudrate=args.speed,
-        bootloader_password=args.password,
-        labelprinter=args.labelprinter,
-    )
+    metrics.configure(args.metrics_file, args.metrics_port)
+    if TFTP_IP not in args.ip_network:
+        # U-Boot's ipaddr and serverip must be in the same subnet for the ramboot
+        raise SystemExit(f"--ip-network must contain the TFTP server's IP {TFTP_IP}")
+    ips.configure(network=args.ip_network)
+    if args.uboot_script:
+        uboot.use_script(args.uboot_script)
+    if args.history:
+        history.configure(
+            args.history,
+            model=args.model or (args.uboot_script.stem if args.uboot_script else None),
+        )
+    interfaces = None
+    if args.netns:
+        try:
+            interfaces = netns.parse_interfaces(args.netns, ports)
+        except ValueError as e:
+            raise SystemExit(f"--netns: {e}")
+
+    if args.prepare_ahead and not args.daemon:
+        raise SystemExit("--prepare-ahead requires --daemon")
+
+    if len(ports) == 1 and not args.daemon:
+        logging.basicConfig(level=args.loglevel, format=log.FORMAT, datefmt=log.DATEFMT)
+    else:
+        logging.basicConfig(
+            level=args.loglevel, format=log.PARALLEL_FORMAT, datefmt=log.DATEFMT
+        )
+
+    with contextlib.ExitStack() as stack:
+        image_pool = ImagePool(args.images_dir)
+        stack.callback(image_pool.close)
+        image_pool.refresh()
+        image_pool.log_stats()
+        # With --netns, every port has servers of its own
+        image_server = None if interfaces else start_servers(args, stack)
+        print_spooler = None
+        if args.labelprinter:
+            print_spooler = stack.enter_context(
+                PrintSpooler(args.labelprinter, args.images_dir / SPOOL_DIR_NAME)
+            )
+
+        def flash(port, **kwargs):
+            options = dict(
+                image_pool=image_pool,
+                serial_port=port,
+                baudrate=args.speed,
+                bootloader_password=args.password,
+                print_spooler=print_spooler,
+                fast_baudrate=args.fast_speed,
+                checkpoint_dir=args.checkpoint_dir,
+                **kwargs,
+            )
+            if not interfaces:
+                return flash_autoconf(image_server=image_server, **options)
+
+            # The servers of the host's namespace can't be reached from the port's
+            with netns.isolated(port, interfaces[parallel.port_name(port)]):
+                with contextlib.ExitStack() as port_stack:
+                    return flash_autoconf(
+                        image_server=start_servers(args, port_stack),
+                        ap_ip=OPENWRT_DEFAULT_LAN_IP,
+                        **options,
+                    )
+
+        if args.daemon:
+            # With --netns, every AP keeps the default IP
+            ap_ip = OPENWRT_DEFAULT_LAN_IP if interfaces else None
+            pipelines = {
+                port: stack.enter_context(
+                    Pipeline(
+                        port,
+                        lambda holder: prepare_job(
+                            image_pool, holder, args.password, print_spooler, ap_ip
+                        ),
+                        lambda job, holder, new_holder: hand_over_job(
+                            image_pool, job, holder, new_holder
+                        ),
+                        lambda job: release_job(image_pool, job),
+                        depth=args.prepare_ahead,
+                    )
+                )
+                for port in (ports if args.prepare_ahead else [])
+            }
+
+            def flash_next(ser, prompt):
+                pipeline = pipelines.get(ser.port)
+                job = pipeline.take() if pipeline else None
+                return flash(ser.port, ser=ser, prompt=prompt, job=job)
+
+            status = daemon.StatusReporter(args.status_dir, args.status_command)
+            daemon.run_daemon(
+                ports,
+                args.speed,
+                flash_next,
+                status,
+                log_dir=args.log_dir,
+                capture_dir=args.capture_dir,
+            )
+            return
+
+        def flash_port(port):
+            return flash(
+                port, detect_baudrate=args.detect_speed, capture_dir=args.capture_dir
+            )
+
+        if len(ports) == 1:
+            flash_port(ports[0])
+            return
+
+        results = parallel.run_on_ports(ports, flash_port, log_dir=args.log_dir)
+
+    parallel.print_results(results)
+    if not all(r.ok for r in results):
+        raise SystemExit(1)
 
 
 if __name__ == "__main__":
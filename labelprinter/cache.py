@@ -0,0 +1,109 @@
+"""
+Cache of printer-ready labels.
+
+Labels are stored under the SHA-256 of the label kind, its parameters and
+the templates (the sources of `labels` and `printer` and the printer
+header), so changed metadata or templates simply result in new entries.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import tempfile
+from pathlib import Path
+import labelprinter.labels as labels
+import labelprinter.printer as printer
+
+CACHE_DIR_NAME = ".label-cache"
+LOGIN_LABEL_IP = "192.168.0.1"
+
+WIFI = "wifi"
+LOGIN = "login"
+
+
+def _template_hash() -> str:
+    digest = hashlib.sha256()
+    for fn in ("labels.py", "printer.py", "header.prn"):
+        with open(printer.get_filename(fn), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+TEMPLATE_HASH = _template_hash()
+
+_renderers = {
+    WIFI: labels.render_wifi,
+    LOGIN: labels.render_login,
+}
+
+
+def label_params(metadata: dict, bootloader_password: str) -> dict:
+    """Returns `{kind: render parameters}` of the labels of an image's metadata"""
+    return {
+        WIFI: dict(ssid=metadata["ssid"], password=metadata["wifi_password"]),
+        LOGIN: dict(
+            ip=LOGIN_LABEL_IP,
+            password=metadata["root_password"],
+            bootloader_pw=bootloader_password,
+        ),
+    }
+
+
+def label_key(kind: str, params: dict) -> str:
+    data = json.dumps([TEMPLATE_HASH, kind, params], sort_keys=True)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class LabelCache:
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = Path(cache_dir)
+
+    def path(self, kind: str, params: dict) -> Path:
+        return self.cache_dir / f"{label_key(kind, params)}.prn"
+
+    def render(self, kind: str, params: dict) -> bytes:
+        """Renders and stores a label, returns the printer data"""
+        data = printer.format_surface(_renderers[kind](**params))
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # Write atomically, a parallel worker might read the label
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path(kind, params))
+        return data
+
+    def get(self, kind: str, params: dict) -> bytes:
+        """Returns the printer data of a label, rendering it if it's not cached yet"""
+        try:
+            return self.path(kind, params).read_bytes()
+        except FileNotFoundError:
+            logging.info(f"{kind} label not cached, rendering it now")
+            return self.render(kind, params)
+
+    def prerender(self, images_dir: Path, bootloader_password: str):
+        """
+        Renders the labels of all metadata files in `images_dir` that aren't
+        cached yet and removes stale entries. Returns the numbers of rendered
+        and removed labels.
+        """
+        wanted = set()
+        rendered = 0
+        for metadata_file in sorted(Path(images_dir).glob("*.json")):
+            metadata = json.loads(metadata_file.read_text())
+            for kind, params in label_params(metadata, bootloader_password).items():
+                path = self.path(kind, params)
+                wanted.add(path.name)
+                if not path.exists():
+                    logging.debug(f"Rendering {kind} label of {metadata_file.name}")
+                    self.render(kind, params)
+                    rendered += 1
+
+        removed = 0
+        for path in self.cache_dir.glob("*.prn"):
+            if path.name not in wanted:
+                path.unlink()
+                removed += 1
+
+        return rendered, removed
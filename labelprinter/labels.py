@@ -7,6 +7,7 @@ gi.require_version("Pango", "1.0")
 from gi.repository import Pango
 from gi.repository import PangoCairo
 import qrcode
+from PIL import Image
 import os
 
 
@@ -14,12 +15,24 @@ def get_filename(fn):
     return os.path.join(os.path.dirname(os.path.realpath(__file__)), fn)
 
 
-def putpixel(surf: cairo.ImageSurface, x, y, v):
-    offset = surf.get_stride() * y + x * 4
-    v = 255 if v else 0
-    d = surf.get_data()
-    for i in range(4):
-        d[offset + i] = v
+def blit(surf: cairo.ImageSurface, img, x, y):
+    """
+    Copies `img` to `surf` at (`x`, `y`), white where `img` is non-zero and
+    black elsewhere. Rows are copied as a whole into the surface's buffer.
+    """
+    img = img.convert("L").point(lambda v: 255 if v else 0)
+    rows = Image.merge("RGBA", (img,) * 4).tobytes()
+    row_bytes = img.width * 4
+    stride = surf.get_stride()
+
+    surf.flush()
+    data = surf.get_data()
+    for row in range(img.height):
+        offset = stride * (y + row) + x * 4
+        data[offset : offset + row_bytes] = rows[
+            row * row_bytes : (row + 1) * row_bytes
+        ]
+    surf.mark_dirty()
 
 
 def create_wifi_qr(ssid, password):
@@ -49,11 +62,7 @@ def render_wifi(ssid, password):
     ctx.paint()
 
     qrimg = create_wifi_qr(ssid, password)
-    imgsurf.flush()
-    for x in range(qrimg.width):
-        for y in range(qrimg.height):
-            putpixel(imgsurf, x, y + 7, qrimg.getpixel((x, y)))
-    imgsurf.mark_dirty()
+    blit(imgsurf, qrimg, 0, 7)
 
     opts = cairo.FontOptions()
     opts.set_antialias(cairo.ANTIALIAS_NONE)
@@ -14,61 +14,119 @@ def get_filename(fn):
 
 
 with open(get_filename("header.prn"), "rb") as f:
-    header = list(f.read())
+    header = f.read()
 
 
-def format_image(img):
-    img = Image.open(img)
-    assert img.width == REQUIRED_HEIGHT
-    out = list(header)
-    for i in range(4):
-        out[0x83 + i] = (img.height >> (i * 8)) & 0xFF
+# Every raster line is sent as "G", 16 bytes of pixel data (128 pixels)
+RASTER_LINE_BYTES = REQUIRED_HEIGHT // 8
+RASTER_LINE_COMMAND = bytes((0x47, RASTER_LINE_BYTES, 0))
 
-    for y in range(img.height):
-        packet = [0x47, 16, 0]
-        packet.extend((0,) * 16)
+# header.prn: invalidate, initialize and raster mode, followed by the page
+# settings starting with the print information command (ESC i z)
+PAGE_SETTINGS_OFFSET = 0x7C
+# n9 of ESC i z: 0 for the first page of a job, 1 for the following pages
+STARTING_PAGE_OFFSET = 0x87
+PRINT = 0x0C
+PRINT_AND_FEED = 0x1A
 
-        for x in range(img.width):
-            if img.getpixel((img.width - 1 - x, y)) == 0:
-                packet[int(x / 8) + 3] |= 1 << (7 - (x & 7))
-        out.extend(packet)
 
-    out.append(0x1A)
-    return bytes(out)
+def _black_pixels(img: Image.Image) -> Image.Image:
+    """Returns a 1-bit image in which set pixels are the black (zero) pixels of `img`"""
+    return img.point(lambda v: 255 if v == 0 else 0, "1")
 
 
-def getpixel(surf: cairo.ImageSurface, x, y):
-    offset = surf.get_stride() * y + x * 4
-    return surf.get_data()[offset] != 0
+def _raster_stream(img: Image.Image, width_mm=None) -> bytes:
+    """
+    Encodes a 1-bit image whose rows are the raster lines, ie. 128 pixels wide
+    and one row per raster line. PIL packs rows of 1-bit images MSB first,
+    which is the printer's bit order, so whole lines are copied at once.
+    """
+    assert img.width == REQUIRED_HEIGHT
+    out = bytearray(header)
+    if width_mm is not None:
+        out[0x81] = width_mm & 0xFF
+    out[0x83:0x87] = img.height.to_bytes(4, "little")
 
+    raster = img.tobytes()
+    for offset in range(0, len(raster), RASTER_LINE_BYTES):
+        out += RASTER_LINE_COMMAND
+        out += raster[offset : offset + RASTER_LINE_BYTES]
 
-def format_surface(surf: cairo.ImageSurface):
-    assert surf.get_format() == REQUIRED_FORMAT
-    assert surf.get_height() == REQUIRED_HEIGHT
-    out = list(header)
+    out.append(PRINT_AND_FEED)
+    return bytes(out)
 
-    width_mm = 24
-    out[0x81] = width_mm & 0xFF
 
-    for i in range(4):
-        out[0x83 + i] = (surf.get_width() >> (i * 8)) & 0xFF
+def format_image(img):
+    """
+    Encodes the image file `img`, pixels that are 0 are printed black. In
+    palette images, that's palette index 0, whatever its color. Images of
+    other modes are converted to grayscale first, so eg. pure black RGB
+    pixels are printed, which the per-pixel encoder before compared as
+    tuples with 0 and left blank.
+    """
+    img = Image.open(img)
+    assert img.width == REQUIRED_HEIGHT
+    if img.mode == "P":
+        img = Image.frombytes("L", img.size, img.tobytes())
+    elif img.mode != "L":
+        img = img.convert("L")
+
+    return _raster_stream(_black_pixels(img).transpose(Image.Transpose.FLIP_LEFT_RIGHT))
+
+
+def surface_channel(surf: cairo.ImageSurface) -> Image.Image:
+    """
+    Returns the first byte of every pixel of `surf` as an 8-bit image, without
+    copying the pixels one by one
+    """
+    surf.flush()
+    return Image.frombuffer(
+        "RGBA",
+        (surf.get_width(), surf.get_height()),
+        surf.get_data(),
+        "raw",
+        "RGBA",
+        surf.get_stride(),
+        1,
+    ).getchannel(0)
 
-    for y in range(surf.get_width()):
-        packet = [0x47, 16, 0]
-        packet.extend((0,) * 16)
 
-        for x in range(surf.get_height()):
-            if getpixel(surf, y, x) == 0:
-                packet[int(x / 8) + 3] |= 1 << (7 - (x & 7))
-        out.extend(packet)
+def format_surface(surf: cairo.ImageSurface):
+    assert surf.get_format() == REQUIRED_FORMAT
+    assert surf.get_height() == REQUIRED_HEIGHT
 
-    out.append(0x1A)
+    # Columns of the surface are the raster lines
+    lines = _black_pixels(surface_channel(surf)).transpose(Image.Transpose.TRANSPOSE)
+    return _raster_stream(lines, width_mm=24)
+
+
+def merge_pages(jobs: list[bytes]) -> bytes:
+    """
+    Merges jobs of `format_surface`/`format_image` into a single job with
+    one page per job. Only the last page is printed with feeding.
+    """
+    out = bytearray()
+    for i, job in enumerate(jobs):
+        assert job[:PAGE_SETTINGS_OFFSET] == header[:PAGE_SETTINGS_OFFSET]
+        assert job[-1] == PRINT_AND_FEED
+
+        if i == 0:
+            out += job[:-1]
+        else:
+            page = bytearray(job[PAGE_SETTINGS_OFFSET:-1])
+            page[STARTING_PAGE_OFFSET - PAGE_SETTINGS_OFFSET] = 1
+            out += page
+        out.append(PRINT if i < len(jobs) - 1 else PRINT_AND_FEED)
     return bytes(out)
 
 
-def print_to_ip(surf: cairo.ImageSurface, ip: str, port=9100):
-    out = format_surface(surf)
+def print_data(data: bytes, ip: str, port=9100):
+    """Sends printer-ready data, eg. from `format_surface`"""
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.connect((ip, port))
-    s.send(out)
+    s.sendall(data)
     s.close()
+
+
+def print_to_ip(surf: cairo.ImageSurface, ip: str, port=9100):
+    print_data(format_surface(surf), ip, port)
@@ -0,0 +1,172 @@
+"""
+Background print queue for the label printer.
+
+Jobs are written to the spool directory before they are queued and deleted
+only after they were sent completely, so no label is lost when the printer
+is offline or autoflash is stopped; the backlog is printed on the next
+start. The connection to the printer is kept open while jobs are coming in
+and failed jobs are retried with exponential backoff, without ever blocking
+the caller.
+"""
+
+import os
+import time
+import queue
+import select
+import socket
+import logging
+import tempfile
+import threading
+from pathlib import Path
+import labelprinter.printer as printer
+
+SPOOL_DIR_NAME = ".print-spool"
+MAX_QUEUED_JOBS = 100
+# Seconds after which an unused printer connection is closed
+IDLE_TIMEOUT = 10
+CONNECT_TIMEOUT = 5
+MIN_RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
+
+
+class PrintSpooler:
+    def __init__(self, ip: str, spool_dir: Path, port=9100):
+        self.ip = ip
+        self.port = port
+        self.spool_dir = Path(spool_dir)
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+
+        self._queue = queue.Queue(MAX_QUEUED_JOBS)
+        # Jobs that are on disk but didn't fit into the queue
+        self._overflowed = threading.Event()
+        self._stopping = threading.Event()
+        self._aborted = threading.Event()
+        self._sock = None
+        self._thread = threading.Thread(target=self._run, name="printer", daemon=True)
+
+    def submit(self, pages: list[bytes], name: str) -> Path:
+        """Queues printer data of `format_surface`, multiple pages are printed as one job"""
+        data = printer.merge_pages(pages) if len(pages) > 1 else pages[0]
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.spool_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        path = self.spool_dir / f"{time.time_ns()}-{name}.prn"
+        os.replace(tmp_path, path)
+
+        self._enqueue(path)
+        return path
+
+    def _enqueue(self, path: Path):
+        try:
+            self._queue.put_nowait(path)
+        except queue.Full:
+            logging.warning(f"Print queue full, {path.name} stays in the backlog")
+            self._overflowed.set()
+
+    def _alive(self) -> bool:
+        """
+        Whether the printer kept the connection open. Once it closed an idle
+        connection, `sendall` might still succeed locally and the job be lost.
+        """
+        readable, _, _ = select.select([self._sock], [], [], 0)
+        if not readable:
+            return True
+        try:
+            # Closed if there's nothing to read but the end of the stream
+            return self._sock.recv(1, socket.MSG_PEEK) != b""
+        except OSError:
+            return False
+
+    def _connect(self):
+        if self._sock is not None and not self._alive():
+            logging.debug(f"Printer {self.ip} closed the connection, reconnecting")
+            self._disconnect()
+        if self._sock is None:
+            self._sock = socket.create_connection(
+                (self.ip, self.port), timeout=CONNECT_TIMEOUT
+            )
+            logging.debug(f"Connected to printer {self.ip}:{self.port}")
+
+    def _disconnect(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _print(self, path: Path):
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            # Queued twice while requeuing the backlog and printed already
+            return
+
+        delay = MIN_RETRY_DELAY
+        while not self._aborted.is_set():
+            try:
+                self._connect()
+                self._sock.sendall(data)
+            except OSError as e:
+                self._disconnect()
+                logging.warning(
+                    f"Printing {path.name} on {self.ip} failed ({e}), retrying in {delay}s"
+                )
+                self._aborted.wait(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+                continue
+
+            path.unlink()
+            logging.info(f"Printed {path.name}")
+            return
+
+    def _requeue_backlog(self):
+        self._overflowed.clear()
+        queued = set(self._queue.queue)
+        for path in sorted(self.spool_dir.glob("*.prn")):
+            if path not in queued:
+                self._enqueue(path)
+
+    def _run(self):
+        self._requeue_backlog()
+        while not self._aborted.is_set():
+            try:
+                path = self._queue.get(
+                    timeout=0.5 if self._stopping.is_set() else IDLE_TIMEOUT
+                )
+            except queue.Empty:
+                self._disconnect()
+                if self._stopping.is_set():
+                    break
+                continue
+
+            self._print(path)
+            if self._queue.empty() and self._overflowed.is_set():
+                self._requeue_backlog()
+
+        self._disconnect()
+
+    def backlog(self) -> int:
+        return len(list(self.spool_dir.glob("*.prn")))
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=30):
+        """Waits up to `timeout` seconds for the queued jobs to be printed"""
+        self._stopping.set()
+        self._thread.join(timeout)
+        self._aborted.set()
+        self._thread.join()
+
+        if left := self.backlog():
+            logging.warning(
+                f"{left} label job(s) not printed yet, they are kept in {self.spool_dir}"
+            )
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,60 @@
+import time
+import logging
+import argparse
+from pathlib import Path
+import autoflash.log as log
+from labelprinter.cache import LabelCache, CACHE_DIR_NAME
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog="render_labels",
+        description="Pre-render the labels of all images for flash_autoconf.py",
+    )
+    parser.add_argument(
+        "-i",
+        "--images-dir",
+        type=Path,
+        required=True,
+        help="Directory containing images and metadata files",
+    )
+    parser.add_argument(
+        "-p",
+        "--password",
+        type=str,
+        default="dasuboot",
+        help="Bootloader Password printed on the login labels",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        help=f"Label cache directory, default is '{CACHE_DIR_NAME}' in the images directory",
+    )
+    parser.add_argument(
+        "-d",
+        "--debug",
+        help="Enable debug logging",
+        action="store_const",
+        dest="loglevel",
+        const=logging.DEBUG,
+        default=logging.INFO,
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=args.loglevel, format=log.FORMAT, datefmt=log.DATEFMT)
+
+    cache = LabelCache(args.cache_dir or args.images_dir / CACHE_DIR_NAME)
+    start = time.monotonic()
+    rendered, removed = cache.prerender(args.images_dir, args.password)
+    logging.info(
+        f"Rendered {rendered} labels and removed {removed} stale ones "
+        f"in {time.monotonic() - start:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import sys
+import time
+import logging
+import argparse
+from pathlib import Path
+import serial
+import autoflash.log as log
+import autoflash.interaction.uboot as uboot
+import autoflash.interaction.openwrt as openwrt
+from autoflash import TFTP_IP, OPENWRT_DEFAULT_LAN_IP
+from autoflash.capture import ReplaySerial, read_session, READ, WRITE, BAUDRATE
+
+
+def configure_ramboot(ser: ReplaySerial):
+    uboot.configure_ramboot(ser, TFTP_IP, OPENWRT_DEFAULT_LAN_IP, "ramboot.bin")
+    # Sessions recorded before the commands were batched sent them one by one
+    ser.skip_to_write(rb"setenv rambootfile ", missing_ok=True)
+
+
+def sysupgrade(ser: ReplaySerial):
+    # The image transfer needs the network, so it is skipped
+    ser.skip_to_write(rb"^sysupgrade ")
+    openwrt.wait_for_sysupgrade_complete(ser)
+
+
+# The serial dialogue of `flash_ap` without the steps that need the network.
+# What is written is ignored by `ReplaySerial`, so no real password is needed.
+STEPS = [
+    ("uboot_login", lambda ser: uboot.ensure_ready(ser, password="")),
+    ("configure_ramboot", configure_ramboot),
+    ("ramboot", lambda ser: uboot.run_ramboot(ser)),
+    ("shell_ready", lambda ser: openwrt.wait_for_shell_ready(ser)),
+    ("lan_ready", lambda ser: openwrt.wait_for_lan_ready(ser)),
+    ("sysupgrade", sysupgrade),
+    ("shell_ready", lambda ser: openwrt.wait_for_shell_ready(ser)),
+]
+
+
+def dump(path: Path):
+    """Prints the session, '<' marks what the AP sent and '>' what was sent to it"""
+    markers = {READ: "<", WRITE: ">", BAUDRATE: "="}
+    for t, kind, data in read_session(path):
+        text = data.decode("utf-8", errors="replace")
+        if kind == BAUDRATE:
+            text = f"{text} baud"
+        for line in text.splitlines() or [""]:
+            print(f"{t:10.3f} {markers[kind]} {line}")
+
+
+def replay(args):
+    """Runs the `flash_ap` dialogue against the recorded session, prints the duration of every step"""
+    ser = ReplaySerial(args.session, speed=args.speed)
+    start = time.monotonic()
+    for name, step in STEPS:
+        step_start = time.monotonic()
+        try:
+            step(ser)
+        except serial.SerialException:
+            print(f"Session ended during {name}")
+            break
+        except Exception as e:
+            print(f"{name} failed: {e}")
+            return False
+        print(f"  {name:<20} {time.monotonic() - step_start:7.3f}s")
+    print(f"Replayed in {time.monotonic() - start:.3f}s")
+    return True
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog="replay",
+        description="Replay a serial session recorded with --capture-dir",
+    )
+    parser.add_argument("session", type=Path, help="Recorded session file")
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="Replay speed, eg. 10 for ten times faster, 0 for no delays. Default is 1",
+    )
+    parser.add_argument(
+        "--dump",
+        action="store_true",
+        help="Print the recorded session with timestamps instead of replaying it",
+    )
+    parser.add_argument(
+        "-d",
+        "--debug",
+        help="Enable debug logging, ie. show serial output",
+        action="store_const",
+        dest="loglevel",
+        const=logging.DEBUG,
+        default=logging.WARNING,
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        help="Enable verbose logging",
+        action="store_const",
+        dest="loglevel",
+        const=logging.INFO,
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=args.loglevel, format=log.FORMAT, datefmt=log.DATEFMT)
+
+    if args.dump:
+        dump(args.session)
+        return
+
+    if not replay(args):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import logging
+import argparse
+import tempfile
+import contextlib
+from pathlib import Path
+import autoflash.log as log
+from autoflash import metrics
+from autoflash import parallel
+from autoflash import run_autoflash
+from autoflash.imageserver import ImageServer
+from autoflash.simulator import SimulatedAP, FAULTS
+
+PASSWORD = "admin@huawei.com"
+
+
+def simulator_options(args):
+    return dict(
+        password=PASSWORD,
+        baudrate=args.baudrate or None,
+        time_scale=args.time_scale,
+        faults=dict(args.fault),
+        seed=args.seed,
+    )
+
+
+def serve(args):
+    with contextlib.ExitStack() as stack:
+        for _ in range(args.count):
+            ap = stack.enter_context(SimulatedAP(**simulator_options(args)))
+            print(ap.port)
+        print(
+            f"Simulating {args.count} AP(s), password '{PASSWORD}'. Press Ctrl-C to stop."
+        )
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+
+def flash_simulated(args, count, parallel_ports, image_server, sysupgrade_path):
+    """Flashes `count` freshly powered on simulated APs and returns the results"""
+    metrics.reset()
+    with contextlib.ExitStack() as stack:
+        aps = [SimulatedAP(**simulator_options(args)) for _ in range(count)]
+        for ap in aps:
+            stack.callback(ap.stop)
+
+        def flash(ap):
+            ap.start()
+            run_autoflash(
+                "ramboot.bin",
+                sysupgrade_path,
+                ap.port,
+                password=PASSWORD,
+                image_server=image_server,
+                fast_speed=args.fast_speed,
+            )
+
+        start = time.monotonic()
+        if parallel_ports:
+            ports = {ap.port: ap for ap in aps}
+            results = parallel.run_on_ports(
+                list(ports), lambda port: flash(ports[port])
+            )
+            failed = sum(not r.ok for r in results)
+        else:
+            failed = 0
+            for ap in aps:
+                try:
+                    flash(ap)
+                except Exception:
+                    logging.exception(f"Flashing simulated AP on {ap.port} failed")
+                    failed += 1
+        duration = time.monotonic() - start
+
+    return {
+        "mode": "parallel" if parallel_ports else "sequential",
+        "aps": count,
+        "failed": failed,
+        "duration": round(duration, 2),
+        "aps_per_hour": round((count - failed) * 3600 / duration, 1),
+        "phases": {
+            phase: round(mean, 2)
+            for phase, (_, mean) in metrics.phase_summary().items()
+        },
+    }
+
+
+def bench(args):
+    with tempfile.TemporaryDirectory() as tmpdir, ImageServer(
+        host="127.0.0.1", port=0
+    ) as image_server:
+        sysupgrade_path = Path(tmpdir) / "sysupgrade.bin"
+        sysupgrade_path.write_bytes(os.urandom(args.image_size * 1024))
+
+        results = []
+        for parallel_ports in (False, True):
+            result = flash_simulated(
+                args, args.count, parallel_ports, image_server, sysupgrade_path
+            )
+            results.append(result)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    for result in results:
+        print(
+            f"\n{result['mode']}: {result['aps'] - result['failed']}/{result['aps']} APs "
+            f"in {result['duration']:.1f}s, {result['aps_per_hour']:.1f} APs/hour"
+        )
+        for phase, mean in result["phases"].items():
+            print(f"  {phase:<20} {mean:7.2f}s")
+
+
+def parse_fault(value):
+    name, _, probability = value.partition("=")
+    if name not in FAULTS:
+        raise argparse.ArgumentTypeError(
+            f"Unknown fault, choose from {', '.join(FAULTS)}"
+        )
+    return name, float(probability or 1)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog="simulate", description="Simulated Huawei APs for testing and benchmarking"
+    )
+    parser.add_argument(
+        "command",
+        choices=["serve", "bench"],
+        help="'serve' creates simulated APs and prints their serial ports, "
+        "'bench' flashes simulated APs sequentially and in parallel and reports the throughput",
+    )
+    parser.add_argument(
+        "-n",
+        "--count",
+        type=int,
+        default=4,
+        help="Number of simulated APs, default is 4",
+    )
+    parser.add_argument(
+        "--baudrate",
+        type=int,
+        default=9600,
+        help="Simulated serial line speed, 0 for unlimited. Default is 9600",
+    )
+    parser.add_argument(
+        "--fast-speed",
+        type=int,
+        metavar="BAUD",
+        help="Let 'bench' switch the APs to this baudrate after logging in",
+    )
+    parser.add_argument(
+        "--time-scale",
+        type=float,
+        default=1.0,
+        help="Factor for all simulated boot delays, default is 1.0",
+    )
+    parser.add_argument(
+        "--fault",
+        type=parse_fault,
+        action="append",
+        default=[],
+        help=f"Inject a fault with an optional probability, eg. 'ramboot_fail=0.2'. "
+        f"Faults: {', '.join(FAULTS)}",
+    )
+    parser.add_argument("--seed", type=int, help="Random seed for fault injection")
+    parser.add_argument(
+        "--image-size",
+        type=int,
+        default=6144,
+        help="Size of the sysupgrade image in KiB for 'bench', default is 6144",
+    )
+    parser.add_argument(
+        "--json", action="store_true", help="Print benchmark results as JSON"
+    )
+    parser.add_argument(
+        "-d",
+        "--debug",
+        help="Enable debug logging, ie. show serial output",
+        action="store_const",
+        dest="loglevel",
+        const=logging.DEBUG,
+        default=logging.WARNING,
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        help="Enable verbose logging",
+        action="store_const",
+        dest="loglevel",
+        const=logging.INFO,
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(
+        level=args.loglevel, format=log.PARALLEL_FORMAT, datefmt=log.DATEFMT
+    )
+
+    if args.command == "serve":
+        serve(args)
+    else:
+        bench(args)
+
+
+if __name__ == "__main__":
+    main()
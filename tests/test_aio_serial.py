@@ -0,0 +1,35 @@
+import os
+import pty
+import tty
+import asyncio
+from autoflash.aio.serial import AsyncSerial
+
+
+def test_write_does_not_block_the_loop():
+    master, slave = pty.openpty()
+    tty.setraw(master)
+    data = os.urandom(256 * 1024)
+
+    async def main():
+        async with AsyncSerial(os.ttyname(slave), 9600) as aser:
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            # Far more than the pty's buffer, nobody reads it yet
+            aser.write(data)
+            assert loop.time() - start < 0.5
+
+            received = bytearray()
+            while len(received) < len(data):
+                await asyncio.sleep(0)
+                try:
+                    received += os.read(master, 65536)
+                except BlockingIOError:
+                    pass
+            return bytes(received)
+
+    os.set_blocking(master, False)
+    try:
+        assert asyncio.run(asyncio.wait_for(main(), 10)) == data
+    finally:
+        os.close(master)
+        os.close(slave)
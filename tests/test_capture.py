@@ -0,0 +1,67 @@
+import time
+import pytest
+import serial
+from autoflash.capture import SessionRecorder, ReplaySerial, READ, WRITE, BAUDRATE
+
+
+def record(path, records):
+    recorder = SessionRecorder(path)
+    for kind, data in records:
+        recorder.record(kind, data)
+    recorder.close()
+    return path
+
+
+def test_replay_waits_for_writes(tmp_path):
+    path = record(
+        tmp_path / "ap.session.gz",
+        [
+            (BAUDRATE, b"9600"),
+            (READ, b"Password: "),
+            (WRITE, b"secret\n"),
+            (READ, b"ar7240> "),
+        ],
+    )
+    ser = ReplaySerial(path, speed=0, timeout=0.05)
+    assert ser.baudrate == 9600
+    assert ser.read(100) == b"Password: "
+    # The prompt followed the password, which wasn't sent yet
+    assert ser.read(100) == b""
+
+    ser.write(b"secret\n")
+    assert ser.read(100) == b"ar7240> "
+    assert ser.written == b"secret\n"
+    with pytest.raises(serial.SerialException):
+        ser.read(100)
+
+
+def test_replay_keeps_recorded_timing(tmp_path):
+    recorder = SessionRecorder(tmp_path / "ap.session.gz")
+    recorder.record(READ, b"first")
+    time.sleep(0.2)
+    recorder.record(READ, b"second")
+    recorder.close()
+
+    ser = ReplaySerial(recorder.path, speed=2, timeout=1)
+    start = time.monotonic()
+    assert ser.read(100) == b"first"
+    assert ser.read(100) == b"second"
+    assert 0.05 < time.monotonic() - start < 0.5
+
+
+def test_chunk_due_while_receiving(tmp_path):
+    recorder = SessionRecorder(tmp_path / "ap.session.gz")
+    recorder.record(READ, b"first")
+    time.sleep(0.02)
+    recorder.record(READ, b"second")
+    recorder.close()
+
+    class SlowReplaySerial(ReplaySerial):
+        def _receive(self):
+            super()._receive()
+            # The next chunk becomes due before `read` computes its wait
+            time.sleep(0.05)
+
+    ser = SlowReplaySerial(recorder.path, speed=1, timeout=1)
+    assert ser.read(100) == b"first"
+    assert ser.read(100) == b"second"
@@ -0,0 +1,124 @@
+import pytest
+from autoflash import checkpoint
+from autoflash.checkpoint import (
+    CheckpointStore,
+    UBOOT,
+    RAMBOOTED,
+    LAN_READY,
+    TRANSFERRED,
+    SYSUPGRADE,
+    DONE,
+    CONSOLE_UBOOT,
+    CONSOLE_RAMBOOT,
+    CONSOLE_INSTALLED,
+)
+
+IMAGE = "sysupgrade.bin"
+AP_IP = "192.168.1.1"
+SHA256 = "ab" * 32
+
+
+@pytest.fixture
+def console(monkeypatch):
+    """Sets what answers on the console, and records reboots of installed firmware"""
+    state = {"console": None, "installed_image": None, "reboots": 0}
+
+    monkeypatch.setattr(
+        checkpoint,
+        "probe_console",
+        lambda ser: (
+            state["console"],
+            "ar7240>" if state["console"] == CONSOLE_UBOOT else None,
+        ),
+    )
+    monkeypatch.setattr(
+        checkpoint.openwrt, "installed_image", lambda ser: state["installed_image"]
+    )
+
+    def reboot(ser):
+        state["reboots"] += 1
+
+    monkeypatch.setattr(checkpoint.openwrt, "reboot", reboot)
+    return state
+
+
+def saved(state, image=IMAGE, ap_ip=AP_IP):
+    return dict(state=state, image=image, ap_ip=ap_ip)
+
+
+@pytest.mark.parametrize(
+    "answer, checkpoint_state, expected",
+    [
+        (CONSOLE_UBOOT, None, UBOOT),
+        (CONSOLE_UBOOT, TRANSFERRED, UBOOT),
+        (CONSOLE_RAMBOOT, None, RAMBOOTED),
+        (CONSOLE_RAMBOOT, RAMBOOTED, RAMBOOTED),
+        (CONSOLE_RAMBOOT, LAN_READY, LAN_READY),
+        (CONSOLE_RAMBOOT, TRANSFERRED, TRANSFERRED),
+        # sysupgrade would have rebooted the AP, the image is still in /tmp
+        (CONSOLE_RAMBOOT, SYSUPGRADE, TRANSFERRED),
+        (CONSOLE_INSTALLED, SYSUPGRADE, DONE),
+        # Still booting
+        (None, RAMBOOTED, RAMBOOTED),
+        (None, TRANSFERRED, RAMBOOTED),
+        (None, SYSUPGRADE, SYSUPGRADE),
+        (None, None, UBOOT),
+        # The checkpoint's AP is finished, this is the next one
+        (CONSOLE_RAMBOOT, DONE, RAMBOOTED),
+    ],
+)
+def test_resume_state(console, answer, checkpoint_state, expected):
+    console["console"] = answer
+    last = saved(checkpoint_state) if checkpoint_state else None
+    state, prompt = checkpoint.resume_state(None, last, IMAGE, AP_IP)
+
+    assert state == expected
+    assert (prompt is not None) == (answer == CONSOLE_UBOOT)
+
+
+def test_other_image_keeps_only_what_was_done_to_the_ap(console):
+    console["console"] = CONSOLE_RAMBOOT
+    last = saved(TRANSFERRED, image="other.bin")
+    assert checkpoint.resume_state(None, last, IMAGE, AP_IP)[0] == LAN_READY
+
+
+def test_other_ip_needs_the_lan_again(console):
+    console["console"] = CONSOLE_RAMBOOT
+    last = saved(TRANSFERRED, ap_ip="192.168.1.2")
+    assert checkpoint.resume_state(None, last, IMAGE, AP_IP)[0] == RAMBOOTED
+
+
+def test_other_installed_firmware_is_rebooted(console):
+    console["console"] = CONSOLE_INSTALLED
+    console["installed_image"] = "cd" * 32
+    assert checkpoint.resume_state(None, None, IMAGE, AP_IP, SHA256)[0] == UBOOT
+    assert console["reboots"] == 1
+
+
+def test_installed_image_is_done(console):
+    console["console"] = CONSOLE_INSTALLED
+    console["installed_image"] = SHA256
+    assert checkpoint.resume_state(None, None, IMAGE, AP_IP, SHA256)[0] == DONE
+    assert console["reboots"] == 0
+
+
+def test_store_survives_restart(tmp_path):
+    CheckpointStore(tmp_path).save("/dev/ttyUSB0", LAN_READY, IMAGE, AP_IP)
+    loaded = CheckpointStore(tmp_path).load("/dev/ttyUSB0")
+    assert loaded["state"] == LAN_READY
+    assert loaded["image"] == IMAGE and loaded["ap_ip"] == AP_IP
+    assert CheckpointStore(tmp_path).load("/dev/ttyUSB1") is None
+
+
+def test_corrupt_checkpoint_is_ignored(tmp_path):
+    store = CheckpointStore(tmp_path)
+    store.save("/dev/ttyUSB0", LAN_READY, IMAGE, AP_IP)
+    next(tmp_path.glob("*.json")).write_text("{")
+    assert CheckpointStore(tmp_path).load("/dev/ttyUSB0") is None
+
+
+def test_store_without_directory():
+    store = CheckpointStore()
+    assert store.load("/dev/ttyUSB0") is None
+    store.save("/dev/ttyUSB0", RAMBOOTED, IMAGE, AP_IP)
+    assert store.load("/dev/ttyUSB0")["state"] == RAMBOOTED
@@ -0,0 +1,35 @@
+import os
+import hashlib
+from autoflash import digests
+from autoflash.digests import DigestCache
+
+
+def test_digest_is_cached_per_version_of_the_file(tmp_path, monkeypatch):
+    path = tmp_path / "sysupgrade.bin"
+    path.write_bytes(b"first")
+    hashed = []
+    sha256_file = digests.sha256_file
+    monkeypatch.setattr(
+        digests, "sha256_file", lambda p: hashed.append(p) or sha256_file(p)
+    )
+
+    cache = DigestCache(tmp_path / "digests.sqlite")
+    assert cache.sha256(path) == hashlib.sha256(b"first").hexdigest()
+    assert cache.sha256(path) == hashlib.sha256(b"first").hexdigest()
+    assert len(hashed) == 1
+
+    path.write_bytes(b"second")
+    os.utime(path, ns=(0, 1))
+    assert cache.sha256(path) == hashlib.sha256(b"second").hexdigest()
+    assert len(hashed) == 2
+    cache.close()
+
+    # Kept across runs
+    cache = DigestCache(tmp_path / "digests.sqlite")
+    assert cache.sha256(path) == hashlib.sha256(b"second").hexdigest()
+    assert len(hashed) == 2
+
+    cache.forget(path)
+    cache.sha256(path)
+    assert len(hashed) == 3
+    cache.close()
@@ -0,0 +1,72 @@
+import json
+import pytest
+from autoflash.capture import SessionRecorder, ReplaySerial, READ, WRITE
+from autoflash.interaction import expect, uboot
+from autoflash.interaction.expect import Dialogue, Script
+
+
+def test_batch_joins_commands_up_to_the_line_length():
+    commands = ["setenv a 1", "setenv b 2", "setenv c 3"]
+    assert expect.batch(commands, "; ", 200) == ["setenv a 1; setenv b 2; setenv c 3"]
+    assert expect.batch(commands, "; ", 22) == ["setenv a 1; setenv b 2", "setenv c 3"]
+    # A command longer than a line still gets one
+    assert expect.batch(["x" * 30, "y"], "; ", 10) == ["x" * 30, "y"]
+
+
+def test_batch_without_separator():
+    assert expect.batch(["a", "b"], None, 200) == ["a", "b"]
+    assert Script({"prompt": ">", "separator": None}).batch(["a", "b"]) == ["a", "b"]
+
+
+def test_rule_of_a_match():
+    dialogue = Dialogue(
+        "test",
+        [
+            {"pattern": r"Password(:| for (\w+))", "send": "{password}\n"},
+            {"pattern": r"(?P<prompt>ar7240)>", "done": True},
+        ],
+    )
+    assert dialogue.rule(dialogue.regex.search("Password for uboot")).send
+    assert dialogue.rule(dialogue.regex.search("boot\nar7240> ")).done
+
+
+def test_invalid_rule():
+    with pytest.raises(Exception, match="Invalid rule"):
+        Dialogue("test", [{"pattern": "x", "sned": "y"}])
+
+
+def test_script_file_overrides_base(tmp_path):
+    path = tmp_path / "script.json"
+    path.write_text(
+        json.dumps({"prompt": "ar7241>", "patterns": {"link_up": "link is up"}})
+    )
+    script = expect.load_script(path, uboot.SCRIPT)
+
+    assert script.prompt == "ar7241>"
+    assert script.pattern("link_up") == "link is up"
+    # Not overridden
+    assert script.pattern("ramboot_failed") == uboot.RAMBOOT_FAILED
+    assert (
+        script.dialogue("login").rules == Script(uboot.SCRIPT).dialogue("login").rules
+    )
+    with pytest.raises(Exception):
+        script.pattern("missing")
+
+
+def test_login_dialogue(tmp_path):
+    recorder = SessionRecorder(tmp_path / "ap.session.gz")
+    for kind, data in [
+        (READ, b"U-Boot 1.1.4\r\nPress f or F  to stop Auto-Boot in 3 seconds\r\n"),
+        (WRITE, b"f"),
+        (READ, b"Password for uboot cmd line :"),
+        (WRITE, b"secret\n"),
+        (READ, b"\r\nar7240> "),
+    ]:
+        recorder.record(kind, data)
+    recorder.close()
+
+    ser = ReplaySerial(recorder.path, speed=0, timeout=0.1)
+    rule = Script(uboot.SCRIPT).dialogue("login").run(ser, {"password": "secret"})
+
+    assert rule.done
+    assert ser.written == b"fsecret\n"
@@ -0,0 +1,74 @@
+import os
+import time
+import pytest
+from autoflash import run_autoflash, digests, checkpoint
+from autoflash.interaction import uboot
+from autoflash.imageserver import ImageServer
+from autoflash.simulator import SimulatedAP, FAULT_CORRUPT_DOWNLOAD
+
+PASSWORD = "admin@huawei.com"
+
+
+@pytest.fixture
+def image_server():
+    with ImageServer(host="127.0.0.1", port=0) as server:
+        yield server
+
+
+@pytest.fixture
+def ap():
+    with SimulatedAP(
+        baudrate=None, time_scale=0.05, power_on_delay=0, boot_log_lines=10
+    ) as ap:
+        yield ap
+
+
+def flash(ap, image_server, sysupgrade_path, **options):
+    run_autoflash(
+        "ramboot.bin",
+        sysupgrade_path,
+        ap.port,
+        password=PASSWORD,
+        image_server=image_server,
+        **options,
+    )
+
+
+def test_flash_simulated_ap(ap, image_server, tmp_path):
+    sysupgrade_path = tmp_path / "sysupgrade.bin"
+    sysupgrade_path.write_bytes(os.urandom(64 * 1024))
+    flash(ap, image_server, sysupgrade_path)
+
+    assert ap.sysupgrades == 1
+    assert ap.installed_sha256 == digests.sha256(sysupgrade_path)
+    # Not marked without skip_flashed
+    assert uboot.ENV_IMAGE not in ap.saved_env
+
+
+def test_skip_flashed_marks_only_after_sysupgrade(ap, image_server, tmp_path):
+    sysupgrade_path = tmp_path / "sysupgrade.bin"
+    sysupgrade_path.write_bytes(os.urandom(64 * 1024))
+    sha256 = digests.sha256(sysupgrade_path)
+    flash(ap, image_server, sysupgrade_path, skip_flashed=True)
+
+    assert ap.sysupgrades == 1
+    assert ap.saved_env[uboot.ENV_IMAGE] == sha256
+    assert ap.image_marker == sha256
+
+    # The same AP again, after power on it is stopped in U-Boot
+    ap.power_cycle()
+    time.sleep(0.5)
+    flash(ap, image_server, sysupgrade_path, skip_flashed=True)
+    assert ap.sysupgrades == 1
+
+
+def test_failed_sysupgrade_is_not_marked(ap, image_server, tmp_path, monkeypatch):
+    monkeypatch.setitem(checkpoint.RETRIES, checkpoint.LAN_READY, (1, 0))
+    sysupgrade_path = tmp_path / "sysupgrade.bin"
+    sysupgrade_path.write_bytes(os.urandom(64 * 1024))
+    ap.faults[FAULT_CORRUPT_DOWNLOAD] = 1.0
+    with pytest.raises(Exception):
+        flash(ap, image_server, sysupgrade_path, skip_flashed=True)
+
+    assert ap.sysupgrades == 0
+    assert uboot.ENV_IMAGE not in ap.saved_env
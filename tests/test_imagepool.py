@@ -0,0 +1,114 @@
+import threading
+import pytest
+from autoflash import imagepool
+from autoflash.imagepool import ImagePool, FREE, CLAIMED, DONE
+
+
+def add_images(images_dir, names):
+    for name in names:
+        (images_dir / f"{name}.json").write_text("{}")
+        (images_dir / f"{name}.bin").write_bytes(name.encode())
+
+
+@pytest.fixture
+def pool(tmp_path):
+    add_images(tmp_path, ["a", "b", "c"])
+    pool = ImagePool(tmp_path)
+    yield pool
+    pool.close()
+
+
+def test_claim_complete_release(pool):
+    first = pool.claim("port0")
+    second = pool.claim("port1")
+    assert first != second
+    assert pool.stats()[CLAIMED] == 2
+
+    pool.complete(first)
+    assert not pool.sysupgrade_file(first).exists()
+    assert not pool.metadata_file(first).exists()
+    pool.release(second)
+
+    stats = pool.stats()
+    assert (stats[FREE], stats[CLAIMED], stats[DONE]) == (2, 0, 1)
+    assert pool.claim("port2") in {"a", "b", "c"} - {first}
+
+
+def test_pool_runs_empty(pool):
+    for i in range(3):
+        pool.claim(f"port{i}")
+    with pytest.raises(Exception, match="No images left"):
+        pool.claim("port3")
+
+
+def test_same_holder_resumes_its_claim(pool):
+    name = pool.claim("port0")
+    pool.claim("port1")
+    # eg. after a crash, the image might already be on the AP
+    assert pool.claim("port0") == name
+    assert pool.stats()[CLAIMED] == 2
+
+
+def test_abandoned_claims_are_returned(pool, monkeypatch):
+    names = {pool.claim(f"port{i}") for i in range(3)}
+    monkeypatch.setattr(imagepool, "CLAIM_TIMEOUT", -1)
+    assert pool.claim("port3") in names
+
+
+def test_hand_over(pool):
+    name = pool.claim("port0+1")
+    assert pool.hand_over(name, "port0+1", "port0")
+    assert not pool.hand_over(name, "port0+1", "port1")
+    assert pool.claim("port0") == name
+
+    pool.release(name)
+    assert not pool.hand_over(name, "port0", "port1")
+
+
+def test_pools_in_parallel_never_share_an_image(tmp_path):
+    add_images(tmp_path, [f"image{i}" for i in range(40)])
+    pools = [ImagePool(tmp_path) for _ in range(4)]
+    claimed = []
+
+    def claim(pool, worker):
+        for i in range(10):
+            claimed.append(pool.claim(f"worker{worker}-{i}"))
+
+    threads = [
+        threading.Thread(target=claim, args=(pool, i)) for i, pool in enumerate(pools)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for pool in pools:
+        pool.close()
+
+    assert len(claimed) == 40
+    assert len(set(claimed)) == 40
+
+
+def test_rescans_added_and_removed_images(tmp_path):
+    add_images(tmp_path, ["a"])
+    pool = ImagePool(tmp_path)
+    pool.refresh()
+    assert pool.stats()[FREE] == 1
+
+    add_images(tmp_path, ["b", "c"])
+    # Without its metadata file, an image isn't complete
+    (tmp_path / "d.bin").write_bytes(b"d")
+    pool.refresh()
+    assert pool.stats()[FREE] == 3
+
+    (tmp_path / "a.json").unlink()
+    pool.refresh()
+    assert pool.stats()[FREE] == 2
+    pool.close()
+
+
+def test_completed_image_added_again(pool, tmp_path):
+    name = pool.claim("port0")
+    pool.complete(name)
+    add_images(tmp_path, [name])
+    pool.refresh()
+    assert pool.stats()[FREE] == 3
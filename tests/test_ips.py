@@ -0,0 +1,82 @@
+import ipaddress
+import pytest
+from autoflash import ips, IP_NETWORK, TFTP_IP
+
+NETWORK = ipaddress.IPv4Network("10.0.0.0/29")
+
+
+@pytest.fixture(autouse=True)
+def database(tmp_path):
+    ips.configure(tmp_path / "ips.sqlite", NETWORK)
+    yield
+    ips.configure("ips.sqlite", IP_NETWORK)
+
+
+def test_network_is_cycled_through_before_reuse():
+    claimed = []
+    for i in range(6):
+        ip = ips.claim_ip(holder=f"port{i}")
+        claimed.append(ip)
+        ips.release_ip(ip)
+
+    assert claimed == list(NETWORK.hosts())
+    # Then the IP released first
+    assert ips.claim_ip(holder="port6") == claimed[0]
+
+
+def test_reserved_ips_are_skipped():
+    reserved = [NETWORK[1], NETWORK[3]]
+    claimed = {ips.claim_ip(reserved, holder=f"port{i}") for i in range(4)}
+    assert claimed == set(NETWORK.hosts()) - set(reserved)
+
+    with pytest.raises(Exception):
+        ips.claim_ip(reserved, holder="port4")
+
+
+def test_holder_gets_its_unreleased_lease_back():
+    ip = ips.claim_ip(holder="port0")
+    ips.claim_ip(holder="port1")
+    assert ips.claim_ip(holder="port0") == ip
+
+
+def test_released_lease_is_not_resumed():
+    ip = ips.claim_ip(holder="port0")
+    ips.release_ip(ip)
+    assert ips.claim_ip(holder="port0") != ip
+
+
+def test_expired_lease_is_reused():
+    for i in range(6):
+        ips.claim_ip(holder=f"port{i}", lease_time=0 if i == 2 else 3600)
+    assert ips.claim_ip(holder="port6") == NETWORK[3]
+
+
+def test_hand_over():
+    ip = ips.claim_ip(holder="port0+1")
+    assert ips.hand_over_ip(ip, "port0+1", "port0")
+    # Only the current holder can hand it over
+    assert not ips.hand_over_ip(ip, "port0+1", "port1")
+    assert ips.claim_ip(holder="port0") == ip
+
+    ips.release_ip(ip)
+    assert not ips.hand_over_ip(ip, "port0", "port1")
+
+
+def test_networks_are_independent():
+    other = ipaddress.IPv4Network("10.0.1.0/30")
+    assert ips.claim_ip(holder="port0") == NETWORK[1]
+    assert ips.claim_ip(holder="port0", network=other) == other[1]
+
+
+def test_holder_lookup_is_indexed():
+    ips.claim_ip(holder="port0")
+    plan = ips._connection().execute(
+        "EXPLAIN QUERY PLAN SELECT ip FROM leases "
+        "WHERE network = ? AND holder = ? AND expires > ?",
+        (str(NETWORK), "port0", 0),
+    )
+    assert any("leases_holder" in row[-1] for row in plan)
+
+
+def test_default_network_contains_tftp_ip():
+    assert TFTP_IP in IP_NETWORK
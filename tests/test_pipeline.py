@@ -0,0 +1,104 @@
+import time
+import pytest
+import threading
+from autoflash import pipeline
+from autoflash.pipeline import Pipeline
+from autoflash.imagepool import ImagePool
+
+PORT = "/dev/ttyUSB0"
+
+
+def make_pool(tmp_path, count):
+    for i in range(count):
+        (tmp_path / f"image{i}.json").write_text("{}")
+        (tmp_path / f"image{i}.bin").write_bytes(b"sysupgrade")
+    return ImagePool(tmp_path)
+
+
+def make_pipeline(pool, depth=1, prepare_time=0.0):
+    prepared = []
+    released = []
+
+    def prepare(holder):
+        time.sleep(prepare_time)
+        name = pool.claim(holder)
+        prepared.append((holder, name))
+        return name
+
+    def release(name):
+        released.append(name)
+        pool.release(name)
+
+    p = Pipeline(PORT, prepare, pool.hand_over, release, depth=depth)
+    return p, prepared, released
+
+
+def test_first_take_waits_for_first_preparation(tmp_path, monkeypatch):
+    run = Pipeline._run
+
+    def late_run(self):
+        # The thread is scheduled only after the first `take`
+        time.sleep(0.1)
+        run(self)
+
+    monkeypatch.setattr(Pipeline, "_run", late_run)
+    pool = make_pool(tmp_path, 3)
+    p, prepared, _ = make_pipeline(pool)
+    with p:
+        job = p.take()
+        time.sleep(0.3)
+
+    # Not prepared again by `take` under the same holder, which would get the same image
+    assert prepared[0] == (PORT, job)
+    assert [holder for holder, _ in prepared].count(PORT) == 1
+
+
+def test_jobs_are_handed_over_to_the_port(tmp_path):
+    pool = make_pool(tmp_path, 4)
+    p, prepared, released = make_pipeline(pool, depth=2)
+    with p:
+        jobs = [p.take() for _ in range(3)]
+        for job in jobs:
+            pool.complete(job)
+
+    assert len(set(jobs)) == 3
+    # The port's own claim first, then slots <port>+1 to <port>+<depth>
+    assert prepared[0][0] == PORT
+    assert {holder for holder, _ in prepared[1:]} <= {f"{PORT}+1", f"{PORT}+2"}
+    # A prepared job that wasn't taken is returned to the pool
+    assert released and pool.stats()["free"] == 1
+
+
+def test_lost_job_is_replaced(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, "RENEW_INTERVAL", 0.05)
+    pool = make_pool(tmp_path, 3)
+    p, prepared, _ = make_pipeline(pool)
+    lost = threading.Event()
+
+    def hand_over(name, holder, new_holder):
+        if holder != new_holder and not lost.is_set():
+            lost.set()
+            # Eg. after `CLAIM_TIMEOUT`
+            pool.release(name)
+            return False
+        return pool.hand_over(name, holder, new_holder)
+
+    p._hand_over = hand_over
+    with p:
+        first = p.take()
+        pool.complete(first)
+        second = p.take()
+
+    assert first != second
+    assert lost.is_set()
+
+
+def test_take_prepares_after_failed_preparation(tmp_path):
+    pool = make_pool(tmp_path, 1)
+    p, prepared, _ = make_pipeline(pool)
+    with p:
+        assert p.take() == "image0"
+        pool.complete("image0")
+        # The pool is empty, `take` prepares on its own and raises
+        with pytest.raises(Exception):
+            p.take()
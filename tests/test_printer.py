@@ -0,0 +1,118 @@
+import io
+import random
+import pytest
+
+cairo = pytest.importorskip("cairo")
+from PIL import Image  # noqa: E402
+from labelprinter import printer  # noqa: E402
+
+WIDTH = 300
+
+
+def old_format_image(img):
+    """The per-pixel encoder `format_image` replaced"""
+    img = Image.open(img)
+    out = list(printer.header)
+    for i in range(4):
+        out[0x83 + i] = (img.height >> (i * 8)) & 0xFF
+
+    for y in range(img.height):
+        packet = [0x47, 16, 0]
+        packet.extend((0,) * 16)
+
+        for x in range(img.width):
+            if img.getpixel((img.width - 1 - x, y)) == 0:
+                packet[int(x / 8) + 3] |= 1 << (7 - (x & 7))
+        out.extend(packet)
+
+    out.append(0x1A)
+    return bytes(out)
+
+
+def old_format_surface(surf):
+    """The per-pixel encoder `format_surface` replaced"""
+    data = surf.get_data()
+    out = list(printer.header)
+    out[0x81] = 24
+    for i in range(4):
+        out[0x83 + i] = (surf.get_width() >> (i * 8)) & 0xFF
+
+    for y in range(surf.get_width()):
+        packet = [0x47, 16, 0]
+        packet.extend((0,) * 16)
+
+        for x in range(surf.get_height()):
+            if data[surf.get_stride() * x + y * 4] == 0:
+                packet[int(x / 8) + 3] |= 1 << (7 - (x & 7))
+        out.extend(packet)
+
+    out.append(0x1A)
+    return bytes(out)
+
+
+def random_image(mode, seed=0):
+    rng = random.Random(seed)
+    img = Image.new("L", (printer.REQUIRED_HEIGHT, 40), 255)
+    img.putdata(
+        [rng.choice((0, 0, 1, 128, 255)) for _ in range(img.width * img.height)]
+    )
+    return img.convert(mode)
+
+
+def png(img) -> io.BytesIO:
+    f = io.BytesIO()
+    img.save(f, "PNG")
+    f.seek(0)
+    return f
+
+
+@pytest.mark.parametrize("mode", ["L", "1"])
+def test_format_image_matches_old_encoder(mode):
+    img = random_image(mode)
+    assert printer.format_image(png(img)) == old_format_image(png(img))
+
+
+def test_format_image_palette_index_zero_is_black():
+    img = random_image("L").convert("P", palette=Image.Palette.ADAPTIVE, colors=4)
+    assert printer.format_image(png(img)) == old_format_image(png(img))
+
+
+def test_format_image_prints_black_rgb_pixels():
+    img = random_image("RGB")
+    expected = old_format_image(png(img.convert("L")))
+    assert printer.format_image(png(img)) == expected
+
+
+def test_format_surface_matches_old_encoder():
+    surf = cairo.ImageSurface(printer.REQUIRED_FORMAT, WIDTH, printer.REQUIRED_HEIGHT)
+    ctx = cairo.Context(surf)
+    ctx.set_source_rgb(1, 1, 1)
+    ctx.paint()
+    rng = random.Random(0)
+    for _ in range(50):
+        ctx.set_source_rgb(rng.random() < 0.5, rng.random(), 0)
+        ctx.rectangle(
+            rng.uniform(0, WIDTH),
+            rng.uniform(0, 128),
+            rng.uniform(1, 40),
+            rng.uniform(1, 40),
+        )
+        ctx.fill()
+    ctx.set_source_rgb(0, 0, 0)
+    ctx.move_to(10, 80)
+    ctx.set_font_size(40)
+    ctx.show_text("autoflash")
+    surf.flush()
+
+    assert printer.format_surface(surf) == old_format_surface(surf)
+
+
+def test_merge_pages():
+    surf = cairo.ImageSurface(printer.REQUIRED_FORMAT, WIDTH, printer.REQUIRED_HEIGHT)
+    page = printer.format_surface(surf)
+    merged = printer.merge_pages([page, page])
+
+    assert merged.startswith(page[:-1])
+    assert merged[len(page) - 1] == printer.PRINT
+    assert merged[-1] == printer.PRINT_AND_FEED
+    assert len(merged) == 2 * len(page) - printer.PAGE_SETTINGS_OFFSET
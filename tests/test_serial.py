@@ -0,0 +1,50 @@
+from autoflash.interaction import serial
+from autoflash.interaction.serial import Console, PromptMatcher
+
+
+def test_prompt_split_across_reads():
+    matcher = PromptMatcher(r"ar7240>")
+    assert matcher.feed("booting\nar72") is None
+    match = matcher.feed("40> ")
+    assert match and match.group(0) == "ar7240>"
+
+
+def test_prompt_doesnt_match_across_lines():
+    matcher = PromptMatcher(r"Password: ")
+    assert matcher.feed("Pass") is None
+    assert matcher.feed("\nword: ") is None
+
+
+def test_alternation_reports_the_prompt_that_matched():
+    matcher = PromptMatcher(r"(?P<ok>Done)|(?P<failed>Error)")
+    assert matcher.feed("line\nError").lastgroup == "failed"
+
+
+def test_matcher_starts_over_after_a_match():
+    matcher = PromptMatcher(r"# ")
+    assert matcher.feed("root@OpenWrt:~# ")
+    assert matcher.feed("ls\n") is None
+
+
+def test_matcher_window_is_bounded():
+    matcher = PromptMatcher(r"never")
+    for _ in range(100):
+        matcher.feed("x" * 1000)
+    assert len(matcher._tail) <= serial.MAX_LINE_LENGTH
+
+
+def test_console_decodes_utf8_split_across_reads():
+    console = Console()
+    data = "Grüße\n".encode("utf-8")
+    split = data.index(b"\xc3") + 1
+    assert console.decode(data[:split]) + console.decode(data[split:]) == "Grüße\n"
+    assert list(console.history) == ["Grüße"]
+
+
+def test_console_history_is_bounded():
+    console = Console(history_lines=3)
+    console.decode("".join(f"line {i}\n" for i in range(10)).encode())
+    console.decode(b"partial")
+    assert list(console.history) == ["line 7", "line 8", "line 9"]
+    assert console.history_contains(r"^partial$")
+    assert not console.history_contains(r"line 6")
@@ -0,0 +1,101 @@
+import time
+import socket
+import threading
+import pytest
+
+pytest.importorskip("cairo")
+from labelprinter import spooler as spooler_module  # noqa: E402
+from labelprinter.spooler import PrintSpooler  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def short_idle_timeout(monkeypatch):
+    # The spooler notices `stop` only after waiting this long for a job
+    monkeypatch.setattr(spooler_module, "IDLE_TIMEOUT", 1)
+
+
+class Printer:
+    """Accepts raw print jobs, and closes a connection once it was idle for `idle_close` seconds"""
+
+    def __init__(self, idle_close=0.2):
+        self.idle_close = idle_close
+        self.connections = []
+        self._server = socket.create_server(("127.0.0.1", 0))
+        self.port = self._server.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            received = bytearray()
+            self.connections.append(received)
+            threading.Thread(
+                target=self._receive, args=(conn, received), daemon=True
+            ).start()
+
+    def _receive(self, conn, received):
+        conn.settimeout(self.idle_close)
+        with conn:
+            try:
+                while data := conn.recv(65536):
+                    received += data
+            except socket.timeout:
+                pass
+
+    def received(self) -> bytes:
+        return b"".join(self.connections)
+
+    def close(self):
+        self._server.close()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_jobs_are_printed_and_deleted(tmp_path):
+    printer = Printer(idle_close=5)
+    with PrintSpooler("127.0.0.1", tmp_path, port=printer.port) as spooler:
+        spooler.submit([b"first"], "a")
+        spooler.submit([b"second"], "b")
+        wait_for(lambda: spooler.backlog() == 0)
+    printer.close()
+
+    assert printer.received() == b"firstsecond"
+    assert len(printer.connections) == 1
+
+
+def test_reconnects_after_printer_closed_idle_connection(tmp_path):
+    printer = Printer(idle_close=0.1)
+    with PrintSpooler("127.0.0.1", tmp_path, port=printer.port) as spooler:
+        spooler.submit([b"first"], "a")
+        wait_for(lambda: printer.received() == b"first")
+        # The printer closes the connection while the spooler keeps it
+        time.sleep(0.5)
+        spooler.submit([b"second"], "b")
+        wait_for(lambda: spooler.backlog() == 0)
+        wait_for(lambda: printer.received() == b"firstsecond")
+    printer.close()
+
+    assert len(printer.connections) == 2
+
+
+def test_backlog_is_kept_while_printer_is_offline(tmp_path):
+    with socket.create_server(("127.0.0.1", 0)) as unused:
+        port = unused.getsockname()[1]
+    spooler = PrintSpooler("127.0.0.1", tmp_path, port=port).start()
+    spooler.submit([b"job"], "a")
+    spooler.stop(timeout=0.2)
+    assert spooler.backlog() == 1
+
+    printer = Printer(idle_close=5)
+    with PrintSpooler("127.0.0.1", tmp_path, port=printer.port) as spooler:
+        wait_for(lambda: spooler.backlog() == 0)
+    printer.close()
+    assert printer.received() == b"job"
@@ -0,0 +1,172 @@
+import os
+import socket
+import struct
+import pytest
+from autoflash import tftp
+from autoflash.tftp import (
+    TftpServer,
+    OP_RRQ,
+    OP_WRQ,
+    OP_DATA,
+    OP_ACK,
+    OP_ERROR,
+    OP_OACK,
+)
+
+
+@pytest.fixture
+def root(tmp_path):
+    (tmp_path / "sub").mkdir()
+    return tmp_path
+
+
+@pytest.fixture
+def server(root):
+    with TftpServer(root, host="127.0.0.1", port=0) as server:
+        yield server
+
+
+class Client:
+    def __init__(self, server):
+        self.server = server.address
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.settimeout(5)
+        self.peer = None
+
+    def request(self, filename, opcode=OP_RRQ, mode="octet", **options):
+        fields = [filename, mode] + [str(f) for kv in options.items() for f in kv]
+        packet = struct.pack("!H", opcode) + b"".join(
+            f.encode("ascii") + b"\0" for f in fields
+        )
+        self.sock.sendto(packet, self.server)
+
+    def receive(self):
+        packet, self.peer = self.sock.recvfrom(70000)
+        opcode = struct.unpack("!H", packet[:2])[0]
+        return opcode, packet[2:]
+
+    def ack(self, block):
+        self.sock.sendto(struct.pack("!HH", OP_ACK, block & 0xFFFF), self.peer)
+
+    def error(self):
+        opcode, payload = self.receive()
+        assert opcode == OP_ERROR
+        return struct.unpack("!H", payload[:2])[0]
+
+    def oack(self) -> dict:
+        opcode, payload = self.receive()
+        assert opcode == OP_OACK
+        fields = payload.rstrip(b"\0").decode("ascii").split("\0")
+        self.ack(0)
+        return dict(zip(fields[::2], fields[1::2]))
+
+    def download(self, blksize=512, windowsize=1, drop=None) -> bytes:
+        """Receives the file, `drop(block)` tells whether a DATA packet gets lost"""
+        data = bytearray()
+        expected = 1
+        received = 0
+        while True:
+            opcode, payload = self.receive()
+            assert opcode == OP_DATA
+            block = struct.unpack("!H", payload[:2])[0]
+            if drop and drop(expected) and block == expected & 0xFFFF:
+                drop = None
+                # The rest of the window is out of order, ACK what we have
+                self.ack(expected - 1)
+                received = 0
+                continue
+            if block != expected & 0xFFFF:
+                continue
+            data += payload[2:]
+            last = len(payload) - 2 < blksize
+            received += 1
+            if last or received == windowsize:
+                self.ack(expected)
+                received = 0
+            if last:
+                return bytes(data)
+            expected += 1
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def client(server):
+    client = Client(server)
+    yield client
+    client.close()
+
+
+def test_transfer_without_options(root, client):
+    # A multiple of the block size ends with an empty block
+    data = os.urandom(512 * 3)
+    (root / "ramboot.bin").write_bytes(data)
+    client.request("ramboot.bin")
+    assert client.download() == data
+
+
+def test_option_negotiation(root, client):
+    data = os.urandom(100000)
+    (root / "ramboot.bin").write_bytes(data)
+    client.request("ramboot.bin", blksize=1468, windowsize=4, tsize=0, timeout=2)
+    assert client.oack() == {
+        "blksize": "1468",
+        "windowsize": "4",
+        "timeout": "2",
+        "tsize": str(len(data)),
+    }
+    assert client.download(blksize=1468, windowsize=4) == data
+
+
+def test_options_are_clamped(root, client):
+    (root / "ramboot.bin").write_bytes(b"x")
+    client.request("ramboot.bin", blksize=100000, windowsize=1000)
+    oack = client.oack()
+    assert oack["blksize"] == str(tftp.MAX_BLKSIZE)
+    assert oack["windowsize"] == str(tftp.MAX_WINDOWSIZE)
+    assert client.download(blksize=tftp.MAX_BLKSIZE) == b"x"
+
+
+def test_invalid_option_value(root, client):
+    (root / "ramboot.bin").write_bytes(b"x")
+    client.request("ramboot.bin", blksize="large")
+    assert client.error() == tftp.ERR_OPTION_NEGOTIATION
+
+
+def test_window_resumes_after_lost_packet(root, client):
+    data = os.urandom(512 * 20 + 100)
+    (root / "ramboot.bin").write_bytes(data)
+    client.request("ramboot.bin", windowsize=8)
+    client.oack()
+    assert client.download(windowsize=8, drop=lambda block: block == 11) == data
+
+
+def test_block_numbers_wrap_around(root, client):
+    data = os.urandom(8 * 66000)
+    (root / "ramboot.bin").write_bytes(data)
+    client.request("ramboot.bin", blksize=8, windowsize=64)
+    client.oack()
+    assert client.download(blksize=8, windowsize=64) == data
+
+
+@pytest.mark.parametrize(
+    "filename, opcode, mode, code",
+    [
+        ("missing.bin", OP_RRQ, "octet", tftp.ERR_FILE_NOT_FOUND),
+        ("sub", OP_RRQ, "octet", tftp.ERR_FILE_NOT_FOUND),
+        ("", OP_RRQ, "octet", tftp.ERR_FILE_NOT_FOUND),
+        ("../outside.bin", OP_RRQ, "octet", tftp.ERR_ACCESS_VIOLATION),
+        ("ramboot.bin", OP_WRQ, "octet", tftp.ERR_ILLEGAL_OPERATION),
+        ("ramboot.bin", OP_RRQ, "netascii", tftp.ERR_ILLEGAL_OPERATION),
+    ],
+)
+def test_rejected_requests(root, server, client, filename, opcode, mode, code):
+    (root / "ramboot.bin").write_bytes(b"x")
+    (root.parent / "outside.bin").write_bytes(b"x")
+    client.request(filename, opcode, mode)
+    assert client.error() == code
+
+    # The server keeps serving
+    client.request("ramboot.bin")
+    assert client.download() == b"x"